@@ -0,0 +1,188 @@
+"""
+在 Firestore 模擬器中建立合成的使用者群組（cohort），資料結構與正式環境相同：
+- users/{uid}：app_config（1 實驗組、0 對照組）
+- users/{uid}/{experiment|control}_events/{eventId}：reading / vocab 任務事件
+  - chats/{chatId}（含 messages 子集合）、notifications/{notifId}、review/{sessionId}
+  - vocab/{sessionId}：vocab 任務的學習會話
+- users/{uid}/{experiment|control}/data/app_sessions/{sessionId}
+
+群組大小由使用者數、天數、每天事件數與每個事件的聊天 / 通知 / 複習數決定，同一個 seed 產生相同的資料
+單獨執行只建立資料（需先啟動模擬器：firebase emulators:start --only firestore）：
+
+    FIRESTORE_EMULATOR_HOST=127.0.0.1:8080 python benchmarks/cohort.py --users 100 --events-per-day 4
+"""
+
+import argparse
+import os
+import random
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+# 與 functions/main.py 相同的固定 UTC+8 時區
+TAIWAN_TZ = timezone(timedelta(hours=8), 'Asia/Taipei')
+# 一次批量寫入的文檔數（Firestore 上限 500）
+SEED_BATCH_SIZE = 500
+# 事件排程的時段（台灣時間的小時）
+EVENT_HOURS = (9, 11, 14, 16, 19, 21)
+CHAT_RESULTS = (0, 1, 2)  # start / snooze / leave
+VOCAB_CARDS_PER_DAY = 8
+
+
+def reset_emulator(project: str, host: str | None = None) -> None:
+    """清空模擬器中該專案的所有文檔"""
+    host = host or os.environ['FIRESTORE_EMULATOR_HOST']
+    request = urllib.request.Request(
+        f"http://{host}/emulator/v1/projects/{project}/databases/(default)/documents", method='DELETE'
+    )
+    urllib.request.urlopen(request).close()
+
+
+def chat_messages(rnd: random.Random, count: int, start: datetime) -> list[dict]:
+    """聊天的 messages 子集合（role 與客戶端相同，形如 'ChatRole.user'）"""
+    messages = []
+    for i in range(count):
+        role = 'ChatRole.assistant' if i % 2 == 0 else 'ChatRole.user'
+        content = f"第{i + 1}句：{'今天有點累，不太想開始' if role == 'ChatRole.user' else '聽起來今天負擔不小，什麼讓你卡住了？'}{rnd.randint(0, 9999)}"
+        messages.append({'role': role, 'content': content, 'timestamp': start + timedelta(seconds=30 * i)})
+    return messages
+
+
+def cohort_documents(users: int, days: int, events_per_day: int, chats_per_event: int,
+                     notifications_per_event: int, reviews_per_event: int, messages_per_chat: int,
+                     sessions_per_day: int, seed: int, today: datetime):
+    """
+    依序產生 (文檔路徑, 數據)；最後一天為 today，前一天即夜間任務統計的日期
+    """
+    rnd = random.Random(seed)
+    first_day = today.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    for u in range(users):
+        uid = f"bench{u:05d}"
+        group = 'control' if u % 2 else 'experiment'
+        yield f"users/{uid}", {'app_config': 0 if group == 'control' else 1, 'createdAt': first_day.astimezone(timezone.utc)}
+
+        for d in range(days):
+            day = first_day + timedelta(days=d)
+            week, weekday = d // 7 + 1, d % 7 + 1
+            for e in range(events_per_day):
+                task = 'vocab' if e % 2 else 'reading'
+                start = day.replace(hour=EVENT_HOURS[e % len(EVENT_HOURS)]).astimezone(timezone.utc)
+                event_path = f"users/{uid}/{group}_events/{day:%Y%m%d}-{e}"
+                yield event_path, {
+                    'title': f"{task}-w{week}-d{weekday}",
+                    'scheduledStartTime': start,
+                    'scheduledEndTime': start + timedelta(minutes=15),
+                    'date': day.astimezone(timezone.utc),
+                    'isDone': rnd.random() < 0.6,
+                }
+                for c in range(chats_per_event):
+                    chat_start = start - timedelta(minutes=5 + c)
+                    chat_path = f"{event_path}/chats/c{c}"
+                    yield chat_path, {
+                        'start_time': chat_start,
+                        'result': rnd.choice(CHAT_RESULTS),
+                        'commit_plan': rnd.choice(['', '先讀第一篇']),
+                    }
+                    for m, message in enumerate(chat_messages(rnd, messages_per_chat, chat_start)):
+                        yield f"{chat_path}/messages/m{m:03d}", message
+                for n in range(notifications_per_event):
+                    yield f"{event_path}/notifications/n{n}", {
+                        'created_at': start - timedelta(minutes=10 - 15 * n),
+                        'opened_time': start if rnd.random() < 0.4 else None,
+                    }
+                for r in range(reviews_per_event):
+                    yield f"{event_path}/review/r{r}", {
+                        'startTime': start + timedelta(hours=2 + r),
+                        'durationMin': rnd.randint(1, 15),
+                        'taskType': task,
+                    }
+                if task == 'vocab':
+                    yield f"{event_path}/vocab/s0", {
+                        'startTime': start,
+                        'status': 'completed',
+                        'totalWords': VOCAB_CARDS_PER_DAY,
+                        'cardDwellTimes': {str(i): rnd.choice([0, rnd.randint(500, 8000)]) for i in range(VOCAB_CARDS_PER_DAY)},
+                    }
+
+            for s in range(sessions_per_day):
+                yield f"users/{uid}/{group}/data/app_sessions/{day:%Y%m%d}-{s}", {
+                    'date': f"{day:%Y%m%d}",
+                    'duration_seconds': rnd.randint(0, 900),
+                    'opened_by_notification': rnd.random() < 0.3,
+                }
+
+
+def seed_cohort(db, users: int = 50, days: int = 2, events_per_day: int = 4, chats_per_event: int = 1,
+                notifications_per_event: int = 2, reviews_per_event: int = 1, messages_per_chat: int = 6,
+                sessions_per_day: int = 3, seed: int = 1, today: datetime | None = None) -> int:
+    """把合成群組寫入 db，返回寫入的文檔數"""
+    today = today or datetime.now(TAIWAN_TZ)
+    batch = db.batch()
+    pending = 0
+    written = 0
+    for path, data in cohort_documents(users, days, events_per_day, chats_per_event, notifications_per_event,
+                                       reviews_per_event, messages_per_chat, sessions_per_day, seed, today):
+        batch.set(db.document(path), data)
+        pending += 1
+        if pending == SEED_BATCH_SIZE:
+            batch.commit()
+            written += pending
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+        written += pending
+    return written
+
+
+def add_cohort_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--days', type=int, default=2, help='建立的天數（最後一天為今天）')
+    parser.add_argument('--events-per-day', type=int, default=4)
+    parser.add_argument('--chats-per-event', type=int, default=1)
+    parser.add_argument('--notifications-per-event', type=int, default=2)
+    parser.add_argument('--reviews-per-event', type=int, default=1)
+    parser.add_argument('--messages-per-chat', type=int, default=6)
+    parser.add_argument('--sessions-per-day', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def cohort_kwargs(args: argparse.Namespace) -> dict:
+    return {
+        'users': args.users,
+        'days': args.days,
+        'events_per_day': args.events_per_day,
+        'chats_per_event': args.chats_per_event,
+        'notifications_per_event': args.notifications_per_event,
+        'reviews_per_event': args.reviews_per_event,
+        'messages_per_chat': args.messages_per_chat,
+        'sessions_per_day': args.sessions_per_day,
+        'seed': args.seed,
+    }
+
+
+def emulator_client(project: str):
+    """連到模擬器的 Firestore 客戶端（匿名憑證，不需要 Application Default Credentials）"""
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import firestore
+
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit("❌ 請先啟動 Firestore 模擬器並設定 FIRESTORE_EMULATOR_HOST（例如 127.0.0.1:8080）")
+    return firestore.Client(project=project, credentials=AnonymousCredentials())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='在 Firestore 模擬器中建立合成使用者群組')
+    add_cohort_arguments(parser)
+    parser.add_argument('--project', default=os.environ.get('GOOGLE_CLOUD_PROJECT', 'demo-momentum'))
+    parser.add_argument('--keep', action='store_true', help='不清空模擬器中的既有資料')
+    args = parser.parse_args()
+
+    db = emulator_client(args.project)
+    if not args.keep:
+        reset_emulator(args.project)
+    written = seed_cohort(db, **cohort_kwargs(args))
+    print(f"✅ 已寫入 {written} 個文檔（{args.users} 個用戶、{args.days} 天）")
+
+
+if __name__ == '__main__':
+    main()
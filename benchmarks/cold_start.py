@@ -0,0 +1,262 @@
+"""
+雲函數冷啟動基準：每次在新的子進程中導入 functions/main.py，再呼叫一次指定的函數
+- import_ms：導入 main 的時間（所有函數共用同一個模組，部署後每個實例啟動時都要付出）
+- first_call_ms：導入後第一次呼叫的時間，包含該函數首次使用時才導入的依賴與客戶端初始化
+- modules / call_modules：導入後的模組數與第一次呼叫額外載入的模組數，call_packages 為額外載入的頂層套件
+- rss_mb：第一次呼叫後的進程 RSS
+
+只量測導入（不需模擬器）：
+
+    python benchmarks/cold_start.py --import-only
+
+量測每個函數（需 Firestore 模擬器；OpenAI 使用本地 Fake OpenAI）：
+
+    export FIRESTORE_EMULATOR_HOST=127.0.0.1:8080
+    python benchmarks/cold_start.py --repeat 5 --json cold_start.json
+    python benchmarks/cold_start.py --baseline cold_start.json --max-regression 0.2
+
+Firestore 觸發器（live_metrics_on_*、summarize_chat_on_end）與批量摘要不在列表中，其冷啟動成本即導入成本
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'functions')
+
+# 量測的函數；'import' 只導入 main，不呼叫任何函數
+FUNCTIONS = (
+    'procrastination_coach_completion',
+    'procrastination_coach_stream',
+    'summarize_chat',
+    'vocab_review_queue',
+    'curriculum_content',
+    'test_users_access',
+    'get_experiment_stats',
+    'manual_daily_metrics',
+    'daily_metrics_aggregation',
+    'coach_context_refresh',
+    'llm_telemetry_rollup',
+)
+RESULT_PREFIX = 'COLD_START_RESULT '
+
+
+def coach_data() -> dict:
+    return {
+        'taskTitle': 'reading-w1-d1',
+        'dialogues': [{'role': 'assistant', 'content': '今天想從哪裡開始？'}, {'role': 'user', 'content': '有點累，不太想動'}],
+        'startTime': '2026-10-17 09:00',
+        'currentTurn': 1,
+        'dayNumber': 1,
+        'taskDurationMin': 15,
+    }
+
+
+def http_request(method: str, path: str = '/', query: dict | None = None, body: dict | None = None):
+    from firebase_functions import https_fn
+    from werkzeug.test import EnvironBuilder
+
+    builder = EnvironBuilder(method=method, path=path, query_string=query, json=body,
+                             headers={'Authorization': 'Bearer cold-start'})
+    return https_fn.Request(builder.get_environ())
+
+
+def invoke(name: str, functions_main, uid: str, callable_request):
+    """呼叫一次指定的函數（callable 與 HTTP 函數呼叫未包裝的原函數，排程函數呼叫其實作）"""
+    import inspect
+
+    def call(data: dict):
+        return inspect.unwrap(getattr(functions_main, name))(callable_request(data, uid))
+
+    if name == 'procrastination_coach_completion':
+        return call(coach_data())
+    if name == 'summarize_chat':
+        return call({'messages': [{'role': 'assistant', 'content': '今天想從哪裡開始？'}, {'role': 'user', 'content': '冷啟動測試'}]})
+    if name == 'vocab_review_queue':
+        return call({})
+    if name == 'test_users_access':
+        return call({})
+    if name == 'get_experiment_stats':
+        return call({'mode': 'aggregate'})
+    if name == 'manual_daily_metrics':
+        return call({'uid': uid})
+    if name == 'procrastination_coach_stream':
+        response = inspect.unwrap(functions_main.procrastination_coach_stream)(http_request('POST', body=coach_data()))
+        return response.get_data()
+    if name == 'curriculum_content':
+        response = inspect.unwrap(functions_main.curriculum_content)(
+            http_request('GET', query={'kind': 'vocab', 'week': '1', 'day': '1'}))
+        return response.status_code
+    if name == 'daily_metrics_aggregation':
+        # 每次都完整執行，不因前一次的檢查點而跳過
+        return functions_main.run_daily_metrics_aggregation(force=True)
+    if name == 'coach_context_refresh':
+        return functions_main.run_coach_context_refresh()
+    if name == 'llm_telemetry_rollup':
+        return functions_main.run_llm_telemetry_rollup()
+    raise ValueError(f"未知的函數: {name}")
+
+
+def run_child(name: str, uid: str, project: str) -> None:
+    """子進程：量測導入 main 與第一次呼叫，結果以 RESULT_PREFIX 開頭的一行 JSON 輸出"""
+    import resource
+
+    modules_before = set(sys.modules)
+    sys.path.insert(0, FUNCTIONS_DIR)
+    started = time.perf_counter()
+    import main as functions_main
+    import_ms = (time.perf_counter() - started) * 1000
+    modules_after_import = set(sys.modules)
+
+    result = {
+        'function': name,
+        'import_ms': round(import_ms, 1),
+        'modules': len(modules_after_import - modules_before),
+        'first_call_ms': None,
+        'call_modules': 0,
+        'call_packages': [],
+    }
+    if name != 'import':
+        import functools
+
+        import firestore_stats
+        sys.path.insert(0, BENCHMARKS_DIR)
+        from cohort import emulator_client
+        from run_benchmarks import callable_request
+
+        # firebase_admin 的預設客戶端需要 Application Default Credentials，改用連到模擬器的客戶端；
+        # 與正式環境相同，客戶端在第一次呼叫時才建立
+        functions_main.get_firestore_client = functools.cache(lambda: firestore_stats.instrument(emulator_client(project)))
+        functions_main.auth.verify_id_token = lambda token: {'uid': uid}
+        modules_before_call = set(sys.modules)
+
+        started = time.perf_counter()
+        invoke(name, functions_main, uid, callable_request)
+        result['first_call_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        new_modules = set(sys.modules) - modules_before_call
+        result['call_modules'] = len(new_modules)
+        result['call_packages'] = sorted({module.split('.')[0] for module in new_modules})
+
+    result['rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    print(RESULT_PREFIX + json.dumps(result, ensure_ascii=False), flush=True)
+    # 不等待遙測緩衝區等背景工作，直接結束
+    os._exit(0)
+
+
+def measure(name: str, uid: str, env: dict, project: str, verbose: bool) -> dict:
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', name, '--uid', uid, '--project', project],
+        env=env, capture_output=True, text=True, cwd=FUNCTIONS_DIR,
+    )
+    if verbose:
+        sys.stdout.write(completed.stdout)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"{name} 的子進程沒有輸出結果（exit {completed.returncode}）:\n{completed.stderr[-2000:]}")
+
+
+def summarize_runs(runs: list[dict]) -> dict:
+    """多次冷啟動取中位數；模組數與額外載入的套件取第一次"""
+    first = runs[0]
+    summary = {**first, 'repeats': len(runs)}
+    for key in ('import_ms', 'first_call_ms', 'rss_mb'):
+        values = [r[key] for r in runs if r[key] is not None]
+        summary[key] = round(statistics.median(values), 1) if values else None
+    summary['total_ms'] = round(summary['import_ms'] + (summary['first_call_ms'] or 0), 1)
+    return summary
+
+
+def print_report(results: list[dict]) -> None:
+    print(f"{'function':<34}{'import ms':>11}{'call ms':>10}{'total ms':>10}{'modules':>9}{'+call':>7}{'RSS MB':>8}  call packages")
+    for r in results:
+        call_ms = f"{r['first_call_ms']:.1f}" if r['first_call_ms'] is not None else '-'
+        print(
+            f"{r['function']:<34}{r['import_ms']:>11.1f}{call_ms:>10}{r['total_ms']:>10.1f}"
+            f"{r['modules']:>9}{r['call_modules']:>7}{r['rss_mb']:>8.1f}  {', '.join(r['call_packages'])}"
+        )
+
+
+def compare_with_baseline(results: list[dict], baseline_path: str, max_regression: float) -> list[str]:
+    """返回退步描述：冷啟動總時間超過基準 (1 + max_regression) 倍，或導入時載入的模組數增加"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {r['function']: r for r in json.load(f)['results']}
+    regressions = []
+    for r in results:
+        base = baseline.get(r['function'])
+        if base is None:
+            continue
+        if r['total_ms'] > base['total_ms'] * (1 + max_regression):
+            regressions.append(f"{r['function']}: 冷啟動 {r['total_ms']:.1f} ms > 基準 {base['total_ms']:.1f} ms × {1 + max_regression:.2f}")
+        if r['modules'] > base['modules']:
+            regressions.append(f"{r['function']}: 導入模組數 {r['modules']} > 基準 {base['modules']}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='雲函數冷啟動基準')
+    parser.add_argument('--project', default=os.environ.get('GOOGLE_CLOUD_PROJECT', 'demo-momentum'))
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=list(FUNCTIONS))
+    parser.add_argument('--import-only', action='store_true', help='只量測導入 main（不需模擬器）')
+    parser.add_argument('--repeat', type=int, default=5, help='每個函數的冷啟動次數')
+    parser.add_argument('--users', type=int, default=5, help='建立的群組用戶數')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Fake OpenAI 的回覆延遲（預設 0，只量測本地開銷）')
+    parser.add_argument('--skip-seed', action='store_true', help='沿用模擬器中已有的群組資料')
+    parser.add_argument('--json', help='把結果寫入 JSON 檔案')
+    parser.add_argument('--baseline', help='與之前 --json 輸出的結果比較')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='允許的冷啟動時間退步比例')
+    parser.add_argument('--verbose', action='store_true', help='顯示子進程的輸出')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--uid', default='bench00000', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.uid, args.project)
+        return
+
+    env = {**os.environ, 'GOOGLE_CLOUD_PROJECT': args.project}
+    names = ['import'] if args.import_only else ['import', *args.functions]
+    openai_server = None
+    if not args.import_only:
+        from cohort import emulator_client, reset_emulator, seed_cohort
+        from fake_openai import FakeOpenAIServer
+
+        openai_server = FakeOpenAIServer(latency_ms=args.latency_ms).start()
+        env['OPENAI_BASE_URL'] = openai_server.base_url
+        env.setdefault('OPENAI_APIKEY', 'benchmark')
+        if not args.skip_seed:
+            db = emulator_client(args.project)
+            reset_emulator(args.project)
+            written = seed_cohort(db, users=args.users)
+            print(f"🌱 已建立群組: {written} 個文檔")
+
+    results = []
+    for name in names:
+        runs = [measure(name, 'bench00000', env, args.project, args.verbose) for _ in range(max(1, args.repeat))]
+        results.append(summarize_runs(runs))
+    if openai_server is not None:
+        openai_server.stop()
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果已寫入 {args.json}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        if regressions:
+            sys.exit(1)
+        print("✅ 與基準相比沒有退步")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+本地的 OpenAI Chat Completions stub，供基準測試使用（不呼叫真實 API、不產生費用）
+- POST /v1/chat/completions：依請求的 json_schema 產生符合 schema 的回覆；stream=true 時以 SSE 分段送出
+- Batch API（chat_summary_batch 用）：POST /v1/files 上傳 JSONL、POST /v1/batches 建立批次、
+  GET /v1/batches/{id} 查詢狀態、GET /v1/files/{id}/content 下載輸出；
+  批次在被查詢 batch_pending_polls 次之後才完成，batch_fail_ids 中的 custom_id 回覆 500
+- 延遲可設定：每個請求先等待 latency_ms ± jitter_ms 再回覆
+- stats 記錄各 schema 的請求數，供基準測試報告 OpenAI 呼叫次數
+
+單獨啟動：
+
+    python benchmarks/fake_openai.py --port 8089 --latency-ms 800
+
+之後把雲函數的 OPENAI_BASE_URL 設為 http://127.0.0.1:8089/v1 即可
+"""
+
+import argparse
+import json
+import re
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 串流回覆每段的字元數
+STREAM_CHUNK_CHARS = 16
+
+
+def sample_from_schema(schema: dict):
+    """產生符合 JSON schema 的最小樣本：enum 取第一個值，字串帶欄位說明，陣列一個元素"""
+    if 'enum' in schema:
+        return schema['enum'][0]
+    schema_type = schema.get('type')
+    if schema_type == 'object':
+        return {name: sample_from_schema(prop) for name, prop in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return [sample_from_schema(schema.get('items', {'type': 'string'}))]
+    if schema_type == 'boolean':
+        return False
+    if schema_type in ('integer', 'number'):
+        return 0
+    return f"基準測試回覆：{schema.get('description', 'text')}"
+
+
+def completion_content(body: dict) -> tuple[str, str]:
+    """返回 (schema 名稱, 回覆內容)；沒有 json_schema 時回覆純文字"""
+    response_format = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        json_schema = response_format['json_schema']
+        return json_schema.get('name', 'json_schema'), json.dumps(sample_from_schema(json_schema['schema']), ensure_ascii=False)
+    return 'text', "基準測試摘要：使用者說明了拖延原因並決定開始。"
+
+
+def chat_completion(body: dict, content: str, completion_id: str) -> dict:
+    """非串流的 chat.completion 回覆（即時呼叫與批次輸出共用）"""
+    return {
+        'id': completion_id,
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'gpt-4.1-mini'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': usage_for(body, content),
+    }
+
+
+def multipart_fields(content_type: str, data: bytes) -> dict[str, tuple[str | None, bytes]]:
+    """解析 multipart/form-data，返回 {欄位名稱: (檔名, 內容)}"""
+    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + data)
+    return {
+        part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+
+def usage_for(body: dict, content: str) -> dict:
+    """粗略的 token 用量（約 4 字元 1 token），讓呼叫端的 token 統計有值"""
+    prompt_tokens = len(json.dumps(body.get('messages', []), ensure_ascii=False)) // 4
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+        'prompt_tokens_details': {'cached_tokens': 0},
+    }
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency_ms: float = 0, jitter_ms: float = 0):
+        super().__init__(('127.0.0.1', port), FakeOpenAIHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+        # Batch API：上傳的檔案與建立的批次（只存在記憶體中）
+        self.files: dict[str, dict] = {}
+        self.batches: dict[str, dict] = {}
+        self.batch_pending_polls = 0
+        self.batch_fail_ids: set[str] = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def record(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def reset_stats(self) -> None:
+        with self._stats_lock:
+            self.stats.clear()
+
+    def delay(self) -> None:
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = {
+            'id': file_id,
+            'object': 'file',
+            'bytes': len(content),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+            'status': 'processed',
+            'content': content,
+        }
+        return self.files[file_id]
+
+    def create_batch(self, body: dict) -> dict:
+        """建立批次並立即算好每一行的回覆；狀態在查詢 batch_pending_polls 次之後才改為 completed"""
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        output_lines = []
+        failed = 0
+        for line in self.files[body['input_file_id']]['content'].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            name, content = completion_content(request['body'])
+            self.record(f"batch:{name}")
+            if request['custom_id'] in self.batch_fail_ids:
+                failed += 1
+                response = {'status_code': 500, 'request_id': uuid.uuid4().hex, 'body': {'error': {'message': 'stub failure'}}}
+            else:
+                response = {'status_code': 200, 'request_id': uuid.uuid4().hex,
+                            'body': chat_completion(request['body'], content, f"chatcmpl-{uuid.uuid4().hex[:24]}")}
+            output_lines.append(json.dumps({'id': f"batch_req_{uuid.uuid4().hex[:24]}", 'custom_id': request['custom_id'],
+                                            'response': response, 'error': None}, ensure_ascii=False))
+        output_file = self.add_file(f"{batch_id}_output.jsonl", 'batch_output', '\n'.join(output_lines).encode('utf-8'))
+        self.batches[batch_id] = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': body['endpoint'],
+            'completion_window': body['completion_window'],
+            'input_file_id': body['input_file_id'],
+            'status': 'validating',
+            'created_at': int(time.time()),
+            'output_file_id': None,
+            'error_file_id': None,
+            'request_counts': {'total': len(output_lines), 'completed': len(output_lines) - failed, 'failed': failed},
+            '_output_file_id': output_file['id'],
+            '_pending_polls': self.batch_pending_polls,
+        }
+        return self.batches[batch_id]
+
+    def poll_batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        if batch['_pending_polls'] > 0:
+            batch['_pending_polls'] -= 1
+            batch['status'] = 'in_progress'
+        else:
+            batch['status'] = 'completed'
+            batch['output_file_id'] = batch['_output_file_id']
+        return batch
+
+    def start(self) -> 'FakeOpenAIServer':
+        """在背景執行緒中啟動"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_not_found(self) -> None:
+        self.send_json(404, {'error': {'message': f'unsupported path {self.path}'}})
+
+    @staticmethod
+    def public(record: dict) -> dict:
+        """去掉 stub 內部用的欄位（底線開頭）與檔案內容"""
+        return {key: value for key, value in record.items() if not key.startswith('_') and key != 'content'}
+
+    def do_GET(self):
+        path = re.sub(r'^/v1', '', self.path.split('?')[0].rstrip('/'))
+        if match := re.fullmatch(r'/batches/([\w-]+)', path):
+            if match.group(1) not in self.server.batches:
+                self.send_not_found()
+                return
+            self.server.record('batches.retrieve')
+            self.send_json(200, self.public(self.server.poll_batch(match.group(1))))
+        elif match := re.fullmatch(r'/files/([\w-]+)/content', path):
+            file = self.server.files.get(match.group(1))
+            if file is None:
+                self.send_not_found()
+                return
+            self.server.record('files.content')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(file['content'])))
+            self.end_headers()
+            self.wfile.write(file['content'])
+        else:
+            self.send_not_found()
+
+    def do_POST(self):
+        path = re.sub(r'^/v1', '', self.path.split('?')[0].rstrip('/'))
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path == '/files':
+            fields = multipart_fields(self.headers.get('Content-Type', ''), data)
+            self.server.record('files.create')
+            filename, content = fields['file']
+            self.send_json(200, self.public(self.server.add_file(filename or 'upload.jsonl', fields['purpose'][1].decode('utf-8'), content)))
+            return
+        if path == '/batches':
+            body = json.loads(data or b'{}')
+            if body.get('input_file_id') not in self.server.files:
+                self.send_json(400, {'error': {'message': f"unknown input_file_id {body.get('input_file_id')}"}})
+                return
+            self.server.record('batches.create')
+            self.send_json(200, self.public(self.server.create_batch(body)))
+            return
+        if path != '/chat/completions':
+            self.send_not_found()
+            return
+        body = json.loads(data or b'{}')
+        name, content = completion_content(body)
+        self.server.record(name)
+        self.server.delay()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = body.get('model', 'gpt-4.1-mini')
+        usage = usage_for(body, content)
+        if not body.get('stream'):
+            self.send_json(200, chat_completion(body, content, completion_id))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        def send_chunk(choices: list, chunk_usage: dict | None = None) -> None:
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': choices,
+                'usage': chunk_usage,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        for i in range(0, len(content), STREAM_CHUNK_CHARS):
+            send_chunk([{'index': 0, 'delta': {'content': content[i:i + STREAM_CHUNK_CHARS]}, 'finish_reason': None}])
+        send_chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if (body.get('stream_options') or {}).get('include_usage'):
+            send_chunk([], usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='本地 OpenAI Chat Completions 與 Batch API stub')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=0, help='每個請求的固定延遲（毫秒）')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='延遲的隨機浮動範圍（毫秒）')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.port, args.latency_ms, args.jitter_ms)
+    print(f"🤖 Fake OpenAI 已啟動: {server.base_url}（延遲 {args.latency_ms}±{args.jitter_ms} ms）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
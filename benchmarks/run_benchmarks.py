@@ -0,0 +1,243 @@
+"""
+雲函數熱路徑的離線基準測試：Firestore 模擬器 + 本地 Fake OpenAI，不接觸正式環境
+
+測量的路徑：
+- calculate_daily_metrics：逐一計算每個用戶前一天的指標
+- daily_metrics_aggregation：完整的夜間聚合（run_daily_metrics_aggregation）
+- procrastination_coach_completion：教練對話（callable）
+- summarize_chat：聊天摘要（callable，每次使用不同的對話，避免命中摘要快取）
+
+每個路徑報告牆鐘時間、Firestore RPC 次數與讀寫文檔數（按 firestore_stats 的呼叫位置）、OpenAI 請求數、Python 堆積峰值
+用法（先在另一個終端啟動模擬器：firebase emulators:start --only firestore）：
+
+    export FIRESTORE_EMULATOR_HOST=127.0.0.1:8080
+    python benchmarks/run_benchmarks.py --users 50 --latency-ms 300 --json bench.json
+
+與上次結果比較，任一路徑的時間或 RPC 次數退步超過門檻時以非零狀態碼結束（可在部署前執行）：
+
+    python benchmarks/run_benchmarks.py --baseline bench.json --max-regression 0.2
+"""
+
+import argparse
+import contextlib
+import inspect
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cohort import TAIWAN_TZ, add_cohort_arguments, cohort_kwargs, emulator_client, reset_emulator, seed_cohort
+from fake_openai import FakeOpenAIServer
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'functions')
+
+SCENARIOS = ('calculate_daily_metrics', 'daily_metrics_aggregation', 'procrastination_coach_completion', 'summarize_chat')
+
+
+def callable_request(data: dict, uid: str):
+    from firebase_functions import https_fn
+    return https_fn.CallableRequest(raw_request=None, data=data, auth=https_fn.AuthData(uid=uid, token={}))
+
+
+def coach_requests(uids: list[str], count: int, messages_per_chat: int) -> list:
+    """教練對話請求：輪流使用各用戶，對話長度在 0 到 messages_per_chat 之間變化"""
+    requests = []
+    for i in range(count):
+        turns = i % (messages_per_chat + 1)
+        dialogues = [
+            {'role': 'assistant' if t % 2 == 0 else 'user', 'content': f"第{t + 1}句：今天不太想開始，第{i}次測試"}
+            for t in range(turns)
+        ]
+        requests.append(callable_request({
+            'taskTitle': f"reading-w1-d{i % 5 + 1}",
+            'dialogues': dialogues,
+            'startTime': '2026-10-17 09:00',
+            'currentTurn': turns // 2,
+            'dayNumber': i % 5 + 1,
+            'taskDurationMin': 15,
+        }, uids[i % len(uids)]))
+    return requests
+
+
+def summarize_requests(uids: list[str], count: int, messages_per_chat: int) -> list:
+    """摘要請求：每次的對話內容都不同，量測未命中快取時的路徑"""
+    return [
+        callable_request({'messages': [
+            {'role': 'assistant' if t % 2 == 0 else 'user', 'content': f"第{t + 1}句：摘要測試 {i}"}
+            for t in range(max(2, messages_per_chat))
+        ]}, uids[i % len(uids)])
+        for i in range(count)
+    ]
+
+
+def run_calls(fn, requests: list, concurrency: int) -> None:
+    if concurrency <= 1:
+        for request in requests:
+            fn(request)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(fn, requests))
+
+
+def measure(name: str, run, calls: int, firestore_stats, openai_server: FakeOpenAIServer, verbose: bool) -> dict:
+    """執行一次 run()，返回該次的各項量測值（預設隱藏被測函數的 print 輸出）"""
+    firestore_before = firestore_stats.STATS.snapshot()
+    openai_server.reset_stats()
+    tracemalloc.start()
+    started = time.perf_counter()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        run()
+    wall_sec = time.perf_counter() - started
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    usage = firestore_stats.usage_delta(firestore_before, firestore_stats.STATS.snapshot())
+    return {
+        'scenario': name,
+        'calls': calls,
+        'wall_sec': round(wall_sec, 4),
+        'per_call_ms': round(wall_sec * 1000 / max(calls, 1), 2),
+        'firestore_rpcs': usage['total']['rpcs'],
+        'firestore_docs_read': usage['total']['reads'],
+        'firestore_docs_written': usage['total']['writes'],
+        'firestore_sites': usage['sites'],
+        'openai_requests': sum(openai_server.stats.values()),
+        'peak_heap_mb': round(peak_bytes / 2**20, 2),
+    }
+
+
+def summarize_runs(runs: list[dict]) -> dict:
+    """多次重複取中位數（時間、記憶體）；RPC 與 OpenAI 次數取第一次（冷實例）"""
+    first = runs[0]
+    return {
+        **first,
+        'repeats': len(runs),
+        'wall_sec': round(statistics.median(r['wall_sec'] for r in runs), 4),
+        'wall_sec_max': max(r['wall_sec'] for r in runs),
+        'per_call_ms': round(statistics.median(r['per_call_ms'] for r in runs), 2),
+        'peak_heap_mb': round(statistics.median(r['peak_heap_mb'] for r in runs), 2),
+    }
+
+
+def print_report(results: list[dict]) -> None:
+    print(f"{'scenario':<34}{'calls':>6}{'wall s':>10}{'ms/call':>10}{'fs rpc':>8}{'docs':>8}{'openai':>8}{'heap MB':>9}")
+    for r in results:
+        print(
+            f"{r['scenario']:<34}{r['calls']:>6}{r['wall_sec']:>10.3f}{r['per_call_ms']:>10.1f}"
+            f"{r['firestore_rpcs']:>8}{r['firestore_docs_read']:>8}{r['openai_requests']:>8}{r['peak_heap_mb']:>9.1f}"
+        )
+        for site, counters in sorted(r['firestore_sites'].items()):
+            print(f"{'':<6}{site:<22} rpc {counters['rpcs']:>6}  讀取 {counters['reads']:>6}  寫入 {counters['writes']:>6}  {counters['ms']:>8} ms")
+
+
+def compare_with_baseline(results: list[dict], baseline_path: str, max_regression: float) -> list[str]:
+    """返回退步描述：時間超過基準 (1 + max_regression) 倍，或 RPC / OpenAI 請求數增加"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {r['scenario']: r for r in json.load(f)['results']}
+    regressions = []
+    for r in results:
+        base = baseline.get(r['scenario'])
+        if base is None:
+            continue
+        if r['wall_sec'] > base['wall_sec'] * (1 + max_regression):
+            regressions.append(f"{r['scenario']}: 時間 {r['wall_sec']:.3f}s > 基準 {base['wall_sec']:.3f}s × {1 + max_regression:.2f}")
+        for key in ('firestore_rpcs', 'openai_requests'):
+            if r[key] > base[key]:
+                regressions.append(f"{r['scenario']}: {key} {r[key]} > 基準 {base[key]}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='雲函數熱路徑的離線基準測試')
+    add_cohort_arguments(parser)
+    parser.add_argument('--project', default=os.environ.get('GOOGLE_CLOUD_PROJECT', 'demo-momentum'))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3, help='每個路徑的重複次數（第一次為冷實例）')
+    parser.add_argument('--coach-calls', type=int, default=20)
+    parser.add_argument('--summarize-calls', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1, help='callable 路徑的並行請求數')
+    parser.add_argument('--latency-ms', type=float, default=300, help='Fake OpenAI 的回覆延遲')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--skip-seed', action='store_true', help='沿用模擬器中已有的群組資料')
+    parser.add_argument('--json', help='把結果寫入 JSON 檔案')
+    parser.add_argument('--baseline', help='與之前 --json 輸出的結果比較')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='允許的時間退步比例')
+    parser.add_argument('--verbose', action='store_true', help='顯示被測函數的輸出')
+    args = parser.parse_args()
+
+    # 被測的雲函數在導入時讀取這些環境變數
+    os.environ['GOOGLE_CLOUD_PROJECT'] = args.project
+    openai_server = FakeOpenAIServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms).start()
+    os.environ['OPENAI_BASE_URL'] = openai_server.base_url
+    os.environ.setdefault('OPENAI_APIKEY', 'benchmark')
+
+    db = emulator_client(args.project)
+    if not args.skip_seed:
+        reset_emulator(args.project)
+        started = time.perf_counter()
+        written = seed_cohort(db, **cohort_kwargs(args))
+        print(f"🌱 已建立群組: {written} 個文檔，{time.perf_counter() - started:.1f}s")
+
+    sys.path.insert(0, FUNCTIONS_DIR)
+    import firestore_stats
+    import main as functions_main
+
+    # firebase_admin 的預設客戶端需要 Application Default Credentials，改用連到模擬器的客戶端（同樣掛上 RPC 統計）
+    firestore_stats.instrument(db)
+    functions_main.get_firestore_client = lambda: db
+
+    uids = [f"bench{u:05d}" for u in range(args.users)]
+    yesterday = datetime.now(TAIWAN_TZ) - timedelta(days=1)
+    date_str = yesterday.strftime('%Y%m%d')
+
+    def run_aggregation():
+        # 刪除當天的檢查點，每次重複都完整執行
+        db.collection('daily_metrics_execution_log').document(date_str).delete()
+        functions_main.run_daily_metrics_aggregation()
+
+    coach = inspect.unwrap(functions_main.procrastination_coach_completion)
+    summarize = inspect.unwrap(functions_main.summarize_chat)
+    scenarios = {
+        'calculate_daily_metrics': (
+            lambda: [functions_main.calculate_daily_metrics(uid, yesterday, db) for uid in uids], len(uids)),
+        'daily_metrics_aggregation': (run_aggregation, 1),
+        'procrastination_coach_completion': (
+            lambda: run_calls(coach, coach_requests(uids, args.coach_calls, args.messages_per_chat), args.concurrency),
+            args.coach_calls),
+        'summarize_chat': (
+            lambda: run_calls(summarize, summarize_requests(uids, args.summarize_calls, args.messages_per_chat), args.concurrency),
+            args.summarize_calls),
+    }
+
+    results = []
+    for name in args.scenarios:
+        run, calls = scenarios[name]
+        runs = [measure(name, run, calls, firestore_stats, openai_server, args.verbose) for _ in range(max(1, args.repeat))]
+        results.append(summarize_runs(runs))
+    openai_server.stop()
+
+    print_report(results)
+    print(f"📈 進程 RSS 峰值: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果已寫入 {args.json}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        if regressions:
+            sys.exit(1)
+        print("✅ 與基準相比沒有退步")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+從 App 的課程素材（assets/dyn、assets/vocab）產生雲函數使用的課程檔案
+- curriculum_index.json：(week, day) 的主題、數量與單字複習規則摘要，供 system_prompt、vocab_review 查表
+- curriculum.bin：攤平的文章、閱讀題、單字與單字測驗記錄（格式見 curriculum_format），供 curriculum 模組查詢
+雲函數部署時只打包 functions/ 目錄，素材更新後需重新執行並提交產生的檔案：
+
+    python functions/build_curriculum.py
+
+產生後會自動與素材原始 JSON 逐筆比對；只比對不重新產生：
+
+    python functions/build_curriculum.py --verify
+"""
+
+import glob
+import json
+import os
+import re
+import sys
+
+from curriculum_format import CurriculumFile, write_curriculum_file
+
+FUNCTIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSETS_DIR = os.path.join(os.path.dirname(FUNCTIONS_DIR), 'assets')
+INDEX_PATH = os.path.join(FUNCTIONS_DIR, 'curriculum_index.json')
+CONTENT_PATH = os.path.join(FUNCTIONS_DIR, 'curriculum.bin')
+
+READING_FILE_PATTERN = re.compile(r'^w(\d+)_d(\d+)\.json$')
+VOCAB_FILE_PATTERN = re.compile(r'^week(\d+)_day(\d+)\.json$')
+# 閱讀題庫：每週總結題（summary）與週測驗（test）
+QUESTION_FILE_PATTERN = re.compile(r'^week(\d+)_(summary_with_questions|test)\.json$')
+QUESTION_SET_NAMES = {'summary_with_questions': 'summary', 'test': 'test'}
+VOCAB_TEST_FILE_PATTERN = re.compile(r'^week(\d+)_test\.json$')
+DAY_KEY_PATTERN = re.compile(r'^day(\d+)$')
+
+
+def load_json(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def build_index(assets_dir: str = ASSETS_DIR) -> dict:
+    """掃描每日閱讀與單字檔案，按 (week, day) 彙整成一筆記錄"""
+    days: dict[tuple[int, int], dict] = {}
+
+    for path in sorted(glob.glob(os.path.join(assets_dir, 'dyn', 'w*_d*.json'))):
+        match = READING_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        week, day = int(match.group(1)), int(match.group(2))
+        articles = load_json(path).get('articles', [])
+        categories = list(dict.fromkeys(a['category'] for a in articles if a.get('category')))
+        entry = days.setdefault((week, day), {'week': week, 'day': day})
+        entry['reading_category'] = categories[0] if categories else ''
+        entry['article_count'] = len(articles)
+
+    for path in sorted(glob.glob(os.path.join(assets_dir, 'vocab', 'week*_day*.json'))):
+        match = VOCAB_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        week, day = int(match.group(1)), int(match.group(2))
+        vocab = load_json(path)
+        entry = days.setdefault((week, day), {'week': week, 'day': day})
+        entry['vocab_new_count'] = len(vocab.get('new_items', []))
+        entry['vocab_review_count'] = len(vocab.get('review_items', []))
+        entry['vocab_review_policy'] = vocab.get('meta', {}).get('policy', '')
+
+    return {'days': [days[key] for key in sorted(days)]}
+
+
+def build_content(assets_dir: str = ASSETS_DIR) -> dict:
+    """
+    把素材攤平成四類記錄（week、day 一律取自檔名，檔案內容中的 week 欄位不一定正確）
+    - articles：每篇文章一筆
+    - questions：每道閱讀題一筆，question_set 為 summary 或 test，index 為該文章內的題號
+    - vocab：每個單字一筆，position 為 items_shuffled 中的出題順序
+    - vocab_questions：單字週測驗每題一筆
+    """
+    articles, questions, vocab, vocab_questions = [], [], [], []
+
+    for path in sorted(glob.glob(os.path.join(assets_dir, 'dyn', 'w*_d*.json'))):
+        match = READING_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        week, day = int(match.group(1)), int(match.group(2))
+        for article in load_json(path).get('articles', []):
+            articles.append({'week': week, 'day': day, **article})
+
+    for path in sorted(glob.glob(os.path.join(assets_dir, 'dyn', 'week*_*.json'))):
+        match = QUESTION_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        week, question_set = int(match.group(1)), QUESTION_SET_NAMES[match.group(2)]
+        for day_key, day_articles in load_json(path).get('days', {}).items():
+            day_match = DAY_KEY_PATTERN.match(day_key)
+            if not day_match:
+                continue
+            day = int(day_match.group(1))
+            for article in day_articles:
+                for i, question in enumerate(article.get('questions', [])):
+                    questions.append({
+                        'week': week,
+                        'day': day,
+                        'rid': article.get('rid'),
+                        'question_set': question_set,
+                        'index': i,
+                        **question,
+                    })
+
+    for path in sorted(glob.glob(os.path.join(assets_dir, 'vocab', 'week*_day*.json'))):
+        match = VOCAB_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        week, day = int(match.group(1)), int(match.group(2))
+        data = load_json(path)
+        positions = {item['word']: i for i, item in enumerate(data.get('items_shuffled', []))}
+        for item in data.get('new_items', []) + data.get('review_items', []):
+            vocab.append({'week': week, 'day': day, 'position': positions.get(item['word']), **item})
+
+    for path in sorted(glob.glob(os.path.join(assets_dir, 'vocab', 'week*_test.json'))):
+        match = VOCAB_TEST_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            continue
+        week = int(match.group(1))
+        for i, item in enumerate(load_json(path).get('items', [])):
+            vocab_questions.append({'week': week, 'index': i, **item})
+
+    return {'articles': articles, 'questions': questions, 'vocab': vocab, 'vocab_questions': vocab_questions}
+
+
+def write_json(path: str, data: dict, indent: int | None = None) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent, separators=None if indent else (',', ':'))
+        f.write('\n')
+
+
+def verify_curriculum_file(path: str = CONTENT_PATH, assets_dir: str = ASSETS_DIR) -> list[str]:
+    """把 curriculum.bin 逐筆解碼，與素材重新攤平的記錄比對，返回差異描述（空列表表示一致）"""
+    expected = build_content(assets_dir)
+    store = CurriculumFile(path)
+    problems = []
+    for kind, records in expected.items():
+        decoded = list(store.iter_records(kind))
+        if len(decoded) != len(records):
+            problems.append(f"{kind}: 記錄數 {len(decoded)} != {len(records)}")
+            continue
+        for i, (actual, record) in enumerate(zip(decoded, records)):
+            if actual != record:
+                problems.append(f"{kind}[{i}] 內容不一致")
+    for entry_no, (kind, keys, _, _) in enumerate(store.entries):
+        record = store.read(entry_no)
+        if any(record.get(field) != value for field, value in keys.items()):
+            problems.append(f"索引 {entry_no}（{kind}）的篩選欄位與記錄不一致")
+    return problems
+
+
+def main() -> None:
+    if '--verify' not in sys.argv[1:]:
+        index = build_index()
+        write_json(INDEX_PATH, index, indent=2)
+        print(f"✅ 已產生 {os.path.relpath(INDEX_PATH)}：{len(index['days'])} 天")
+
+        content = build_content()
+        written = write_curriculum_file(CONTENT_PATH, content)
+        source_bytes = len(json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        counts = ", ".join(f"{kind} {len(records)}" for kind, records in content.items())
+        print(f"✅ 已產生 {os.path.relpath(CONTENT_PATH)}：{counts}；{written['bytes']} bytes（JSON {source_bytes} bytes）")
+
+    problems = verify_curriculum_file()
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        sys.exit(1)
+    print(f"✅ {os.path.relpath(CONTENT_PATH)} 與素材 JSON 逐筆一致")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+課程內容的記憶體索引：實例啟動時開啟 build_curriculum.py 產生的 curriculum.bin，只載入索引
+按 week/day/rid/word 建索引，提供分頁、欄位投影的查詢，回應附帶可用於 ETag 的內容版本
+記錄本身在查詢命中時才從 mmap 解壓
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from curriculum_format import CurriculumFile, INDEX_KEY_FIELDS
+
+CONTENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curriculum.bin')
+
+# 各類記錄可用的篩選欄位（等值比對），即 curriculum.bin 索引中保存的欄位
+FILTER_FIELDS = INDEX_KEY_FIELDS
+# 建立索引的欄位，依選擇性由高到低；查詢時從第一個有提供的欄位取候選記錄
+INDEXED_FIELDS = ('rid', 'word', 'answer_word', 'day', 'week')
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# 已解壓記錄的快取數量
+DECODED_RECORD_CACHE_SIZE = 512
+
+
+class CurriculumIndex:
+    """
+    唯讀的課程內容索引，載入後不再變動，可在多執行緒間共用
+    篩選只使用 curriculum.bin 索引中的欄位，分頁後才解壓需要返回的記錄
+    version 為內容版本，內容更新後自動改變
+    """
+
+    def __init__(self, store: CurriculumFile):
+        self.version = store.version
+        self._store = store
+        # kind -> [(篩選欄位, 記錄編號)]，保持原始順序
+        self.entries: dict[str, list[tuple[dict, int]]] = {kind: [] for kind in FILTER_FIELDS}
+        for entry_no, (kind, keys, _, _) in enumerate(store.entries):
+            if kind in self.entries:
+                self.entries[kind].append((keys, entry_no))
+        # (kind, field, value) -> 在 entries[kind] 中的位置
+        self._positions: dict[tuple, list[int]] = {}
+        for kind, entries in self.entries.items():
+            for position, (keys, _) in enumerate(entries):
+                for field in INDEXED_FIELDS:
+                    if field in FILTER_FIELDS[kind] and keys.get(field) is not None:
+                        self._positions.setdefault((kind, field, keys[field]), []).append(position)
+        self._decoded: OrderedDict[int, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, entry_no: int) -> dict:
+        """解壓單筆記錄（帶 LRU 快取）"""
+        with self._lock:
+            record = self._decoded.get(entry_no)
+            if record is not None:
+                self._decoded.move_to_end(entry_no)
+                return record
+        record = self._store.read(entry_no)
+        with self._lock:
+            self._decoded[entry_no] = record
+            while len(self._decoded) > DECODED_RECORD_CACHE_SIZE:
+                self._decoded.popitem(last=False)
+        return record
+
+    def query(self, kind: str, filters: dict | None = None, fields: list[str] | None = None,
+              page_size: int = DEFAULT_PAGE_SIZE, page_token: str | None = None) -> dict:
+        """
+        查詢指定類別的記錄
+        - filters：{欄位: 值}，只接受 FILTER_FIELDS 中的欄位，day 需與 week 一起使用才有意義
+        - fields：只返回這些欄位；省略時返回完整記錄
+        - page_size / page_token：分頁，page_token 為上一頁返回的 next_page_token
+        返回 {'items': [...], 'next_page_token': str | None, 'total': int}
+        """
+        if kind not in FILTER_FIELDS:
+            raise ValueError(f"未知的內容類別: {kind}")
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        unknown = set(filters) - set(FILTER_FIELDS[kind])
+        if unknown:
+            raise ValueError(f"{kind} 不支援篩選欄位: {sorted(unknown)}")
+
+        entries = self.entries[kind]
+        positions = None
+        for field in INDEXED_FIELDS:
+            if field in filters:
+                positions = self._positions.get((kind, field, filters[field]), [])
+                break
+        candidates = entries if positions is None else [entries[p] for p in positions]
+        matched = [entry_no for keys, entry_no in candidates if all(keys.get(k) == v for k, v in filters.items())]
+
+        page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+        offset = max(0, int(page_token)) if page_token else 0
+        page = [self.read(entry_no) for entry_no in matched[offset:offset + page_size]]
+        if fields:
+            page = [{f: r[f] for f in fields if f in r} for r in page]
+        next_offset = offset + page_size
+        return {
+            'items': page,
+            'next_page_token': str(next_offset) if next_offset < len(matched) else None,
+            'total': len(matched),
+        }
+
+    def etag(self, *query_parts) -> str:
+        """內容版本與查詢參數組成的 ETag，內容或參數不同時必然不同"""
+        payload = json.dumps([self.version, *query_parts], ensure_ascii=False, sort_keys=True, default=str)
+        return '"' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def load_curriculum(path: str = CONTENT_PATH) -> CurriculumIndex:
+    return CurriculumIndex(CurriculumFile(path))
+
+
+# 實例啟動時載入一次
+CURRICULUM = load_curriculum()
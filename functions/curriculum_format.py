@@ -0,0 +1,87 @@
+"""
+課程內容的緊湊二進位格式（curriculum.bin），可用 mmap 按需讀取單筆記錄
+
+檔案結構（小端序）:
+- 檔頭 HEADER: magic b'CURB'、格式版本、保留欄位、記錄數、索引起點、內容版本（16 位元組）
+- 記錄區: 每筆記錄為 zlib 壓縮的緊湊 JSON，依寫入順序緊密排列
+- 索引區: zlib 壓縮的 JSON 陣列，每筆為 [kind, keys, offset, length]
+  keys 只包含篩選用的小欄位（week、day、rid、word 等），查詢時不必解壓記錄本身
+"""
+
+import hashlib
+import json
+import mmap
+import struct
+import zlib
+
+MAGIC = b'CURB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHIQ16s')
+COMPRESSION_LEVEL = 9
+
+# 各類記錄複製到索引中的篩選欄位
+INDEX_KEY_FIELDS = {
+    'articles': ('week', 'day', 'rid', 'category'),
+    'questions': ('week', 'day', 'rid', 'question_set'),
+    'vocab': ('week', 'day', 'word', 'label'),
+    'vocab_questions': ('week', 'answer_word'),
+}
+
+
+def encode_record(record: dict) -> bytes:
+    return zlib.compress(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def write_curriculum_file(path: str, content: dict, key_fields: dict = INDEX_KEY_FIELDS) -> dict:
+    """
+    把 {kind: [記錄]} 寫成 curriculum.bin
+    key_fields: {kind: (欄位, ...)}，這些欄位會複製到索引中
+    返回 {'records': 記錄數, 'bytes': 檔案大小, 'version': 內容版本}
+    """
+    blobs = []
+    entries = []
+    offset = HEADER.size
+    for kind, fields in key_fields.items():
+        for record in content.get(kind, []):
+            blob = encode_record(record)
+            keys = {field: record[field] for field in fields if record.get(field) is not None}
+            entries.append([kind, keys, offset, len(blob)])
+            blobs.append(blob)
+            offset += len(blob)
+
+    index_blob = zlib.compress(json.dumps(entries, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL)
+    body = b''.join(blobs) + index_blob
+    version = hashlib.sha256(body).digest()[:16]
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(entries), offset, version)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(body)
+    return {'records': len(entries), 'bytes': len(header) + len(body), 'version': version.hex()}
+
+
+class CurriculumFile:
+    """
+    curriculum.bin 的唯讀讀取器：開啟時只解析檔頭與索引，read() 按偏移量解壓單筆記錄
+    以 mmap 映射檔案，多個執行緒可同時讀取
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, _, count, index_offset, version = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"不支援的課程檔案格式: {magic!r} v{format_version}")
+        self.version = version.hex()
+        # [(kind, keys, offset, length)]
+        self.entries = [tuple(entry) for entry in json.loads(zlib.decompress(self._mm[index_offset:]))]
+        if len(self.entries) != count:
+            raise ValueError(f"課程檔案索引損壞: 預期 {count} 筆，實際 {len(self.entries)} 筆")
+
+    def read(self, entry_no: int) -> dict:
+        _, _, offset, length = self.entries[entry_no]
+        return json.loads(zlib.decompress(self._mm[offset:offset + length]))
+
+    def iter_records(self, kind: str):
+        for entry_no, entry in enumerate(self.entries):
+            if entry[0] == kind:
+                yield self.read(entry_no)
@@ -0,0 +1,153 @@
+"""
+Firestore RPC 統計：包裝客戶端底層的 GAPIC 方法，按呼叫位置（site）累計 RPC 次數、讀取文檔數、寫入數與耗時
+- 呼叫位置以 call_site('events') 等上下文標記，未標記的記為 'other'；標記只在當前執行緒內有效，
+  線程池中的工作函數需自行標記
+- 讀取數按回傳的文檔計算（run_query 的 document、batch_get_documents 的 found / missing，聚合查詢算 1 次）
+- 寫入數為 commit / batch_write 請求中的寫入筆數
+- 串流 RPC 的耗時只計算取下一筆回應所花的時間，不含呼叫端處理回應的時間
+
+用法：
+
+    db = instrument(firestore.client())
+    before = STATS.snapshot()
+    with call_site('events'):
+        events = list(query.stream())
+    usage = usage_delta(before, STATS.snapshot())
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+
+# GAPIC 方法 -> 統計類別
+RPC_KINDS = {
+    'batch_get_documents': 'lookups',
+    'run_query': 'queries',
+    'run_aggregation_query': 'queries',
+    'list_documents': 'queries',
+    'list_collection_ids': 'queries',
+    'commit': 'commits',
+    'batch_write': 'commits',
+}
+COUNTER_NAMES = ('rpcs', 'lookups', 'queries', 'commits', 'reads', 'writes', 'ms')
+
+_current_site = contextvars.ContextVar('firestore_call_site', default='other')
+
+
+@contextlib.contextmanager
+def call_site(name: str):
+    """標記區塊內的 Firestore RPC 所屬的呼叫位置"""
+    token = _current_site.set(name)
+    try:
+        yield
+    finally:
+        _current_site.reset(token)
+
+
+class FirestoreStats:
+    """按呼叫位置累計的 RPC 計數，線程安全"""
+
+    def __init__(self):
+        self._sites: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, site: str, **counters) -> None:
+        with self._lock:
+            totals = self._sites.setdefault(site, dict.fromkeys(COUNTER_NAMES, 0))
+            for name, value in counters.items():
+                totals[name] += value
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {site: dict(totals) for site, totals in self._sites.items()}
+
+
+# 模組級統計：同一實例內所有掛上統計的客戶端共用
+STATS = FirestoreStats()
+
+
+def usage_delta(before: dict, after: dict) -> dict:
+    """
+    兩次 snapshot 之間的用量，返回 {'sites': {site: 計數}, 'total': 計數}
+    ms 取整到毫秒，沒有任何 RPC 的位置不列出
+    """
+    sites = {}
+    total = dict.fromkeys(COUNTER_NAMES, 0)
+    for site, counters in after.items():
+        previous = before.get(site, {})
+        delta = {name: counters[name] - previous.get(name, 0) for name in COUNTER_NAMES}
+        if not delta['rpcs']:
+            continue
+        delta['ms'] = round(delta['ms'])
+        sites[site] = delta
+        for name in COUNTER_NAMES:
+            total[name] += delta[name]
+    return {'sites': sites, 'total': total}
+
+
+def merge_usage(*usages: dict) -> dict:
+    """合併多段用量（例如重試前後的檢查點）"""
+    merged = {'sites': {}, 'total': dict.fromkeys(COUNTER_NAMES, 0)}
+    for usage in usages:
+        for site, counters in (usage or {}).get('sites', {}).items():
+            totals = merged['sites'].setdefault(site, dict.fromkeys(COUNTER_NAMES, 0))
+            for name in COUNTER_NAMES:
+                totals[name] += counters.get(name, 0)
+                merged['total'][name] += counters.get(name, 0)
+    return merged
+
+
+def _commit_writes(args: tuple, kwargs: dict) -> int:
+    request = kwargs.get('request', args[0] if args else None)
+    if isinstance(request, dict):
+        return len(request.get('writes') or [])
+    return len(getattr(request, 'writes', None) or [])
+
+
+def _counted_responses(responses, site: str, stats: FirestoreStats):
+    """逐筆轉發串流回應，同時累計回傳的文檔數與取回應的耗時"""
+    iterator = iter(responses)
+    while True:
+        started = time.perf_counter()
+        try:
+            response = next(iterator)
+        except StopIteration:
+            stats.record(site, ms=(time.perf_counter() - started) * 1000)
+            return
+        reads = int(bool(
+            getattr(response, 'document', None) or getattr(response, 'found', None)
+            or getattr(response, 'missing', None) or getattr(response, 'result', None)
+        ))
+        stats.record(site, reads=reads, ms=(time.perf_counter() - started) * 1000)
+        yield response
+
+
+def _wrap(method, name: str, stats: FirestoreStats):
+    kind = RPC_KINDS[name]
+
+    def counted(*args, **kwargs):
+        site = _current_site.get()
+        started = time.perf_counter()
+        result = method(*args, **kwargs)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if kind == 'commits':
+            stats.record(site, rpcs=1, commits=1, writes=_commit_writes(args, kwargs), ms=elapsed_ms)
+            return result
+        stats.record(site, rpcs=1, ms=elapsed_ms, **{kind: 1})
+        if name in ('list_documents', 'list_collection_ids'):
+            return result
+        return _counted_responses(result, site, stats)
+
+    return counted
+
+
+def instrument(db, stats: FirestoreStats = STATS):
+    """為 Firestore 客戶端掛上 RPC 統計（重複呼叫不會重複包裝），返回原客戶端"""
+    api = db._firestore_api
+    if getattr(api, '_rpc_stats', None) is stats:
+        return db
+    for name in RPC_KINDS:
+        setattr(api, name, _wrap(getattr(api, name), name, stats))
+    api._rpc_stats = stats
+    return db
@@ -0,0 +1,166 @@
+"""
+LLM 呼叫遙測：每次 OpenAI 呼叫記錄模型、token、端到端與 OpenAI 延遲、重試次數、對話輪次與分組
+- TelemetryBuffer.record() 只把事件放進記憶體緩衝區，由背景執行緒按批次（或定時）交給 writer 寫出，不阻塞請求
+- rollup() 把一天的事件彙總為各端點、各分組的 p50/p95 延遲與每個會話的 token 用量
+
+實例閒置時 CPU 可能被節流，背景寫出會延後到下一個請求；實例被回收前未寫出的事件會遺失（遙測允許少量遺失）
+"""
+
+import atexit
+import math
+import threading
+from collections import deque
+
+import structured_log
+
+# rollup 中統計分佈的數值欄位
+LATENCY_FIELDS = ('latency_ms', 'openai_ms', 'first_token_ms')
+TOKEN_FIELDS = ('prompt_tokens', 'completion_tokens', 'cached_tokens', 'total_tokens')
+# 所有分組合計的 key
+ALL_GROUPS = 'all'
+
+
+class TelemetryBuffer:
+    """
+    遙測事件的記憶體緩衝區，線程安全
+    - 累積到 batch_size 筆時喚醒背景執行緒寫出，否則每 flush_interval_sec 秒寫出一次
+    - writer(events) 失敗時事件放回緩衝區等待下次寫出；超過 max_buffered 筆時丟棄最舊的事件
+    """
+
+    def __init__(self, writer, batch_size: int, flush_interval_sec: float, max_buffered: int):
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self._writer = writer
+        self._events: deque = deque(maxlen=max_buffered)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.flushed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def record(self, event: dict) -> None:
+        with self._lock:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            full = len(self._events) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='llm-telemetry-flush', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        if full:
+            self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval_sec)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """寫出目前緩衝的所有事件，返回寫出的筆數"""
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._events)
+                self._events.clear()
+            if not events:
+                return 0
+            try:
+                self._writer(events)
+            except Exception as e:
+                structured_log.warning("⚠️ LLM 遙測寫入失敗，稍後重試", sample_key='llm_telemetry_write_error', events=len(events), error=str(e))
+                with self._lock:
+                    # 放回隊首；超出上限時 deque 從最舊的一端丟棄
+                    pending = events + list(self._events)
+                    self.dropped += max(0, len(pending) - self._events.maxlen)
+                    self._events = deque(pending, maxlen=self._events.maxlen)
+                    self.failed_flushes += 1
+                return 0
+            with self._lock:
+                self.flushed += len(events)
+            return len(events)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'buffered': len(self._events),
+                'flushed': self.flushed,
+                'dropped': self.dropped,
+                'failed_flushes': self.failed_flushes,
+            }
+
+
+def percentile(values: list, pct: float):
+    """最近排名法的百分位數，空列表返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def distribution(values: list) -> dict:
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': max(values) if values else None,
+        'mean': round(sum(values) / len(values), 1) if values else None,
+    }
+
+
+def summarize_events(events: list[dict]) -> dict:
+    """一組事件的呼叫數、錯誤與重試、延遲分佈、token 合計與每個會話的 token 分佈"""
+    sessions: dict[str, dict] = {}
+    for event in events:
+        if event.get('session'):
+            session = sessions.setdefault(event['session'], {'tokens': 0, 'turns': 0})
+            session['tokens'] += event.get('total_tokens') or 0
+            session['turns'] += 1
+
+    summary = {
+        'calls': len(events),
+        'errors': sum(1 for event in events if event.get('status') != 'ok'),
+        'retries': sum(event.get('retries') or 0 for event in events),
+        'calls_with_retries': sum(1 for event in events if event.get('retries')),
+        'sessions': len(sessions),
+        'tokens_per_session': distribution([session['tokens'] for session in sessions.values()]),
+        'turns_per_session': distribution([session['turns'] for session in sessions.values()]),
+    }
+    for field in LATENCY_FIELDS:
+        values = [event[field] for event in events if event.get(field) is not None]
+        if values:
+            summary[field] = distribution(values)
+    for field in TOKEN_FIELDS:
+        summary[field] = sum(event.get(field) or 0 for event in events)
+    return summary
+
+
+def rollup(events: list[dict], slowest: int = 10) -> dict:
+    """
+    一天的遙測彙總，返回:
+    - endpoints: {端點: {分組: summarize_events 結果}}，分組另有 'all' 合計
+    - slowest: 端到端延遲最長的幾次呼叫（端點、會話、輪次、延遲、重試），用於追查慢回合
+    """
+    by_endpoint: dict[str, dict[str, list]] = {}
+    for event in events:
+        groups = by_endpoint.setdefault(event.get('endpoint', 'unknown'), {})
+        groups.setdefault(event.get('group') or 'unknown', []).append(event)
+        groups.setdefault(ALL_GROUPS, []).append(event)
+
+    slowest_events = sorted(
+        (event for event in events if event.get('latency_ms') is not None),
+        key=lambda event: event['latency_ms'],
+        reverse=True,
+    )[:slowest]
+    return {
+        'calls': len(events),
+        'endpoints': {
+            endpoint: {group: summarize_events(group_events) for group, group_events in groups.items()}
+            for endpoint, groups in by_endpoint.items()
+        },
+        'slowest': [
+            {key: event.get(key) for key in ('endpoint', 'uid', 'session', 'turn', 'latency_ms', 'openai_ms', 'retries', 'status')}
+            for event in slowest_events
+        ],
+    }
@@ -2,22 +2,210 @@
 # To get started, simply uncomment the below code or create your own.
 # Deploy with `firebase deploy`
 
-from firebase_functions import https_fn, scheduler_fn
-from firebase_admin import initialize_app, firestore, credentials
-from openai import OpenAI
+from firebase_functions import https_fn, scheduler_fn, firestore_fn
+from firebase_admin import initialize_app, firestore, credentials, auth
 import os
 import json
-from datetime import datetime, timedelta
-import pytz
-import system_prompt
+import base64
+import hashlib
+from datetime import datetime, timedelta, timezone
+import firestore_stats
+import llm_telemetry
+import structured_log
 import re
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TYPE_CHECKING
+
+# 冷啟動：所有函數共用本模組，只有部分函數用到的依賴在使用處才導入
+# - openai / httpx：get_openai_client()
+# - system_prompt：教練與摘要的 prompt 組裝
+# - curriculum / vocab_review：課程內容查詢與單字複習佇列（導入時會開啟 curriculum.bin）
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 # 使用默認憑證初始化，確保有完整的 admin 權限
 initialize_app()
 
+# 台灣時區：1980 年起不再實施夏令時間，以固定 UTC+8 表示（不需導入時區資料庫）
+TAIWAN_TZ = timezone(timedelta(hours=8), 'Asia/Taipei')
+
+# OpenAI 請求超時（秒）：總超時與建立連線超時
+OPENAI_TIMEOUT_SEC = float(os.environ.get('OPENAI_TIMEOUT_SEC', '60'))
+OPENAI_CONNECT_TIMEOUT_SEC = float(os.environ.get('OPENAI_CONNECT_TIMEOUT_SEC', '10'))
+# OpenAI SDK 內建的重試次數（連線錯誤、429、5xx，指數退避）
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '2'))
+# HTTP 連線池：最大連線數與閒置 keep-alive 連線的保留時間（秒）
+OPENAI_MAX_CONNECTIONS = 20
+OPENAI_KEEPALIVE_EXPIRY_SEC = 120
+
+# 教練對話歷史壓縮：對話歷史（含較早輪次的摘要）的 token 預算，超出時較早的輪次改以已快取的滾動摘要代入，
+# 摘要本身在背景生成，不佔用教練請求的時間
+COACH_HISTORY_TOKEN_BUDGET = int(os.environ.get('COACH_HISTORY_TOKEN_BUDGET', '1500'))
+# 一定保留原文的最近訊息數（一輪 = user + assistant 兩則）
+COACH_KEEP_RECENT_MESSAGES = int(os.environ.get('COACH_KEEP_RECENT_MESSAGES', '6'))
+# 摘要邊界每次前移的訊息數，讓同一份摘要可在連續幾輪之間重複使用
+COACH_SUMMARY_STEP_MESSAGES = 4
+# 沒有可用的摘要而必須捨棄最舊的原文訊息時，捨棄部分改為逐則截斷的摘錄：摘錄的 token 上限與每則保留的字元數
+COACH_DROPPED_DIGEST_TOKENS = int(os.environ.get('COACH_DROPPED_DIGEST_TOKENS', '200'))
+COACH_DROPPED_DIGEST_CHARS = 40
+# yesterday_chat 超過此 token 數時代入摘要（尚未生成時先截斷）
+COACH_YESTERDAY_CHAT_TOKEN_LIMIT = int(os.environ.get('COACH_YESTERDAY_CHAT_TOKEN_LIMIT', '400'))
+# 實例內快取的對話摘要數量
+DIALOGUE_SUMMARY_CACHE_SIZE = 512
+# 背景生成對話摘要的線程數
+DIALOGUE_SUMMARY_WORKERS = 2
+
+# summarize_chat 結果快取：實例內 LRU 數量，以及跨實例共用的 Firestore 集合與保存天數
+SUMMARY_CACHE_SIZE = int(os.environ.get('SUMMARY_CACHE_SIZE', '1000'))
+SUMMARY_CACHE_COLLECTION = 'summary_cache'
+SUMMARY_CACHE_TTL_DAYS = 30
+# 摘要 prompt、schema 或模型變更時調整版本號，讓舊的快取失效
+SUMMARY_CACHE_VERSION = 'gpt-4.1-mini:v2'
+
+# 批量摘要（OpenAI Batch API）：每個批次最多提交的聊天數、任務記錄集合與完成時限
+SUMMARY_BATCH_MAX_CHATS = 2000
+SUMMARY_BATCH_COLLECTION = 'summary_batches'
+SUMMARY_BATCH_COMPLETION_WINDOW = '24h'
+SUMMARY_BATCH_ACTIVE_STATUSES = ('validating', 'in_progress', 'finalizing', 'cancelling')
+SUMMARY_BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+# 套用批次結果時的認領狀態與租約：租約內其他呼叫（排程或手動）不會重複套用，逾期則可重新認領
+SUMMARY_BATCH_APPLYING_STATUS = 'applying'
+SUMMARY_BATCH_APPLY_LEASE = timedelta(minutes=15)
+# 聊天文檔的 summary_status：pending（待批量摘要，可直接查詢）、batch（已提交批量摘要）、done（已寫入摘要）
+CHAT_SUMMARY_PENDING = 'pending'
+CHAT_SUMMARY_IN_BATCH = 'batch'
+CHAT_SUMMARY_DONE = 'done'
+
+# 聊天結束時的服務端摘要：觸發器的最大實例數；觸發器設定 concurrency=1（Gen2 默認每個實例並行 80 個事件），
+# 每個實例一次只處理一個事件，最大實例數即同時進行的摘要數上限
+SUMMARY_TRIGGER_MAX_INSTANCES = 10
+
+# 教練上下文：coach_context_refresh 排程在每日指標聚合之後為隔天對話預先產生 users/{uid}/coach_context/{日期}，
+# 教練函數在實例內快取
+COACH_CONTEXT_COLLECTION = 'coach_context'
+COACH_CONTEXT_CACHE_SIZE = 5000
+COACH_CONTEXT_CACHE_TTL_SEC = 1800
+COACH_CONTEXT_METRIC_NAMES = (
+    'event_total_count', 'event_complete_count', 'event_overdue_count',
+    'chat_total_count', 'chat_start_count', 'chat_snooze_count', 'review_count',
+)
+
+# 單字複習佇列：夜間任務預先計算，存到 users/{uid}/vocab_review/{日期}
+VOCAB_REVIEW_COLLECTION = 'vocab_review'
+# 學習紀錄的掃描範圍（複習規則限於同週，往前一週足夠）
+VOCAB_REVIEW_LOOKBACK = timedelta(days=7)
+# 計入學習紀錄的會話子集合：vocab 為學習會話，review 為首頁的複習會話
+VOCAB_SESSION_COLLECTIONS = ('vocab', 'review')
+
+# LLM 遙測：每次 OpenAI 呼叫一個文檔，夜間彙總到 llm_telemetry_daily/{日期}
+LLM_TELEMETRY_COLLECTION = 'llm_telemetry'
+LLM_TELEMETRY_DAILY_COLLECTION = 'llm_telemetry_daily'
+LLM_TELEMETRY_BATCH_SIZE = int(os.environ.get('LLM_TELEMETRY_BATCH_SIZE', '50'))
+LLM_TELEMETRY_FLUSH_INTERVAL_SEC = float(os.environ.get('LLM_TELEMETRY_FLUSH_INTERVAL_SEC', '10'))
+# 寫出持續失敗時緩衝的事件上限
+LLM_TELEMETRY_MAX_BUFFERED = 5000
+# 彙總中保留的最慢呼叫數
+LLM_TELEMETRY_SLOWEST = 10
+
+# 每個事件需要讀取的子集合（名稱 -> 日誌用描述）
+EVENT_SUBCOLLECTIONS = {
+    'chats': '聊天記錄',
+    'review': '複習記錄',
+    'notifications': '通知記錄',
+}
+# 子集合並行讀取的最大線程數
+SUBCOLLECTION_FETCH_WORKERS = 16
+
+# 每日聚合時並行處理用戶的線程數
+DAILY_METRICS_WORKERS = int(os.environ.get('DAILY_METRICS_WORKERS', '8'))
+# 單個用戶的處理超時（秒），超時記為失敗，不阻塞其他用戶
+DAILY_METRICS_USER_TIMEOUT_SEC = float(os.environ.get('DAILY_METRICS_USER_TIMEOUT_SEC', '60'))
+
+# 每日聚合分頁讀取用戶的每頁數量（每頁處理完寫一次檢查點）
+DAILY_METRICS_USER_PAGE_SIZE = int(os.environ.get('DAILY_METRICS_USER_PAGE_SIZE', '200'))
+# 每日聚合分片數量：按 uid 範圍分片，每個分片有獨立的排程函數，只讀取自己範圍內的用戶
+DAILY_METRICS_SHARDS = int(os.environ.get('DAILY_METRICS_SHARDS', '1'))
+# uid 首字元（Firebase Auth uid 為英數字），按 Firestore 文檔 ID 的排序排列；分片按此切分 uid 範圍
+UID_SHARD_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# 單次執行的時間預算（秒，需小於 540 秒的函數超時），超出後保存檢查點並失敗退出，由排程重試續跑
+DAILY_METRICS_TIME_BUDGET_SEC = 480
+# 排程失敗後的重試次數
+DAILY_METRICS_RETRY_COUNT = 3
+
+# 批量寫入每批的文檔數（Firestore 單個批次上限為 500 次寫入）
+FIRESTORE_BATCH_SIZE = 400
+# 批量寫入失敗後的重試次數（指數退避）
+FIRESTORE_BATCH_RETRIES = 3
+# 執行日誌中最多記錄的寫入失敗明細數量，避免日誌文檔過大
+MAX_LOGGED_WRITE_FAILURES = 100
+
+# 用戶文檔快取：最多快取的用戶數與有效期（秒），在熱實例的多次調用之間共用
+USER_PROFILE_CACHE_SIZE = int(os.environ.get('USER_PROFILE_CACHE_SIZE', '10000'))
+USER_PROFILE_CACHE_TTL_SEC = float(os.environ.get('USER_PROFILE_CACHE_TTL_SEC', '600'))
+
+# 每日聚合模式：per_user（逐用戶查詢）、collection_group（跨用戶分頁掃描）
+# 或 incremental（直接以觸發器維護的即時計數定稿，沒有即時文檔的用戶才完整計算，並抽樣核對）
+DAILY_METRICS_MODE = os.environ.get('DAILY_METRICS_MODE', 'per_user')
+# 即時每日指標文檔：users/{uid}/daily_metrics_live/{date}，由 Firestore 觸發器增量維護
+LIVE_METRICS_COLLECTION = 'daily_metrics_live'
+# 已處理的觸發器事件：users/{uid}/daily_metrics_live_events/{event.id}，重複投遞的事件不再累加
+LIVE_METRICS_PROCESSED_COLLECTION = 'daily_metrics_live_events'
+# 已處理事件記錄的保留天數（expires_at 欄位設有 TTL 策略）
+LIVE_METRICS_PROCESSED_TTL_DAYS = 7
+# incremental 模式每頁抽樣重新完整計算、與即時計數核對的用戶數（不一致時以完整計算為準）
+LIVE_METRICS_VERIFY_SAMPLE = int(os.environ.get('LIVE_METRICS_VERIFY_SAMPLE', '5'))
+# 觸發器監聽的事件集合
+LIVE_METRICS_EVENT_COLLECTIONS = ('experiment_events', 'control_events')
+
+# collection-group 掃描每頁文檔數
+COLLECTION_GROUP_PAGE_SIZE = 1000
+# 子集合文檔的時間可能早於事件排程時間（例如提前排程的通知），掃描時向前放寬的範圍
+COLLECTION_GROUP_LOOKBACK = timedelta(days=7)
+# collection-group 掃描子集合時使用的時間欄位
+SUBCOLLECTION_TIME_FIELDS = {
+    'chats': 'start_time',
+    'review': 'startTime',
+    'notifications': 'created_at',
+}
+
 def get_firestore_client():
-    """延遲初始化Firestore客户端，避免部署超時"""
-    return firestore.client()
+    """延遲初始化Firestore客户端，避免部署超時；客戶端掛上 firestore_stats 的 RPC 統計"""
+    return firestore_stats.instrument(firestore.client())
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client() -> 'OpenAI':
+    """延遲建立 OpenAI 客户端並在熱實例中重用，保留 TLS 連線與 HTTP 連線池（openai 套件在首次呼叫時才導入）"""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                import httpx
+                from openai import OpenAI, DefaultHttpxClient
+
+                _openai_client = OpenAI(
+                    api_key=os.environ.get("OPENAI_APIKEY"),
+                    timeout=httpx.Timeout(OPENAI_TIMEOUT_SEC, connect=OPENAI_CONNECT_TIMEOUT_SEC),
+                    max_retries=OPENAI_MAX_RETRIES,
+                    http_client=DefaultHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=OPENAI_MAX_CONNECTIONS,
+                            max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SEC,
+                        ),
+                    ),
+                )
+    return _openai_client
+
+def require_admin(req: https_fn.CallableRequest) -> None:
+    """手動觸發與管理用的 callable 只允許帶 admin 自訂聲明（custom claims）的帳號呼叫"""
+    if req.auth is None or not (req.auth.token or {}).get('admin'):
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.PERMISSION_DENIED, message="需要管理員權限")
 
 def generate_task_description(task_title: str, reading_topic: str = "", explicit_description: str | None = None) -> str:
     """根据任务标题與可選描述生成任務說明。
@@ -33,54 +221,27 @@ def generate_task_description(task_title: str, reading_topic: str = "", explicit
     else:
         return f"- task : The user needs to complete the task: {task_title}"
 
+# 任務標題格式：reading / vocab 加上 w{week}-d{day} 或 {week}-{day}（分隔符 - 或 _ 可省略）
+# 用條件分組保證 w 與 d 同時出現或同時省略
+TASK_TITLE_PATTERN = re.compile(r'^(?:reading|vocab)[-_]?(w)?(\d+)[-_]?(?(1)d)(\d+)$')
+
+
 def parse_week_day_from_title(task_title: str) -> tuple[int, int]:
-    """从任务标题中解析出 week 和 day"""
-    
-    # 转换为小写并去除空格
-    title = task_title.lower().strip()
-    
-    # 匹配 reading-w{week}-d{day} 格式
-    pattern1 = r'^reading[-_]?w(\d+)[-_]?d(\d+)$'
-    match1 = re.match(pattern1, title)
-    if match1:
-        week = int(match1.group(1))
-        day = int(match1.group(2))
-        return week, day
-    
-    # 匹配 reading-{week}-{day} 格式
-    pattern2 = r'^reading[-_]?(\d+)[-_]?(\d+)$'
-    match2 = re.match(pattern2, title)
-    if match2:
-        week = int(match2.group(1))
-        day = int(match2.group(2))
-        return week, day
-    
-    # 匹配 vocab-w{week}-d{day} 格式
-    pattern3 = r'^vocab[-_]?w(\d+)[-_]?d(\d+)$'
-    match3 = re.match(pattern3, title)
-    if match3:
-        week = int(match3.group(1))
-        day = int(match3.group(2))
-        return week, day
-    
-    # 匹配 vocab-{week}-{day} 格式
-    pattern4 = r'^vocab[-_]?(\d+)[-_]?(\d+)$'
-    match4 = re.match(pattern4, title)
-    if match4:
-        week = int(match4.group(1))
-        day = int(match4.group(2))
-        return week, day
-    
-    # 如果没有匹配到，返回默认值
+    """从任务标题中解析出 week 和 day，無法解析時返回 (None, None)"""
+    match = TASK_TITLE_PATTERN.match(task_title.lower().strip())
+    if match:
+        return int(match.group(2)), int(match.group(3))
     return None, None
 
-def build_prompt(task: str, dialogues: list[dict], start_time: str, current_turn: int, task_description: str | None = None, yesterday_chat: str | None = None, day_number: int | None = None, scheduled_duration_min: int | None = None) -> list[dict]:
+def build_prompt(task: str, dialogues: list[dict], start_time: str, current_turn: int, task_description: str | None = None, yesterday_chat: str | None = None, day_number: int | None = None, scheduled_duration_min: int | None = None, dialogue_summary: str | None = None, daily_summary: str | None = None) -> list[dict]:
     """
     將 system prompt 與使用者對話組合成 OpenAI ChatCompletion 用的 messages 陣列
     """
-    # 將任務資訊帶入 SYSTEM_INSTRUCTION 模板
+    import system_prompt
+
+    # 將任務資訊帶入 system prompt 模板
     # 使用台灣時區
-    taiwan_tz = pytz.timezone('Asia/Taipei')
+    taiwan_tz = TAIWAN_TZ
     now_taiwan = datetime.now(taiwan_tz).strftime('%Y-%m-%d %H:%M')
     
     # 处理reading_topic
@@ -96,249 +257,1558 @@ def build_prompt(task: str, dialogues: list[dict], start_time: str, current_turn
     
     # 根据任务标题生成任务描述（允許外部提供）
     task_description = generate_task_description(task, reading_topic, task_description)
-    system_content = (
-        system_prompt.SYSTEM_INSTRUCTION
-        .replace("{{task_title}}", task)
-        .replace("{{scheduled_start}}", start_time)
-        .replace("{{scheduled_duration_min}}", str(scheduled_duration_min or ""))
-        .replace("{{now}}", now_taiwan)
-        .replace("{{current_turn}}", str(current_turn))
-        .replace("{{reading_topic}}", reading_topic)
-        .replace("{{task_description}}", task_description)
+    # 固定的 MI 指令在前，每輪變化的欄位放在後段，保持 prompt 前綴穩定
+    system_content = system_prompt.render_system_prompt(
+        task_title=task,
+        scheduled_start=start_time,
+        scheduled_duration_min=str(scheduled_duration_min or ""),
+        now=now_taiwan,
+        current_turn=str(current_turn),
+        task_description=task_description,
+        yesterday_chat=yesterday_chat or "無",
+        daily_summary=daily_summary or "無",
+        dialogue_summary=dialogue_summary or "無",
     )
     
-    # 替换前一天的数据
-    system_content = system_content.replace("{{yesterday_chat}}", yesterday_chat or "無")
-    
-    # 如果有描述，在任務標題後添加描述信息
-    if task_description and task_description.strip():
-        # 在"任務："行後添加描述
-        system_content = system_content.replace(
-            f"- 任務：{task}", 
-            f"- 任務：{task}\n- 以下是使用者對於任務的描述或感受：{task_description.strip()}"
-        )
-    
-    system_content += f"\n\n🔄 對話狀態：目前為第 {current_turn} 輪對話"
-    
     # 建立訊息陣列：僅保留一個 system role，後續直接接上 dialogues
     messages: list[dict] = [{"role": "system", "content": system_content}]
     messages.extend(dialogues)
     return messages
 
+def estimate_tokens(text: str) -> int:
+    """
+    本地估算 token 數（不依賴 tokenizer 套件，刻意偏高以免超出預算）
+    非 ASCII 字元（中文、emoji 等）每字算 1 token，ASCII 每 3 字元算 1 token
+    """
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + -(-(len(text) - non_ascii) // 3)
+
+
+def estimate_message_tokens(messages: list[dict]) -> int:
+    """估算 messages 陣列的 token 數，每則訊息另加 4 token 的格式開銷"""
+    return sum(4 + estimate_tokens(str(m.get("content", ""))) for m in messages)
+
+
+_dialogue_summary_cache: OrderedDict = OrderedDict()
+_dialogue_summary_lock = threading.Lock()
+# 背景摘要：線程池與排程中的前綴（同一前綴只排程一次）
+_dialogue_summary_executor = ThreadPoolExecutor(max_workers=DIALOGUE_SUMMARY_WORKERS)
+_dialogue_summary_pending: set[str] = set()
+
+
+def dialogue_prefix_digests(messages: list[dict]) -> list[str]:
+    """逐則串接的前綴雜湊：第 i 個元素對應 messages[:i + 1]"""
+    prefix_digests = []
+    digest = ""
+    for m in messages:
+        item = json.dumps([m.get("role", ""), m.get("content", "")], ensure_ascii=False)
+        digest = hashlib.sha256((digest + item).encode("utf-8")).hexdigest()
+        prefix_digests.append(digest)
+    return prefix_digests
+
+
+def cached_dialogue_summary(messages: list[dict], prefix_digests: list[str] | None = None) -> tuple[int, str | None]:
+    """實例內快取中 messages 最長前綴的摘要，返回 (該前綴的訊息數, 摘要)；沒有任何前綴命中時為 (0, None)"""
+    prefix_digests = prefix_digests or dialogue_prefix_digests(messages)
+    with _dialogue_summary_lock:
+        for end in range(len(messages), 0, -1):
+            cached = _dialogue_summary_cache.get(prefix_digests[end - 1])
+            if cached is not None:
+                _dialogue_summary_cache.move_to_end(prefix_digests[end - 1])
+                return end, cached
+    return 0, None
+
+
+def rolling_dialogue_summary(messages: list[dict]) -> str:
+    """
+    回傳 messages 的滾動摘要（實例內 LRU 快取，key 為逐則串接的前綴雜湊），會同步呼叫模型
+    以已快取的最長前綴摘要為基礎，只把之後新增的訊息交給模型合併，不必每次重新摘要整段對話
+    """
+    prefix_digests = dialogue_prefix_digests(messages)
+    base_end, base_summary = cached_dialogue_summary(messages, prefix_digests)
+    if base_end == len(messages):
+        return base_summary
+
+    new_messages = messages[base_end:]
+    if base_summary:
+        new_messages = [{"role": "earlier_summary", "content": base_summary}] + new_messages
+    summary = summarize_messages(new_messages).get("summary", "")
+
+    with _dialogue_summary_lock:
+        _dialogue_summary_cache[prefix_digests[-1]] = summary
+        while len(_dialogue_summary_cache) > DIALOGUE_SUMMARY_CACHE_SIZE:
+            _dialogue_summary_cache.popitem(last=False)
+    return summary
+
+
+def prefetch_dialogue_summary(messages: list[dict]) -> None:
+    """
+    在背景線程生成 messages 的滾動摘要，供同一實例之後的請求使用，不阻塞呼叫端
+    摘要通常在同一個教練請求等待模型回覆期間完成
+    """
+    digest = dialogue_prefix_digests(messages)[-1]
+    with _dialogue_summary_lock:
+        if digest in _dialogue_summary_cache or digest in _dialogue_summary_pending:
+            return
+        _dialogue_summary_pending.add(digest)
+
+    def run() -> None:
+        try:
+            rolling_dialogue_summary(messages)
+        except Exception as e:
+            structured_log.warning("⚠️ 背景對話摘要失敗", sample_key='dialogue_summary_error', error=str(e))
+        finally:
+            with _dialogue_summary_lock:
+                _dialogue_summary_pending.discard(digest)
+
+    _dialogue_summary_executor.submit(contextvars.copy_context().run, run)
+
+
+def dropped_dialogue_digest(messages: list[dict], token_limit: int = COACH_DROPPED_DIGEST_TOKENS, snippet_chars: int = COACH_DROPPED_DIGEST_CHARS) -> str:
+    """
+    被捨棄訊息的確定性摘錄（不呼叫模型）：每則取前 snippet_chars 個字元，從最新的一則往前收錄到 token_limit 為止，
+    收錄不下的較早訊息只記錄則數
+    """
+    header_template = "[{} earlier messages omitted]"
+    used = estimate_tokens(header_template.format(len(messages))) + 1
+    lines = []
+    for m in reversed(messages):
+        content = " ".join(str(m.get("content", "")).split())
+        if len(content) > snippet_chars:
+            content = content[:snippet_chars] + "…"
+        line = f"{m.get('role', '')}: {content}"
+        tokens = estimate_tokens(line) + 1
+        if used + tokens > token_limit:
+            break
+        lines.append(line)
+        used += tokens
+    lines.reverse()
+    omitted = len(messages) - len(lines)
+    if omitted:
+        lines.insert(0, header_template.format(omitted))
+    return "\n".join(lines)
+
+
+def compact_dialogues(dialogues: list[dict], token_budget: int = COACH_HISTORY_TOKEN_BUDGET, keep_recent: int = COACH_KEEP_RECENT_MESSAGES) -> tuple[list[dict], str | None]:
+    """
+    對話歷史壓縮，回傳 (保留原文的訊息, 較早輪次的摘要或 None)，不在請求路徑上呼叫模型
+    - 未超出 token 預算時原樣回傳
+    - 超出時至少保留最近 keep_recent 則原文，更早的訊息（邊界按 COACH_SUMMARY_STEP_MESSAGES 對齊）
+      改用已快取的最長前綴摘要；該邊界的摘要尚未生成時在背景生成，供下一輪使用
+    - 沒有可用的摘要或壓縮後仍超出預算時，從最舊的原文訊息開始捨棄，至少保留最後一則；
+      捨棄的訊息以 dropped_dialogue_digest 的截斷摘錄代入（附在摘要之後），預算中先為摘錄預留 COACH_DROPPED_DIGEST_TOKENS
+    """
+    if estimate_message_tokens(dialogues) <= token_budget:
+        return dialogues, None
+
+    summary = None
+    cut = max(len(dialogues) - keep_recent, 0) // COACH_SUMMARY_STEP_MESSAGES * COACH_SUMMARY_STEP_MESSAGES
+    if cut > 0:
+        covered, summary = cached_dialogue_summary(dialogues[:cut])
+        if covered < cut:
+            prefetch_dialogue_summary(dialogues[:cut])
+        if summary:
+            dialogues = dialogues[covered:]
+
+    summary_tokens = estimate_tokens(summary) if summary else 0
+    recent = list(dialogues)
+    dropped = []
+    if summary_tokens + estimate_message_tokens(recent) > token_budget:
+        reserved = summary_tokens + COACH_DROPPED_DIGEST_TOKENS
+        while len(recent) > 1 and reserved + estimate_message_tokens(recent) > token_budget:
+            dropped.append(recent.pop(0))
+    if dropped:
+        digest = dropped_dialogue_digest(dropped)
+        summary = f"{summary}\n{digest}" if summary else digest
+    return recent, summary
+
+
+def compact_yesterday_chat(yesterday_chat: str | None, token_limit: int = COACH_YESTERDAY_CHAT_TOKEN_LIMIT, wait: bool = False) -> str | None:
+    """
+    yesterday_chat 超過 token 上限時改用摘要
+    wait 為 False（教練請求路徑）時只使用已快取的摘要，未命中時截斷並在背景生成摘要；
+    wait 為 True（夜間任務）時同步摘要，失敗才截斷
+    """
+    if not yesterday_chat or estimate_tokens(yesterday_chat) <= token_limit:
+        return yesterday_chat
+    messages = [{"role": "yesterday_chat", "content": yesterday_chat}]
+    if wait:
+        try:
+            return rolling_dialogue_summary(messages)
+        except Exception as e:
+            structured_log.warning("⚠️ yesterday_chat 摘要失敗，改為截斷", sample_key='yesterday_chat_summary_error', error=str(e))
+    else:
+        _, summary = cached_dialogue_summary(messages)
+        if summary:
+            return summary
+        prefetch_dialogue_summary(messages)
+    # 每個字元至多 1 token，取前 token_limit 個字元必定不超出上限
+    return yesterday_chat[:token_limit]
+
+
+def build_coach_messages(data: dict, uid: str | None = None) -> list[dict]:
+    """
+    從教練對話請求的參數組合 OpenAI messages（callable 與串流版本共用）
+    提供 uid 時以預先產生的教練上下文填入前一天的聊天與日報摘要；客戶端仍傳 yesterdayChat 時以客戶端為準
+    """
+    task = data["taskTitle"]
+    task_description = data.get("taskDescription")  # 新增描述參數
+    dialogues = data["dialogues"]
+    start_time = data["startTime"]
+    current_turn = data.get("currentTurn", 0)
+    day_number = data.get("dayNumber")  # 新增dayNumber參數
+    scheduled_duration_min = data.get("taskDurationMin")  # 新增：任務時長（分鐘）
+    
+    # 获取前一天的数据
+    coach_context = load_coach_context(uid) if uid else {}
+    yesterday_chat = data.get("yesterdayChat") or coach_context.get("yesterday_chat", "")
+    daily_summary = coach_context.get("daily_summary")
+
+    # 送出前先按 token 預算壓縮對話歷史與 yesterday_chat（只用已快取的摘要，不在此等待模型）
+    dialogues, dialogue_summary = compact_dialogues(dialogues)
+    yesterday_chat = compact_yesterday_chat(yesterday_chat)
+
+    return build_prompt(
+        task,
+        dialogues,
+        start_time,
+        current_turn,
+        task_description=task_description,
+        yesterday_chat=yesterday_chat,
+        day_number=day_number,
+        scheduled_duration_min=scheduled_duration_min,
+        dialogue_summary=dialogue_summary,
+        daily_summary=daily_summary,
+    )
+
+
+def token_usage_dict(usage) -> dict:
+    """OpenAI usage 轉為回傳給客戶端的 token_usage"""
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'total_tokens': usage.total_tokens
+    }
+
+
+def openai_retries(raw_response) -> int:
+    """with_raw_response 回應的重試次數（舊版 SDK 沒有 retries_taken 時讀取請求標頭）"""
+    retries = getattr(raw_response, 'retries_taken', None)
+    if retries is None:
+        retries = int(raw_response.http_request.headers.get('x-stainless-retry-count', 0))
+    return retries
+
+
+def llm_session_id(uid: str | None, data: dict) -> str | None:
+    """同一場教練對話的識別碼：用戶、任務標題與開始時間相同即為同一場"""
+    if not uid:
+        return None
+    key = f"{uid}|{data.get('taskTitle', '')}|{data.get('startTime', '')}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def record_llm_call(endpoint: str, model: str, started_at: float, openai_ms: float | None = None, usage=None,
+                    retries: int = 0, uid: str | None = None, data: dict | None = None, error: Exception | None = None,
+                    first_token_ms: float | None = None) -> None:
+    """
+    把一次 LLM 呼叫的遙測放進緩衝區（不阻塞請求）
+    started_at 為請求開始時的 time.perf_counter()；分組在寫出時才查詢
+    """
+    data = data or {}
+    now = datetime.now(TAIWAN_TZ)
+    cached_tokens = None
+    if usage is not None and getattr(usage, 'prompt_tokens_details', None) is not None:
+        cached_tokens = usage.prompt_tokens_details.cached_tokens
+    llm_telemetry_buffer.record({
+        'endpoint': endpoint,
+        'model': model,
+        'uid': uid,
+        'session': llm_session_id(uid, data),
+        'turn': data.get('currentTurn'),
+        'day_number': data.get('dayNumber'),
+        'prompt_tokens': usage.prompt_tokens if usage is not None else None,
+        'completion_tokens': usage.completion_tokens if usage is not None else None,
+        'cached_tokens': cached_tokens,
+        'total_tokens': usage.total_tokens if usage is not None else None,
+        'latency_ms': round((time.perf_counter() - started_at) * 1000),
+        'openai_ms': round(openai_ms) if openai_ms is not None else None,
+        'first_token_ms': round(first_token_ms) if first_token_ms is not None else None,
+        'retries': retries,
+        'status': 'ok' if error is None else 'error',
+        'error': str(error)[:500] if error is not None else None,
+        'date': now.strftime('%Y%m%d'),
+        'created_at': now,
+    })
+
+
+def write_llm_telemetry(events: list[dict]) -> None:
+    """背景寫出遙測事件：補上用戶分組（經 user_profile_cache）後分批寫入 llm_telemetry"""
+    db = get_firestore_client()
+    writes = []
+    for event in events:
+        if 'group' not in event:
+            event['group'] = get_user_group_path(event['uid'], db) if event.get('uid') else None
+        writes.append((event.get('uid') or event['endpoint'], db.collection(LLM_TELEMETRY_COLLECTION).document(), event))
+    with firestore_stats.call_site(LLM_TELEMETRY_COLLECTION):
+        failures = commit_in_batches(db, writes)
+    if failures:
+        raise RuntimeError(f"{len(failures)} 筆遙測寫入失敗: {failures[0][1]}")
+
+
+llm_telemetry_buffer = llm_telemetry.TelemetryBuffer(
+    write_llm_telemetry,
+    batch_size=LLM_TELEMETRY_BATCH_SIZE,
+    flush_interval_sec=LLM_TELEMETRY_FLUSH_INTERVAL_SEC,
+    max_buffered=LLM_TELEMETRY_MAX_BUFFERED,
+)
+
+
+def validate_response_fields(answer: dict, response_format: dict) -> dict:
+    """按 response_format 中的 JSON schema 檢查必填欄位、類型與 enum，不符合時拋出 ValueError"""
+    schema = response_format['json_schema']['schema']
+    json_types = {'string': str, 'boolean': bool, 'array': list, 'object': dict}
+    for name in schema['required']:
+        if name not in answer:
+            raise ValueError(f"回覆缺少欄位 {name}")
+        prop = schema['properties'][name]
+        expected_type = json_types.get(prop.get('type'))
+        if expected_type and not isinstance(answer[name], expected_type):
+            raise ValueError(f"欄位 {name} 類型錯誤: {answer[name]!r}")
+        if 'enum' in prop and answer[name] not in prop['enum']:
+            raise ValueError(f"欄位 {name} 的值不在允許範圍: {answer[name]!r}")
+    return answer
+
+
+class JsonStringFieldStream:
+    """
+    從逐段到達的 JSON 文本中，增量解出某個頂層字串欄位的內容
+    每次 feed() 返回這段新增的已解碼文字（處理跳脫字元與跨段的 \\uXXXX）
+    """
+
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, field: str):
+        self._key_pattern = re.compile(r'"' + re.escape(field) + r'"\s*:\s*"')
+        self._buffer = ""
+        self._pos = None  # 欄位值在 buffer 中的下一個待解碼位置
+        self._pending_high_surrogate = ""
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = self._key_pattern.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        out = []
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                self.done = True
+                pos += 1
+                break
+            if char != '\\':
+                out.append(char)
+                pos += 1
+                continue
+            # 跳脫字元：不完整時等待下一段
+            if pos + 1 >= len(buffer):
+                break
+            escape = buffer[pos + 1]
+            if escape != 'u':
+                out.append(self._ESCAPES.get(escape, escape))
+                pos += 2
+                continue
+            if pos + 6 > len(buffer):
+                break
+            code_unit = chr(int(buffer[pos + 2:pos + 6], 16))
+            pos += 6
+            if '\ud800' <= code_unit <= '\udbff':
+                self._pending_high_surrogate = code_unit
+            elif self._pending_high_surrogate and '\udc00' <= code_unit <= '\udfff':
+                pair = self._pending_high_surrogate + code_unit
+                out.append(pair.encode('utf-16', 'surrogatepass').decode('utf-16'))
+                self._pending_high_surrogate = ""
+            else:
+                out.append(code_unit)
+        self._pos = pos
+        return "".join(out)
+
+
+def sse_event(event: str, data: dict) -> str:
+    """格式化一個 Server-Sent Events 事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 @https_fn.on_call(secrets=["OPENAI_APIKEY"])
 def procrastination_coach_completion(req: https_fn.CallableRequest) -> any:
-    client = OpenAI(api_key=os.environ.get("OPENAI_APIKEY"))
+    import system_prompt
+
+    started_at = time.perf_counter()
+    client = get_openai_client()
+    uid = req.auth.uid if req.auth else None
+    response = None
+    openai_ms = None
+    retries = 0
+
+    try:
+        messages = build_coach_messages(req.data, uid=uid)
+        openai_started_at = time.perf_counter()
+        raw_response = client.chat.completions.with_raw_response.create(
+            model="gpt-4.1-mini",
+            messages=messages,
+            response_format=system_prompt.get_response_schema()
+        )
+        openai_ms = (time.perf_counter() - openai_started_at) * 1000
+        retries = openai_retries(raw_response)
+        response = raw_response.parse()
+        message = response.choices[0].message.content
+        answer = json.loads(message)
+        
+        # 🎯 實驗數據收集：添加token使用量信息
+        if hasattr(response, 'usage') and response.usage:
+            answer['token_usage'] = token_usage_dict(response.usage)
+        
+        record_llm_call('coach', "gpt-4.1-mini", started_at, openai_ms, response.usage, retries, uid, req.data)
+        return answer
+
+    except Exception as e:
+        record_llm_call('coach', "gpt-4.1-mini", started_at, openai_ms, getattr(response, 'usage', None), retries, uid, req.data, error=e)
+        raise https_fn.HttpsError(code=https_fn.HttpsErrorCode.UNKNOWN,
+                                  message="Error",
+                                  details=e)
+
+
+@https_fn.on_request(secrets=["OPENAI_APIKEY"], timeout_sec=120)
+def procrastination_coach_stream(req: https_fn.Request) -> https_fn.Response:
+    """
+    串流版本的 procrastination_coach_completion（Server-Sent Events）
+    - delta 事件：{"text": ...}，answer 文字隨 token 生成逐段送出
+    - final 事件：通過 schema 驗證的完整回覆，欄位與 callable 版本相同（含 token_usage）
+    - error 事件：{"message": ...}
+    請求需帶 Authorization: Bearer <Firebase ID token>；body 為 JSON 參數，也接受 callable 格式 {"data": {...}}
+    """
+    started_at = time.perf_counter()
+    if req.method != 'POST':
+        return https_fn.Response('Method Not Allowed', status=405)
+
+    id_token = req.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    try:
+        uid = auth.verify_id_token(id_token)['uid']
+    except Exception:
+        return https_fn.Response('Unauthorized', status=401)
+
+    body = req.get_json(silent=True) or {}
+    try:
+        messages = build_coach_messages(body.get('data', body), uid=uid)
+    except Exception as e:
+        return https_fn.Response(
+            json.dumps({'error': f'參數錯誤: {e}'}, ensure_ascii=False), status=400, mimetype='application/json'
+        )
+
+    def events():
+        import system_prompt
+
+        data = body.get('data', body)
+        openai_ms = None
+        first_token_ms = None
+        retries = 0
+        usage = None
+        try:
+            response_format = system_prompt.get_response_schema()
+            openai_started_at = time.perf_counter()
+            raw_response = get_openai_client().chat.completions.with_raw_response.create(
+                model="gpt-4.1-mini",
+                messages=messages,
+                response_format=response_format,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            retries = openai_retries(raw_response)
+            stream = raw_response.parse()
+            answer_stream = JsonStringFieldStream('answer')
+            content_parts = []
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - openai_started_at) * 1000
+                    content_parts.append(content)
+                    text = answer_stream.feed(content)
+                    if text:
+                        yield sse_event('delta', {'text': text})
+
+            openai_ms = (time.perf_counter() - openai_started_at) * 1000
+            answer = validate_response_fields(json.loads("".join(content_parts)), response_format)
+            if usage:
+                answer['token_usage'] = token_usage_dict(usage)
+            record_llm_call('coach_stream', "gpt-4.1-mini", started_at, openai_ms, usage, retries, uid, data,
+                            first_token_ms=first_token_ms)
+            yield sse_event('final', answer)
+        except Exception as e:
+            structured_log.error("❌ 串流教練回覆失敗", sample_key='coach_stream_error', uid=uid, error=str(e))
+            record_llm_call('coach_stream', "gpt-4.1-mini", started_at, openai_ms, usage, retries, uid, data,
+                            error=e, first_token_ms=first_token_ms)
+            yield sse_event('error', {'message': str(e)})
+
+    return https_fn.Response(
+        events(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+def normalize_messages(messages: list[dict]) -> list[list[str]]:
+    """正規化對話：只保留 role 與 content，去除首尾空白並把連續空白合併為一格"""
+    return [[str(m.get("role", "")).strip(), " ".join(str(m.get("content", "")).split())] for m in messages]
+
+
+def messages_cache_key(messages: list[dict]) -> str:
+    """正規化對話（連同 SUMMARY_CACHE_VERSION）的 SHA-256，作為摘要快取的 key"""
+    payload = json.dumps([SUMMARY_CACHE_VERSION, normalize_messages(messages)], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SummaryCache:
+    """
+    對話摘要的內容定址快取，key 為正規化對話的雜湊，線程安全
+    先查實例內 LRU，再查 Firestore summary_cache/{key}（跨實例共用），都未命中才呼叫模型
+    Firestore 讀寫失敗只記錄警告，不影響摘要本身
+    """
+
+    def __init__(self, maxsize: int = SUMMARY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.firestore_hits = 0
+        self.misses = 0
+
+    def _put_local(self, key: str, result: dict) -> None:
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _get_stored(self, key: str) -> dict | None:
+        try:
+            doc = get_firestore_client().collection(SUMMARY_CACHE_COLLECTION).document(key).get()
+        except Exception as e:
+            structured_log.warning("⚠️ 讀取摘要快取失敗", sample_key='summary_cache_read_error', error=str(e))
+            return None
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get('expires_at')
+        if expires_at is not None and expires_at < datetime.now(timezone.utc):
+            return None
+        return data.get('result')
+
+    def _store(self, key: str, result: dict) -> None:
+        try:
+            get_firestore_client().collection(SUMMARY_CACHE_COLLECTION).document(key).set({
+                'result': result,
+                'version': SUMMARY_CACHE_VERSION,
+                'created_at': firestore.SERVER_TIMESTAMP,
+                'expires_at': datetime.now(timezone.utc) + timedelta(days=SUMMARY_CACHE_TTL_DAYS),
+            })
+        except Exception as e:
+            structured_log.warning("⚠️ 寫入摘要快取失敗", sample_key='summary_cache_write_error', error=str(e))
+
+    def get_or_compute(self, messages: list[dict], compute) -> tuple[dict, str]:
+        """返回 (摘要結果, 來源)，來源為 'memory'、'firestore' 或 'model'"""
+        key = messages_cache_key(messages)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return dict(result), 'memory'
+
+        result = self._get_stored(key)
+        if result is not None:
+            with self._lock:
+                self.firestore_hits += 1
+            self._put_local(key, result)
+            return dict(result), 'firestore'
+
+        with self._lock:
+            self.misses += 1
+        result = compute(messages)
+        self._put_local(key, result)
+        self._store(key, result)
+        return dict(result), 'model'
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'memory_hits': self.memory_hits,
+                'firestore_hits': self.firestore_hits,
+                'misses': self.misses,
+            }
+
+
+# 模組級快取：同一實例內的所有調用共用
+summary_cache = SummaryCache()
+
+
+def summarize_messages(messages: list[dict]) -> dict:
+    """
+    萃取對話中的拖延原因、教練方法與摘要，結果經 summary_cache 快取（summarize_chat 與對話歷史壓縮共用）
+    每次調用輸出本次的來源與實例累計的命中/未命中數（按 sample_key 限速，累計值不因限速失真）；
+    在 structured_log.run() 之內時另按來源計入該次執行的 counts
+    """
+    result, source = summary_cache.get_or_compute(messages, request_summary)
+    current = structured_log.current_run()
+    if current is not None:
+        current.count(f"summary_cache_{source}")
+    structured_log.info("🗂️ 摘要快取", sample_key='summary_cache_stats', source=source, **summary_cache.stats())
+    return result
+
+
+def summary_request_body(messages: list[dict]) -> dict:
+    """
+    摘要請求的 Chat Completions 參數（即時呼叫與 Batch API 共用）
+    對話原文照送，提示詞與原 summarize_chat 逐字相同（含縮排）；正規化只用於快取 key
+    """
+    # 將對話格式化成文字
+    dialogue_text = ""
+    for m in messages:
+        role = m.get("role", "")
+        content = m.get("content", "")
+        dialogue_text += f"{role}: {content}\n"
+
+    prompt = f"""
+            請幫我從以下對話中：
+            1. 萃取所有使用者提到的「延後/拖延」原因（以 array 回傳，若無請回傳空陣列）
+            2. 萃取AI教練提出的具體建議或方法（以 array 回傳，若無請回傳空陣列）
+            3. 用一段話摘要這次對話的重點
+
+            請用以下 JSON 格式回傳：
+            {{
+            "snooze_reasons": [ ... ],
+            "coach_methods": [ ... ],
+            "summary": "..."
+            }}
+
+            對話內容如下：
+            {dialogue_text}
+            """
+
+    import system_prompt
+
+    return {
+        "model": "gpt-4.1-mini",
+        "messages": [
+            {"role": "system", "content": prompt}
+        ],
+        "response_format": system_prompt.get_summarize_schema(),
+    }
+
+
+def request_summary(messages: list[dict]) -> dict:
+    """以 gpt-4.1-mini 摘要對話（不經快取）"""
+    started_at = time.perf_counter()
+    client = get_openai_client()
+    try:
+        raw_response = client.chat.completions.with_raw_response.create(**summary_request_body(messages))
+    except Exception as e:
+        record_llm_call('summarize', "gpt-4.1-mini", started_at, error=e)
+        raise
+    response = raw_response.parse()
+    record_llm_call('summarize', "gpt-4.1-mini", started_at, (time.perf_counter() - started_at) * 1000,
+                    response.usage, openai_retries(raw_response))
+    # 解析回傳
+    message = response.choices[0].message.content
+    result = json.loads(message)
+    return result
+
+
+@https_fn.on_call(secrets=["OPENAI_APIKEY"])
+def summarize_chat(req: https_fn.CallableRequest) -> any:
+    try:
+        messages = req.data["messages"]  # list of dict: {role, content}
+        return summarize_messages(messages)
+
+    except Exception as e:
+        raise https_fn.HttpsError(
+            code=https_fn.HttpsErrorCode.UNKNOWN,
+            message="summarize_chat error",
+            details=str(e)
+        )
+
+
+def chat_messages_for_summary(chat_ref) -> list[dict]:
+    """讀取聊天的 messages 子集合，轉為摘要用的 [{role, content}]（客戶端存的 role 形如 'ChatRole.user'）"""
+    messages = []
+    for message_doc in chat_ref.collection('messages').order_by('timestamp').stream():
+        data = message_doc.to_dict()
+        messages.append({
+            'role': str(data.get('role') or '').split('.')[-1],
+            'content': data.get('content') or '',
+        })
+    return messages
+
+
+def collect_unsummarized_chats(db, uids: set | None = None, group: str | None = None, limit: int = SUMMARY_BATCH_MAX_CHATS) -> list:
+    """
+    以 collection-group 查詢找出 summary_status 為 pending 的聊天（服務端摘要失敗、批量摘要未取得結果或經 mark_pending 標記）
+    uids / group 可選，用於限定某個研究批次的用戶
+    已由其他來源寫入摘要的聊天改標記為 done，不再提交
+    """
+    chats = []
+    already_summarized = []
+    for chat_doc in stream_collection_group(db, 'chats', [('summary_status', '==', CHAT_SUMMARY_PENDING)], '__name__', site='summary_pending'):
+        if chat_doc.to_dict().get('summary'):
+            already_summarized.append(chat_doc.reference)
+            continue
+        # 路徑為 users/{uid}/.../chats/{chatId}
+        uid = chat_doc.reference.path.split('/')[1]
+        if uids is not None and uid not in uids:
+            continue
+        if group is not None and group_path_from_user_data(user_profile_cache.fetch(uid, db)) != group:
+            continue
+        chats.append(chat_doc)
+        if len(chats) >= limit:
+            break
+    if already_summarized:
+        commit_in_batches(db, [(ref.path, ref, {'summary_status': CHAT_SUMMARY_DONE}) for ref in already_summarized], merge=True)
+    return chats
+
+
+def mark_pending_summaries(db) -> int:
+    """
+    一次性回填：掃描所有已結束（result 非空）但沒有摘要、也不在批次中的聊天，標記 summary_status 為 pending
+    之後的批量提交只查詢 pending 的聊天，不再掃描全部聊天；返回標記的聊天數
+    """
+    writes = []
+    for chat_doc in stream_collection_group(db, 'chats', [('result', '!=', None)], 'result'):
+        chat_data = chat_doc.to_dict()
+        if chat_data.get('summary') or chat_data.get('summary_batch_id') or chat_data.get('summary_status'):
+            continue
+        writes.append((chat_doc.reference.path, chat_doc.reference, {'summary_status': CHAT_SUMMARY_PENDING}))
+    failures = commit_in_batches(db, writes, merge=True)
+    return len(writes) - len(failures)
+
+
+def submit_summary_batch(db, client: 'OpenAI', chat_docs: list) -> dict | None:
+    """
+    讀取聊天內容並組成 JSONL 上傳，建立一個 Batch（custom_id 為聊天文檔路徑）
+    任務記錄寫入 summary_batches/{batch_id}，並在聊天上標記 summary_batch_id 與 summary_status=batch 以免重複提交
+    沒有可摘要的聊天時返回 None
+    """
+    histories = {}
+    with ThreadPoolExecutor(max_workers=SUBCOLLECTION_FETCH_WORKERS) as executor:
+        for chat_doc, messages in zip(chat_docs, executor.map(lambda doc: chat_messages_for_summary(doc.reference), chat_docs)):
+            if messages:
+                histories[chat_doc.reference.path] = messages
+    if not histories:
+        return None
+
+    lines = [
+        json.dumps({
+            'custom_id': path,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': summary_request_body(messages),
+        }, ensure_ascii=False)
+        for path, messages in histories.items()
+    ]
+    input_file = client.files.create(file=('chat_summaries.jsonl', '\n'.join(lines).encode('utf-8')), purpose='batch')
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window=SUMMARY_BATCH_COMPLETION_WINDOW,
+    )
+
+    db.collection(SUMMARY_BATCH_COLLECTION).document(batch.id).set({
+        'batch_id': batch.id,
+        'status': batch.status,
+        'input_file_id': input_file.id,
+        'chat_paths': list(histories),
+        'request_count': len(histories),
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    })
+    mark_failures = commit_in_batches(
+        db, [(path, db.document(path), {'summary_batch_id': batch.id, 'summary_status': CHAT_SUMMARY_IN_BATCH}) for path in histories],
+        merge=True,
+    )
+    structured_log.info("📤 已提交批量摘要", batch_id=batch.id, chats=len(histories), mark_failures=len(mark_failures))
+    return {'batch_id': batch.id, 'status': batch.status, 'request_count': len(histories)}
+
+
+def claim_summary_batch(db, job_ref) -> bool:
+    """
+    在事務中認領批次的套用權：已套用過，或其他呼叫的認領仍在 SUMMARY_BATCH_APPLY_LEASE 租約內時返回 False
+    認領後 status 改為 SUMMARY_BATCH_APPLYING_STATUS，套用完成後改回批次的終態
+    """
+    @firestore.transactional
+    def claim(transaction) -> bool:
+        snapshot = job_ref.get(transaction=transaction)
+        job = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        now = datetime.now(timezone.utc)
+        claimed_at = job.get('apply_claimed_at')
+        if job.get('applied_at') is not None or (claimed_at is not None and now - claimed_at < SUMMARY_BATCH_APPLY_LEASE):
+            return False
+        transaction.set(job_ref, {
+            'status': SUMMARY_BATCH_APPLYING_STATUS,
+            'apply_claimed_at': now,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        return True
+
+    return claim(db.transaction())
+
+
+def apply_summary_batch(db, client: 'OpenAI', batch_id: str) -> dict:
+    """
+    查詢批次狀態；進入終態（完成、失敗、過期、取消）後先認領批次，再下載輸出，把摘要合併寫回各聊天文檔
+    已套用或正由其他呼叫套用的批次略過（skipped）；沒有取得結果的聊天清除 summary_batch_id 並標記為 pending，
+    下次批量時會重新提交
+    """
+    job_ref = db.collection(SUMMARY_BATCH_COLLECTION).document(batch_id)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status not in SUMMARY_BATCH_FINAL_STATUSES:
+        job_ref.set({'status': batch.status, 'updated_at': firestore.SERVER_TIMESTAMP}, merge=True)
+        return {'batch_id': batch_id, 'status': batch.status}
+    if not claim_summary_batch(db, job_ref):
+        return {'batch_id': batch_id, 'status': batch.status, 'skipped': True}
+
+    summaries = {}
+    error_count = 0
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            try:
+                if response.get('status_code') != 200:
+                    raise ValueError(f"status_code={response.get('status_code')}")
+                summaries[item['custom_id']] = json.loads(response['body']['choices'][0]['message']['content'])
+            except Exception as e:
+                error_count += 1
+                structured_log.warning("⚠️ 批量摘要輸出無法解析", sample_key='summary_batch_parse_error',
+                                       batch_id=batch_id, chat_path=item.get('custom_id'), error=str(e))
+
+    job_snapshot = job_ref.get()
+    chat_paths = (job_snapshot.to_dict() or {}).get('chat_paths', []) if job_snapshot.exists else list(summaries)
+    writes = []
+    for path in chat_paths:
+        result = summaries.get(path)
+        if result is None:
+            writes.append((path, db.document(path), {'summary_batch_id': firestore.DELETE_FIELD, 'summary_status': CHAT_SUMMARY_PENDING}))
+            continue
+        writes.append((path, db.document(path), {
+            'summary': result.get('summary', ''),
+            'snooze_reasons': result.get('snooze_reasons', []),
+            'coach_methods': result.get('coach_methods', []),
+            'summary_source': 'batch',
+            'summary_status': CHAT_SUMMARY_DONE,
+            'summary_created_at': firestore.SERVER_TIMESTAMP,
+        }))
+    write_failures = commit_in_batches(db, writes, merge=True)
+
+    outcome = {
+        'batch_id': batch_id,
+        'status': batch.status,
+        'succeeded_count': len(summaries),
+        'failed_count': len(chat_paths) - len(summaries),
+        'write_failure_count': len(write_failures),
+    }
+    job_ref.set({**outcome, 'updated_at': firestore.SERVER_TIMESTAMP, 'applied_at': firestore.SERVER_TIMESTAMP}, merge=True)
+    structured_log.info("📥 批量摘要已套用", **outcome, output_error_count=error_count)
+    return outcome
+
+
+@https_fn.on_call(secrets=["OPENAI_APIKEY"], timeout_sec=540)
+def chat_summary_batch(req: https_fn.CallableRequest) -> any:
+    """
+    以 OpenAI Batch API 批量摘要聊天（研究匯出用，費用約為逐筆呼叫 summarize_chat 的一半）
+    參數:
+    - action: 可選，"submit"（默認）提交 summary_status 為 pending 的聊天；"poll" 查詢並套用指定批次；
+      "mark_pending" 一次性掃描所有已結束但沒有摘要的聊天並標記為 pending（部署前的舊聊天）
+    - group: 可選，"experiment" 或 "control"，只提交該組用戶的聊天
+    - uids: 可選，只提交這些用戶的聊天
+    - limit: 可選，本批次最多提交的聊天數，默認為 SUMMARY_BATCH_MAX_CHATS
+    - batch_id: action 為 "poll" 時必填
+    設定環境變數 OPENAI_BASE_URL 可改為指向本地的 Batch API stub
+    僅限管理員呼叫（提交批次會產生 OpenAI 費用）
+    """
+    require_admin(req)
+    try:
+        db = get_firestore_client()
+        action = req.data.get('action', 'submit')
+        if action == 'mark_pending':
+            return {'success': True, 'marked_count': mark_pending_summaries(db)}
+
+        client = get_openai_client()
+        if action == 'poll':
+            return {'success': True, **apply_summary_batch(db, client, req.data['batch_id'])}
+
+        uids = req.data.get('uids')
+        chat_docs = collect_unsummarized_chats(
+            db,
+            uids=set(uids) if uids else None,
+            group=req.data.get('group'),
+            limit=int(req.data.get('limit', SUMMARY_BATCH_MAX_CHATS)),
+        )
+        job = submit_summary_batch(db, client, chat_docs)
+        if job is None:
+            return {'success': True, 'message': '沒有需要摘要的聊天'}
+        return {'success': True, **job}
+
+    except Exception as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+@scheduler_fn.on_schedule(schedule="*/30 * * * *", timezone="Asia/Taipei", secrets=["OPENAI_APIKEY"])
+def poll_chat_summary_batches(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    每 30 分鐘檢查進行中的批量摘要任務，進入終態的批次把摘要寫回聊天
+    套用中斷（租約逾期仍為 applying）的批次也會重新認領並套用
+    """
+    db = get_firestore_client()
+    client = get_openai_client()
+    statuses = [*SUMMARY_BATCH_ACTIVE_STATUSES, SUMMARY_BATCH_APPLYING_STATUS]
+    active_jobs = db.collection(SUMMARY_BATCH_COLLECTION).where('status', 'in', statuses).stream()
+    for job_doc in active_jobs:
+        try:
+            apply_summary_batch(db, client, job_doc.id)
+        except Exception as e:
+            structured_log.error("❌ 檢查批量摘要失敗", sample_key='summary_batch_poll_error', batch_id=job_doc.id, error=str(e))
+
+
+def chat_has_summary(chat_data: dict) -> bool:
+    """聊天已有摘要（服務端、批量或舊版客戶端 saveChatSummary 寫入）或已在批量摘要中"""
+    return bool(chat_data.get('summary') or chat_data.get('summary_source') or chat_data.get('summary_batch_id'))
+
+
+def summarize_chat_document(chat_ref) -> dict | None:
+    """
+    讀取聊天訊息並摘要，合併寫回聊天文檔（欄位與客戶端 saveChatSummary 相同）
+    已有摘要、已在批量摘要中或訊息少於兩則時略過並返回 None
+    寫回時在事務中再次檢查：摘要期間已由其他來源（例如舊版客戶端）寫入摘要時不覆蓋，返回 None
+    """
+    chat_snapshot = chat_ref.get()
+    chat_data = chat_snapshot.to_dict() if chat_snapshot.exists else {}
+    if chat_has_summary(chat_data):
+        return None
+    messages = chat_messages_for_summary(chat_ref)
+    if len(messages) < 2:
+        return None
+
+    result = summarize_messages(messages)
+
+    @firestore.transactional
+    def write_summary(transaction) -> bool:
+        snapshot = chat_ref.get(transaction=transaction)
+        if snapshot.exists and chat_has_summary(snapshot.to_dict() or {}):
+            return False
+        transaction.set(chat_ref, {
+            'summary': result.get('summary', ''),
+            'snooze_reasons': result.get('snooze_reasons', []),
+            'coach_methods': result.get('coach_methods', []),
+            'summary_source': 'server',
+            'summary_status': CHAT_SUMMARY_DONE,
+            'summary_created_at': firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        return True
+
+    return result if write_summary(get_firestore_client().transaction()) else None
+
+
+@firestore_fn.on_document_written(document="users/{uid}/{eventsCollection}/{eventId}/chats/{chatId}", secrets=["OPENAI_APIKEY"], max_instances=SUMMARY_TRIGGER_MAX_INSTANCES, concurrency=1)
+def summarize_chat_on_end(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """
+    聊天結束（result 由空變為有值）時在服務端生成摘要，隔天的 yesterday_chat 可直接讀取
+    客戶端不再呼叫 summarize_chat 生成摘要；已有摘要（含舊版客戶端寫入）的聊天略過
+    並行數由 concurrency=1 與 max_instances 限制
+    """
+    before = snapshot_data(event.data.before) or {}
+    after = snapshot_data(event.data.after)
+    if after is None or after.get('result') is None or before.get('result') is not None or chat_has_summary(after):
+        return
+
+    chat_id = event.params['chatId']
+    try:
+        if summarize_chat_document(get_firestore_client().document(event.data.after.reference.path)) is not None:
+            structured_log.info("📝 已生成聊天摘要", chat_id=chat_id)
+    except Exception as e:
+        structured_log.error("❌ 聊天摘要失敗，標記為待批量摘要", sample_key='chat_summary_error', chat_id=chat_id, error=str(e))
+        try:
+            get_firestore_client().document(event.data.after.reference.path).set({'summary_status': CHAT_SUMMARY_PENDING}, merge=True)
+        except Exception as mark_error:
+            structured_log.error("❌ 標記待批量摘要失敗", sample_key='chat_summary_mark_error', chat_id=chat_id, error=str(mark_error))
+
+
+def commit_in_batches(db, writes: list[tuple], batch_size: int = FIRESTORE_BATCH_SIZE, retries: int = FIRESTORE_BATCH_RETRIES, merge: bool = False) -> list[tuple]:
+    """
+    以 WriteBatch 分批提交 [(key, doc_ref, data)]，失敗的批次按指數退避重試
+    重試後仍失敗的批次改為逐個文檔寫入，以定位具體失敗的文檔
+    merge 為 True 時合併寫入，不覆蓋文檔中的其他欄位
+    返回寫入失敗的 [(key, error)]
+    """
+    failures = []
+    for start in range(0, len(writes), batch_size):
+        chunk = writes[start:start + batch_size]
+        for attempt in range(retries + 1):
+            batch = db.batch()
+            for _, doc_ref, data in chunk:
+                batch.set(doc_ref, data, merge=merge)
+            try:
+                batch.commit()
+                break
+            except Exception as e:
+                if attempt < retries:
+                    structured_log.warning(f"⚠️ 批量寫入失敗（第 {attempt + 1} 次），稍後重試", sample_key='batch_retry', documents=len(chunk), error=str(e))
+                    time.sleep(2 ** attempt)
+                    continue
+                structured_log.error(f"❌ 批量寫入重試 {retries} 次後仍失敗，改為逐個寫入", sample_key='batch_fallback', documents=len(chunk), error=str(e))
+                for key, doc_ref, data in chunk:
+                    try:
+                        doc_ref.set(data, merge=merge)
+                    except Exception as doc_error:
+                        failures.append((key, doc_error))
+    return failures
+
+
+def shard_uid_range(shard_index: int, shard_count: int) -> tuple[str | None, str | None]:
+    """
+    分片對應的 uid 範圍 [start, end)，按 UID_SHARD_ALPHABET 均分首字元
+    第一個分片沒有下限、最後一個分片沒有上限，任何 uid 都恰好屬於一個分片
+    """
+    if shard_count <= 1:
+        return None, None
+    bounds = [UID_SHARD_ALPHABET[len(UID_SHARD_ALPHABET) * i // shard_count] for i in range(shard_count)]
+    start = bounds[shard_index] if shard_index > 0 else None
+    end = bounds[shard_index + 1] if shard_index + 1 < shard_count else None
+    return start, end
+
+
+def iter_user_pages(db, start_after_uid: str | None = None, page_size: int = DAILY_METRICS_USER_PAGE_SIZE,
+                    start_uid: str | None = None, end_uid: str | None = None):
+    """
+    按文檔 ID 順序分頁讀取 users，可從指定 uid 之後續讀
+    start_uid / end_uid 以 __name__ 範圍查詢限定 uid 範圍 [start_uid, end_uid)，範圍外的用戶不會被讀取
+    """
+    users_ref = db.collection('users')
+    query = users_ref
+    if start_uid:
+        query = query.where('__name__', '>=', users_ref.document(start_uid))
+    if end_uid:
+        query = query.where('__name__', '<', users_ref.document(end_uid))
+    query = query.order_by('__name__').limit(page_size)
+    cursor = start_after_uid
+    while True:
+        page_query = query.start_after({'__name__': cursor}) if cursor else query
+        with firestore_stats.call_site('users'):
+            page = list(page_query.stream())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        cursor = page[-1].id
+
+
+def load_aggregation_checkpoint(log_ref, shard_index: int) -> dict:
+    """讀取 daily_metrics_execution_log/{date} 中指定分片的檢查點，不存在時返回空 dict"""
+    with firestore_stats.call_site('execution_log'):
+        log_doc = log_ref.get()
+    if not log_doc.exists:
+        return {}
+    return (log_doc.to_dict().get('shards') or {}).get(str(shard_index)) or {}
+
+
+def save_aggregation_checkpoint(log_ref, date_str: str, shard_index: int, shard_count: int, state: dict) -> None:
+    """
+    以 merge 方式寫入分片檢查點到 daily_metrics_execution_log/{date}.shards.{shard}
+    只有一個分片時，同時把計數與狀態寫到文檔頂層（與原有欄位保持一致）
+    """
+    taiwan_tz = TAIWAN_TZ
+    now = datetime.now(taiwan_tz)
+    log_data = {
+        'date': date_str,
+        'mode': DAILY_METRICS_MODE,
+        'workers': DAILY_METRICS_WORKERS,
+        'shard_count': shard_count,
+        'timezone': 'Asia/Taipei',
+        'shards': {str(shard_index): {**state, 'updated_at': now}},
+    }
+    if shard_count <= 1:
+        log_data.update({key: value for key, value in state.items() if key != 'cursor'})
+        log_data['executed_at'] = now
+    with firestore_stats.call_site('execution_log'):
+        log_ref.set(log_data, merge=True)
+
+
+def scan_chat_summaries(db, target_date: datetime) -> dict:
+    """以 collection-group 查詢讀取指定日期產生的聊天摘要，返回 {uid: [摘要, ...]}（按摘要時間排序）"""
+    start_of_day = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_utc = start_of_day.astimezone(timezone.utc)
+    end_utc = (start_of_day + timedelta(days=1)).astimezone(timezone.utc)
+
+    summaries: dict[str, list[str]] = {}
+    filters = [('summary_created_at', '>=', start_utc), ('summary_created_at', '<', end_utc)]
+    for chat_doc in stream_collection_group(db, 'chats', filters, 'summary_created_at', site='chat_summaries'):
+        summary = chat_doc.to_dict().get('summary')
+        if summary:
+            # 路徑為 users/{uid}/.../chats/{chatId}
+            summaries.setdefault(chat_doc.reference.path.split('/')[1], []).append(summary)
+    return summaries
+
+
+def format_chat_summaries(summaries: list[str]) -> str:
+    """多則聊天摘要依序編號合併（與客戶端 getCompletion 的格式相同）"""
+    if len(summaries) == 1:
+        return summaries[0]
+    return "\n\n".join(f"聊天{i + 1}: {summary}" for i, summary in enumerate(summaries))
+
+
+def format_daily_report(report: dict) -> str:
+    """日報轉為摘要文字（與客戶端 getYesterdayData 的格式相同），並附上延遲與未完成原因"""
+    parts = []
+    if report.get('notes'):
+        parts.append(f"心得: {report['notes']}")
+    parts.append(f"閱讀有用度: {report.get('readingHelpfulness', 3)}/5")
+    parts.append(f"單字有用度: {report.get('vocabHelpfulness', 3)}/5")
+    parts.append(f"學習滿意度: {report.get('overallSatisfaction', 3)}/5")
+    parts.append(f"明日信心: {report.get('tomorrowConfidence', 3)}/5")
+    if report.get('delayReasons'):
+        parts.append(f"延遲原因: {', '.join(report['delayReasons'])}")
+    if report.get('incompleteReasons'):
+        parts.append(f"未完成原因: {', '.join(report['incompleteReasons'])}")
+    return "; ".join(parts)
+
+
+def format_metrics_summary(metrics: dict) -> str:
+    """每日指標轉為一句話摘要"""
+    return (
+        f"任務完成 {metrics.get('event_complete_count', 0)}/{metrics.get('event_total_count', 0)}、"
+        f"逾期 {metrics.get('event_overdue_count', 0)}；"
+        f"教練對話 {metrics.get('chat_total_count', 0)} 次（開始 {metrics.get('chat_start_count', 0)}、延後 {metrics.get('chat_snooze_count', 0)}）；"
+        f"複習 {metrics.get('review_count', 0)} 次"
+    )
+
+
+def build_coach_context(db, uid: str, date_str: str, chat_summaries: list[str], metrics: dict) -> dict:
+    """
+    組合隔天對話用的教練上下文：前一天的聊天摘要、日報摘要與指標
+    聊天摘要在此先按 token 上限壓縮，不在使用者的第一輪對話中才生成
+    metrics 為空（當天指標尚未寫入）時日報摘要不附帶指標
+    """
+    with firestore_stats.call_site('daily_report'):
+        report_docs = list(
+            db.collection('users').document(uid).collection('daily_metrics').document(date_str)
+            .collection('daily_report').limit(1).stream()
+        )
+    daily_parts = []
+    if report_docs:
+        daily_parts.append(format_daily_report(report_docs[0].to_dict()))
+    if metrics:
+        daily_parts.append(f"昨日數據: {format_metrics_summary(metrics)}")
+
+    return {
+        'yesterday_chat': compact_yesterday_chat(format_chat_summaries(chat_summaries), wait=True) if chat_summaries else '',
+        'daily_summary': "; ".join(daily_parts),
+        'metrics': {name: metrics.get(name, 0) for name in COACH_CONTEXT_METRIC_NAMES},
+        'source_date': date_str,
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }
+
+
+def vocab_study_from_session(event_data: dict, session_data: dict) -> dict | None:
+    """把 vocab / review 會話文檔轉為 vocab_review 的學習紀錄；不是單字任務或沒有看過任何卡片時返回 None"""
+    title = event_data.get('title', '')
+    week, day = parse_week_day_from_title(title)
+    start_time = session_data.get('startTime')
+    if week is None or 'vocab' not in title.lower() or not start_time:
+        return None
+    # cardDwellTimes 的 key 為卡片在 items_shuffled 中的位置，停留時間大於 0 才算看過
+    dwell_times = session_data.get('cardDwellTimes')
+    positions = None
+    if dwell_times is not None:
+        positions = {int(index) for index, dwell_ms in dwell_times.items() if dwell_ms}
+        if not positions:
+            return None
+    return {
+        'week': week,
+        'day': day,
+        'date': start_time.astimezone(TAIWAN_TZ).date(),
+        'positions': positions,
+    }
 
-    try:
-        task = req.data["taskTitle"]
-        task_description = req.data.get("taskDescription")  # 新增描述參數
-        dialogues = req.data["dialogues"]
-        start_time = req.data["startTime"]
-        current_turn = req.data.get("currentTurn", 0)
-        day_number = req.data.get("dayNumber")  # 新增dayNumber參數
-        scheduled_duration_min = req.data.get("taskDurationMin")  # 新增：任務時長（分鐘）
-        
-        # 获取前一天的数据
-        yesterday_chat = req.data.get("yesterdayChat", "")
-        yesterday_status = req.data.get("yesterdayStatus", "")
-
-        messages = build_prompt(
-            task,
-            dialogues,
-            start_time,
-            current_turn,
-            task_description,
-            yesterday_chat,
-            yesterday_status,
-            day_number,
-            scheduled_duration_min,
-        )
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=messages,
-            response_format=system_prompt.get_response_schema()
-        )
-        message = response.choices[0].message.content
-        answer = json.loads(message)
-        
-        # 🎯 實驗數據收集：添加token使用量信息
-        if hasattr(response, 'usage') and response.usage:
-            answer['token_usage'] = {
-                'prompt_tokens': response.usage.prompt_tokens,
-                'completion_tokens': response.usage.completion_tokens,
-                'total_tokens': response.usage.total_tokens
-            }
-        
-        return answer
 
-    except Exception as e:
-        raise https_fn.HttpsError(code=https_fn.HttpsErrorCode.UNKNOWN,
-                                  message="Error",
-                                  details=e)
+def scan_vocab_studies(db, start_utc: datetime, end_utc: datetime) -> dict:
+    """
+    以 collection-group 查詢讀取時間範圍內所有用戶的 vocab / review 會話，返回 {uid: [學習紀錄]}
+    會話所屬事件的標題以 get_all 批量讀取，每個事件只讀一次
+    """
+    sessions = []
+    filters = [('startTime', '>=', start_utc), ('startTime', '<', end_utc)]
+    for collection_id in VOCAB_SESSION_COLLECTIONS:
+        sessions += list(stream_collection_group(db, collection_id, filters, 'startTime', site='vocab_sessions'))
 
+    event_refs = list({session.reference.parent.parent.path: session.reference.parent.parent for session in sessions}.values())
+    events = {}
+    with firestore_stats.call_site('vocab_sessions'):
+        for i in range(0, len(event_refs), FIRESTORE_BATCH_SIZE):
+            for event_doc in db.get_all(event_refs[i:i + FIRESTORE_BATCH_SIZE], field_paths=['title']):
+                if event_doc.exists:
+                    events[event_doc.reference.path] = event_doc.to_dict()
 
-@https_fn.on_call(secrets=["OPENAI_APIKEY"])
-def summarize_chat(req: https_fn.CallableRequest) -> any:
-    client = OpenAI(api_key=os.environ.get("OPENAI_APIKEY"))
+    studies: dict[str, list[dict]] = {}
+    for session in sessions:
+        event_data = events.get(session.reference.parent.parent.path)
+        study = vocab_study_from_session(event_data, session.to_dict()) if event_data else None
+        if study is not None:
+            # 路徑為 users/{uid}/{事件集合}/{eventId}/{vocab|review}/{sessionId}
+            studies.setdefault(session.reference.path.split('/')[1], []).append(study)
+    return studies
 
-    try:
-        messages = req.data["messages"]  # list of dict: {role, content}
-        # 將對話格式化成文字
-        dialogue_text = ""
-        for m in messages:
-            role = m.get("role", "")
-            content = m.get("content", "")
-            dialogue_text += f"{role}: {content}\n"
-
-        prompt = f"""
-            請幫我從以下對話中：
-            1. 萃取所有使用者提到的「延後/拖延」原因（以 array 回傳，若無請回傳空陣列）
-            2. 萃取AI教練提出的具體建議或方法（以 array 回傳，若無請回傳空陣列）
-            3. 用一段話摘要這次對話的重點
 
-            請用以下 JSON 格式回傳：
-            {{
-            "snooze_reasons": [ ... ],
-            "coach_methods": [ ... ],
-            "summary": "..."
-            }}
+def load_user_vocab_studies(db, uid: str, start_utc: datetime, end_utc: datetime) -> list[dict]:
+    """讀取單一用戶時間範圍內的單字學習紀錄（夜間任務尚未產生複習佇列時使用）"""
+    studies = []
+    for collection_name in LIVE_METRICS_EVENT_COLLECTIONS:
+        events_ref = db.collection('users').document(uid).collection(collection_name)
+        events_query = events_ref.where('scheduledStartTime', '>=', start_utc).where('scheduledStartTime', '<', end_utc)
+        for event_doc in events_query.stream():
+            event_data = event_doc.to_dict()
+            if 'vocab' not in event_data.get('title', '').lower():
+                continue
+            for collection_id in VOCAB_SESSION_COLLECTIONS:
+                for session_doc in event_doc.reference.collection(collection_id).stream():
+                    study = vocab_study_from_session(event_data, session_doc.to_dict())
+                    if study is not None:
+                        studies.append(study)
+    return studies
 
-            對話內容如下：
-            {dialogue_text}
-            """
 
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": prompt}
-            ],
-            response_format = system_prompt.get_summarize_schema()
-        )
-        # 解析回傳
-        message = response.choices[0].message.content
-        result = json.loads(message)
-        return result
+def build_vocab_review_document(studies: list[dict], as_of: datetime) -> dict:
+    """計算 as_of 當天（台灣時間）的單字複習佇列，返回要寫入 vocab_review/{日期} 的文檔"""
+    import vocab_review
 
-    except Exception as e:
-        raise https_fn.HttpsError(
-            code=https_fn.HttpsErrorCode.UNKNOWN,
-            message="summarize_chat error",
-            details=str(e)
-        )
+    queue = vocab_review.build_review_queue(studies, as_of.date())
+    return {
+        **queue,
+        'date': as_of.strftime('%Y%m%d'),
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }
 
 
-@scheduler_fn.on_schedule(schedule="0 1 * * *", timezone="Asia/Taipei", timeout_sec=540) 
-def daily_metrics_aggregation(event: scheduler_fn.ScheduledEvent) -> None:
+def run_daily_metrics_aggregation(shard_index: int = 0, shard_count: int = 1, force: bool = False) -> None:
     """
-    每日數據聚合函數：計算前一天的所有指標並存儲到 daily_metrics collection
+    計算前一天屬於指定分片的所有用戶指標並存儲到 daily_metrics collection
+    按 uid 分頁處理，每頁完成後把游標寫入檢查點；重試時從游標續跑，已完成的分片直接跳過
+    force 為 True 時忽略檢查點，從頭重新計算（用於刻意重跑已完成的日期）
+    日誌經 structured_log：逐用戶的錯誤按類型限速，結束時輸出一筆含計數與 Firestore 用量的摘要記錄
     """
-    try:
-        print("🚀 每日數據聚合開始執行...")
-        
-        # 計算前一天的日期 (台灣時區)
-        taiwan_tz = pytz.timezone('Asia/Taipei')
-        yesterday = datetime.now(taiwan_tz) - timedelta(days=1)
-        date_str = yesterday.strftime('%Y%m%d')
-        
-        print(f"📅 處理日期: {date_str}")
-        
-        # 獲取所有使用者 - 添加延遲等待初始化
-        print("🔄 初始化 Firestore 客戶端...")
-        import time
-        time.sleep(2)  # 等待2秒確保初始化完成
-        
-        db = get_firestore_client()
-        users_ref = db.collection('users')
-        
-        print("🔍 嘗試獲取用戶列表...")
-        
-        # 嘗試多種方法獲取用戶
+    started_at = time.monotonic()
+    # Firestore 用量：本次執行的增量加上重試前已記錄在檢查點中的用量
+    firestore_before = firestore_stats.STATS.snapshot()
+    previous_firestore_usage = None
+    shard_label = f"{shard_index + 1}/{shard_count}"
+    
+    # 計算前一天的日期 (台灣時區)
+    taiwan_tz = TAIWAN_TZ
+    yesterday = datetime.now(taiwan_tz) - timedelta(days=1)
+    date_str = yesterday.strftime('%Y%m%d')
+    
+    processed_count = 0
+    error_count = 0
+    write_error_count = 0
+    write_failures = []
+    live_drift_count = 0
+    cursor = None
+    log_ref = None
+    
+    def firestore_usage() -> dict:
+        return firestore_stats.merge_usage(
+            previous_firestore_usage, firestore_stats.usage_delta(firestore_before, firestore_stats.STATS.snapshot())
+        )
+    
+    with structured_log.run('daily_metrics_aggregation', date=date_str, shard=shard_label) as run_log:
         try:
-            # 方法1：直接get()
-            users_docs = users_ref.get()
-            users_list = list(users_docs)
-            print(f"📊 方法1 - 找到 {len(users_list)} 個用戶")
+            structured_log.info("🚀 每日數據聚合開始執行", mode=DAILY_METRICS_MODE)
             
-            # 方法2：使用stream()
-            try:
-                users_stream = list(users_ref.stream())
-                print(f"📊 方法2 - stream() 找到 {len(users_stream)} 個用戶")
-            except Exception as stream_error:
-                print(f"❌ stream() 方法失敗: {stream_error}")
+            db = get_firestore_client()
+            log_ref = db.collection('daily_metrics_execution_log').document(date_str)
             
-            # 方法3：嘗試查詢所有collection
-            try:
-                all_collections = db.collections()
-                collection_names = [col.id for col in all_collections]
-                print(f"🗂️ 數據庫中的所有collections: {collection_names}")
-            except Exception as col_error:
-                print(f"❌ 獲取collections失敗: {col_error}")
+            # 讀取檢查點：重試時從上次的游標續跑；force 時從頭重跑
+            checkpoint = {} if force else load_aggregation_checkpoint(log_ref, shard_index)
+            if checkpoint.get('status') == 'completed':
+                structured_log.info("⏭️ 分片當日已完成，略過（需重跑請使用 force）", completed_at=checkpoint.get('updated_at'))
+                run_log.set(status='skipped')
+                return
+            if force:
+                structured_log.info("🔁 忽略檢查點，強制重新計算")
+            cursor = checkpoint.get('cursor')
+            processed_count = checkpoint.get('processed_count', 0)
+            error_count = checkpoint.get('error_count', 0)
+            write_error_count = checkpoint.get('write_error_count', 0)
+            write_failures = checkpoint.get('write_failures', [])
+            live_drift_count = checkpoint.get('live_drift_count', 0)
+            previous_firestore_usage = checkpoint.get('firestore_usage')
+            if cursor:
+                structured_log.info("♻️ 從檢查點續跑", cursor=cursor, processed_count=processed_count, error_count=error_count)
+            
+            # collection_group 模式：整天的數據只掃描一次，每頁用戶共用分桶結果
+            collection_group_buckets = None
+            if DAILY_METRICS_MODE == 'collection_group':
+                collection_group_buckets = scan_daily_collection_groups(target_date=yesterday, db=db)
+            precomputed_metrics = {}
+            
+            today = yesterday + timedelta(days=1)
+            today_str = today.strftime('%Y%m%d')
+            
+            # 單字學習紀錄同樣只掃描一次，用於預先計算今天的複習佇列
+            review_end_utc = today.replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc)
+            vocab_studies = scan_vocab_studies(db, review_end_utc - VOCAB_REVIEW_LOOKBACK, review_end_utc)
+            
+            def process_user(uid: str) -> tuple[dict, dict | None]:
+                with structured_log.context(uid=uid):
+                    metrics = precomputed_metrics.get(uid)
+                    if metrics is None:
+                        metrics = calculate_daily_metrics(uid=uid, target_date=yesterday, db=db)
+                    try:
+                        review_queue = build_vocab_review_document(vocab_studies.get(uid, []), today)
+                    except Exception as review_error:
+                        # 複習佇列失敗時，vocab_review_queue 會在用戶請求時即時計算
+                        structured_log.warning("⚠️ 單字複習佇列計算失敗", sample_key='vocab_review_error', error=str(review_error))
+                        run_log.count('vocab_review_errors')
+                        review_queue = None
+                    return metrics, review_queue
+            
+            start_uid, end_uid = shard_uid_range(shard_index, shard_count)
+            for page in iter_user_pages(db, start_after_uid=cursor, start_uid=start_uid, end_uid=end_uid):
+                user_profile_cache.seed(page)
+                run_log.count('pages')
+                run_log.count('users_listed', len(page))
+                structured_log.debug("📊 分頁用戶", page_users=len(page))
                 
-        except Exception as users_error:
-            print(f"❌ 獲取用戶列表時發生錯誤: {users_error}")
-            print(f"🔍 錯誤類型: {type(users_error).__name__}")
-            print(f"🔍 錯誤詳情: {str(users_error)}")
-            raise
-        
-        processed_count = 0
-        error_count = 0
-        
-        for user_doc in users_list:
-            uid = user_doc.id
-            try:
-                print(f"🔄 處理用戶: {uid}")
-                metrics = calculate_daily_metrics(uid=uid, target_date=yesterday, db=db)
+                if DAILY_METRICS_MODE == 'incremental':
+                    precomputed_metrics, page_drift_count = finalize_live_metrics(db, page, yesterday)
+                    live_drift_count += page_drift_count
+                    run_log.count('live_finalized', len(precomputed_metrics))
+                elif collection_group_buckets is not None:
+                    precomputed_metrics = metrics_from_collection_groups(collection_group_buckets, page)
                 
-                # 儲存到 daily_metrics（使用新的數據結構）
-                try:
-                    # 新結構：直接存到 users/{uid}/daily_metrics/{date}
-                    metrics_ref = db.collection('users').document(uid).collection('daily_metrics').document(date_str)
-                    metrics_ref.set(metrics)
-                    print(f"✅ 用戶 {uid} 的 {date_str} 日報數據已生成（新結構）")
-                except Exception as save_error:
-                    print(f"新結構保存失敗: {save_error}")
-                processed_count += 1
+                writes = []
+                for uid, result, user_error in run_per_user([user_doc.id for user_doc in page], process_user):
+                    if user_error is None:
+                        processed_count += 1
+                        metrics, review_queue = result
+                        # 新結構：直接存到 users/{uid}/daily_metrics/{date}
+                        metrics_ref = db.collection('users').document(uid).collection('daily_metrics').document(date_str)
+                        writes.append((uid, metrics_ref, metrics))
+                        if review_queue is not None:
+                            review_ref = db.collection('users').document(uid).collection(VOCAB_REVIEW_COLLECTION).document(today_str)
+                            writes.append((f"{uid}/{VOCAB_REVIEW_COLLECTION}", review_ref, review_queue))
+                    else:
+                        structured_log.error("❌ 處理用戶時發生錯誤", sample_key='user_error', uid=uid, error=str(user_error))
+                        error_count += 1
                 
-            except Exception as user_error:
-                print(f"❌ 處理用戶 {uid} 時發生錯誤: {user_error}")
-                error_count += 1
-                continue
+                # 儲存到 daily_metrics：整頁結果分批寫入
+                with firestore_stats.call_site('daily_metrics_writes'):
+                    failures = commit_in_batches(db, writes)
+                for uid, save_error in failures:
+                    structured_log.error("❌ 新結構保存失敗", sample_key='write_error', uid=uid, error=str(save_error))
+                    if len(write_failures) < MAX_LOGGED_WRITE_FAILURES:
+                        write_failures.append({'uid': uid, 'error': str(save_error)})
+                write_error_count += len(failures)
+                run_log.count('documents_written', len(writes) - len(failures))
+                
+                # 保存檢查點
+                cursor = page[-1].id
+                save_aggregation_checkpoint(log_ref, date_str, shard_index, shard_count, {
+                    'cursor': cursor,
+                    'processed_count': processed_count,
+                    'error_count': error_count,
+                    'write_error_count': write_error_count,
+                    'write_failures': write_failures,
+                    'live_drift_count': live_drift_count,
+                    'firestore_usage': firestore_usage(),
+                    'error': None,
+                    'status': 'running',
+                })
                 
-        print(f"🎯 每日數據聚合完成: {date_str}, 成功: {processed_count}, 失敗: {error_count}")
+                if time.monotonic() - started_at > DAILY_METRICS_TIME_BUDGET_SEC:
+                    raise TimeoutError(f"超出 {DAILY_METRICS_TIME_BUDGET_SEC} 秒時間預算，已保存檢查點 {cursor}，等待重試續跑")
+                    
+            # 記錄執行結果到Firestore
+            save_aggregation_checkpoint(log_ref, date_str, shard_index, shard_count, {
+                'cursor': cursor,
+                'processed_count': processed_count,
+                'error_count': error_count,
+                'write_error_count': write_error_count,
+                'write_failures': write_failures,
+                'live_drift_count': live_drift_count,
+                'firestore_usage': firestore_usage(),
+                'user_cache': user_profile_cache.stats(),
+                'error': None,
+                'status': 'completed',
+            })
+            
+        except Exception as e:
+            # 記錄失敗到Firestore（保留游標，供重試續跑）
+            try:
+                if log_ref is None:
+                    log_ref = get_firestore_client().collection('daily_metrics_execution_log').document(date_str)
+                save_aggregation_checkpoint(log_ref, date_str, shard_index, shard_count, {
+                    'cursor': cursor,
+                    'processed_count': processed_count,
+                    'error_count': error_count,
+                    'write_error_count': write_error_count,
+                    'write_failures': write_failures,
+                    'live_drift_count': live_drift_count,
+                    'firestore_usage': firestore_usage(),
+                    'error': str(e),
+                    'status': 'failed',
+                })
+            except:
+                pass  # 如果记录失败也失败，不要抛出异常
+            
+            raise
         
-        # 記錄執行結果到Firestore
-        execution_log_ref = db.collection('daily_metrics_execution_log').document(date_str)
-        execution_log_ref.set({
+        finally:
+            # 每次執行只輸出一筆摘要記錄（由 structured_log.run 在結束時輸出）
+            run_log.set(
+                processed_count=processed_count,
+                error_count=error_count,
+                write_error_count=write_error_count,
+                live_drift_count=live_drift_count,
+                firestore_usage=firestore_usage()['total'],
+                user_cache=user_profile_cache.stats(),
+            )
+
+
+@scheduler_fn.on_schedule(schedule="0 1 * * *", timezone="Asia/Taipei", timeout_sec=540, retry_count=DAILY_METRICS_RETRY_COUNT)
+def daily_metrics_aggregation(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    每日數據聚合函數：計算前一天的所有指標並存儲到 daily_metrics collection
+    分片數大於 1 時只處理第 1 個分片，其餘分片由 daily_metrics_aggregation_shard_{n} 處理
+    """
+    run_daily_metrics_aggregation(shard_index=0, shard_count=DAILY_METRICS_SHARDS)
+
+
+def make_shard_aggregation(shard_index: int):
+    """為指定分片生成獨立的排程函數 daily_metrics_aggregation_shard_{shard_index}"""
+    def shard_aggregation(event: scheduler_fn.ScheduledEvent) -> None:
+        run_daily_metrics_aggregation(shard_index=shard_index, shard_count=DAILY_METRICS_SHARDS)
+
+    # 部署時以函數名稱作為入口點，必須與模組屬性名稱一致
+    shard_aggregation.__name__ = shard_aggregation.__qualname__ = f"daily_metrics_aggregation_shard_{shard_index}"
+    return scheduler_fn.on_schedule(
+        schedule="0 1 * * *", timezone="Asia/Taipei", timeout_sec=540, retry_count=DAILY_METRICS_RETRY_COUNT,
+    )(shard_aggregation)
+
+
+for _shard_index in range(1, DAILY_METRICS_SHARDS):
+    globals()[f"daily_metrics_aggregation_shard_{_shard_index}"] = make_shard_aggregation(_shard_index)
+
+
+def run_coach_context_refresh() -> dict:
+    """
+    為今天的教練對話產生 users/{uid}/coach_context/{今天}：前一天的聊天摘要（需要時呼叫 LLM 壓縮）、日報與每日指標
+    指標讀取聚合任務已寫入的 daily_metrics/{昨天}，不重新計算；與聚合任務分開執行，LLM 延遲不佔用聚合的時間預算
+    """
+    yesterday = datetime.now(TAIWAN_TZ) - timedelta(days=1)
+    date_str = yesterday.strftime('%Y%m%d')
+    today_str = (yesterday + timedelta(days=1)).strftime('%Y%m%d')
+
+    with structured_log.run('coach_context_refresh', date=date_str) as run_log:
+        db = get_firestore_client()
+        # 前一天的聊天摘要只掃描一次
+        chat_summaries = scan_chat_summaries(db, yesterday)
+
+        for page in iter_user_pages(db):
+            run_log.count('users_listed', len(page))
+            metrics_refs = [user_doc.reference.collection('daily_metrics').document(date_str) for user_doc in page]
+            stored_metrics = {}
+            with firestore_stats.call_site('daily_metrics'):
+                for i in range(0, len(metrics_refs), FIRESTORE_BATCH_SIZE):
+                    for metrics_doc in db.get_all(metrics_refs[i:i + FIRESTORE_BATCH_SIZE], field_paths=list(COACH_CONTEXT_METRIC_NAMES)):
+                        if metrics_doc.exists:
+                            # 路徑為 users/{uid}/daily_metrics/{date}
+                            stored_metrics[metrics_doc.reference.path.split('/')[1]] = metrics_doc.to_dict()
+
+            def process_user(uid: str) -> dict:
+                with structured_log.context(uid=uid):
+                    if uid not in stored_metrics:
+                        run_log.count('metrics_missing')
+                    return build_coach_context(db, uid, date_str, chat_summaries.get(uid, []), stored_metrics.get(uid, {}))
+
+            writes = []
+            for uid, coach_context, user_error in run_per_user([user_doc.id for user_doc in page], process_user):
+                if user_error is None:
+                    context_ref = db.collection('users').document(uid).collection(COACH_CONTEXT_COLLECTION).document(today_str)
+                    writes.append((uid, context_ref, coach_context))
+                else:
+                    # 教練上下文失敗時，教練函數會退回使用客戶端提供的數據
+                    structured_log.warning("⚠️ 教練上下文生成失敗", sample_key='coach_context_error', uid=uid, error=str(user_error))
+                    run_log.count('coach_context_errors')
+
+            with firestore_stats.call_site('coach_context_writes'):
+                failures = commit_in_batches(db, writes)
+            for uid, save_error in failures:
+                structured_log.error("❌ 教練上下文保存失敗", sample_key='write_error', uid=uid, error=str(save_error))
+            run_log.count('documents_written', len(writes) - len(failures))
+            run_log.count('write_errors', len(failures))
+
+        return run_log.summary_record()
+
+
+@scheduler_fn.on_schedule(schedule="0 2 * * *", timezone="Asia/Taipei", timeout_sec=540, secrets=["OPENAI_APIKEY"])
+def coach_context_refresh(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    每日在指標聚合（01:00）之後產生今天的教練上下文；需要 OpenAI 金鑰壓縮聊天摘要，
+    因此與不需要金鑰的 daily_metrics_aggregation 分開部署
+    """
+    run_coach_context_refresh()
+
+
+def run_llm_telemetry_rollup(date_str: str | None = None) -> dict:
+    """
+    彙總一天（預設為前一天，台灣時區）的 LLM 呼叫遙測，寫入 llm_telemetry_daily/{date}
+    內容為各端點、各分組的 p50/p95 延遲、錯誤與重試次數、每個會話的 token 用量，以及最慢的幾次呼叫
+    """
+    if date_str is None:
+        date_str = (datetime.now(TAIWAN_TZ) - timedelta(days=1)).strftime('%Y%m%d')
+    db = get_firestore_client()
+    with firestore_stats.call_site(LLM_TELEMETRY_COLLECTION):
+        events = [doc.to_dict() for doc in db.collection(LLM_TELEMETRY_COLLECTION).where('date', '==', date_str).stream()]
+    summary = llm_telemetry.rollup(events, slowest=LLM_TELEMETRY_SLOWEST)
+    with firestore_stats.call_site(LLM_TELEMETRY_DAILY_COLLECTION):
+        db.collection(LLM_TELEMETRY_DAILY_COLLECTION).document(date_str).set({
+            **summary,
             'date': date_str,
-            'executed_at': datetime.now(taiwan_tz),
-            'processed_count': processed_count,
-            'error_count': error_count,
-            'status': 'completed',
-            'timezone': 'Asia/Taipei'
+            'updated_at': firestore.SERVER_TIMESTAMP,
         })
-        
-    except Exception as e:
-        print(f"❌ 每日數據聚合失敗: {e}")
-        
-        # 記錄失敗到Firestore
-        try:
-            taiwan_tz = pytz.timezone('Asia/Taipei')
-            yesterday = datetime.now(taiwan_tz) - timedelta(days=1)
-            date_str = yesterday.strftime('%Y%m%d')
-            
-            db = get_firestore_client()
-            execution_log_ref = db.collection('daily_metrics_execution_log').document(date_str)
-            execution_log_ref.set({
-                'date': date_str,
-                'executed_at': datetime.now(taiwan_tz),
-                'error': str(e),
-                'status': 'failed',
-                'timezone': 'Asia/Taipei'
-            })
-        except:
-            pass  # 如果记录失败也失败，不要抛出异常
-        
-        raise
+    structured_log.info("📊 LLM 遙測彙總", date=date_str, calls=summary['calls'], endpoints=sorted(summary['endpoints']))
+    return summary
+
+
+@scheduler_fn.on_schedule(schedule="30 1 * * *", timezone="Asia/Taipei")
+def llm_telemetry_rollup(event: scheduler_fn.ScheduledEvent) -> None:
+    """每日彙總前一天的 LLM 呼叫延遲與 token 用量（llm_telemetry -> llm_telemetry_daily）"""
+    run_llm_telemetry_rollup()
 
 
 @https_fn.on_call()
@@ -350,7 +1820,7 @@ def test_users_access(req: https_fn.CallableRequest) -> any:
         db = get_firestore_client()
         users_ref = db.collection('users')
         
-        print("🧪 測試函數：嘗試獲取用戶列表...")
+        structured_log.info("🧪 測試函數：嘗試獲取用戶列表")
         
         # 嘗試多種方法
         results = {}
@@ -414,9 +1884,11 @@ def manual_daily_metrics(req: https_fn.CallableRequest) -> any:
     參數: 
     - date: 可選，格式 "YYYY-MM-DD"，默認為昨天
     - uid: 可選，指定用戶ID，默認為所有用戶
+    - mode: 可選，"per_user"、"collection_group" 或 "incremental"，默認為 DAILY_METRICS_MODE
+    - workers: 可選，並行處理用戶的線程數，限制在 1 到 DAILY_METRICS_WORKERS 之間，默認為 DAILY_METRICS_WORKERS
     """
     try:
-        taiwan_tz = pytz.timezone('Asia/Taipei')
+        taiwan_tz = TAIWAN_TZ
         
         # 解析日期參數
         date_param = req.data.get('date')
@@ -430,6 +1902,16 @@ def manual_daily_metrics(req: https_fn.CallableRequest) -> any:
         # 解析用戶參數
         target_uid = req.data.get('uid')
         
+        # 解析聚合模式（僅對所有用戶生效）
+        mode = req.data.get('mode', DAILY_METRICS_MODE)
+        
+        # 解析線程數：限制在 [1, DAILY_METRICS_WORKERS]，無法解析時使用默認值
+        try:
+            workers = int(req.data.get('workers', DAILY_METRICS_WORKERS))
+        except (TypeError, ValueError):
+            workers = DAILY_METRICS_WORKERS
+        workers = min(max(workers, 1), DAILY_METRICS_WORKERS)
+        
         if target_uid:
             # 處理單個用戶
             db = get_firestore_client()
@@ -442,7 +1924,7 @@ def manual_daily_metrics(req: https_fn.CallableRequest) -> any:
                 metrics_ref.set(metrics)
                 message = f'用戶 {target_uid} ({group_path}組) 的 {date_str} 數據已生成'
             except Exception as save_error:
-                print(f"新結構保存失敗，嘗試舊結構: {save_error}")
+                structured_log.warning("新結構保存失敗，嘗試舊結構", uid=target_uid, error=str(save_error))
                 metrics_ref = db.collection('users').document(target_uid).collection('daily_metrics').document(date_str)
                 metrics_ref.set(metrics)
                 message = f'用戶 {target_uid} 的 {date_str} 數據已生成（舊結構）'
@@ -457,36 +1939,50 @@ def manual_daily_metrics(req: https_fn.CallableRequest) -> any:
             db = get_firestore_client()
             users_ref = db.collection('users')
             
-            print("🔍 手動測試：嘗試獲取用戶列表...")
+            structured_log.info("🔍 手動測試：嘗試獲取用戶列表")
             users_docs = users_ref.get()
             users = list(users_docs)
-            print(f"📊 手動測試：找到 {len(users)} 個用戶")
+            user_profile_cache.seed(users)
+            structured_log.info("📊 手動測試：找到用戶", users=len(users))
             results = []
             
-            for user_doc in users:
-                uid = user_doc.id
-                try:
+            precomputed_metrics = {}
+            if mode == 'collection_group':
+                precomputed_metrics = calculate_all_daily_metrics(target_date=target_date, user_docs=users, db=db)
+            elif mode == 'incremental':
+                precomputed_metrics, _ = finalize_live_metrics(db, users, target_date)
+            
+            def process_user(uid: str) -> dict:
+                metrics = precomputed_metrics.get(uid)
+                if metrics is None:
                     metrics = calculate_daily_metrics(uid=uid, target_date=target_date, db=db)
-                    
-                    # 使用新的數據結構保存
-                    try:
-                        group_path = get_user_group_path(uid, db)
-                        metrics_ref = db.collection('users').document(uid).collection(group_path).document('data').collection('daily_metrics').document(date_str)
-                        metrics_ref.set(metrics)
-                        status_msg = f'success ({group_path}組)'
-                    except Exception as save_error:
-                        print(f"用戶 {uid} 新結構保存失敗，嘗試舊結構: {save_error}")
-                        metrics_ref = db.collection('users').document(uid).collection('daily_metrics').document(date_str)
-                        metrics_ref.set(metrics)
-                        status_msg = 'success (舊結構)'
-                    
-                    results.append({
-                        'uid': uid,
-                        'status': status_msg,
-                        'metrics': metrics
-                    })
-                    
-                except Exception as user_error:
+                
+                # 使用新的數據結構保存（超時的用戶不再寫入）
+                try:
+                    group_path = get_user_group_path(uid, db)
+                    metrics_ref = db.collection('users').document(uid).collection(group_path).document('data').collection('daily_metrics').document(date_str)
+                    check_user_cancelled()
+                    metrics_ref.set(metrics)
+                    status_msg = f'success ({group_path}組)'
+                except TimeoutError:
+                    raise
+                except Exception as save_error:
+                    structured_log.warning("新結構保存失敗，嘗試舊結構", sample_key='manual_save_fallback', uid=uid, error=str(save_error))
+                    check_user_cancelled()
+                    metrics_ref = db.collection('users').document(uid).collection('daily_metrics').document(date_str)
+                    metrics_ref.set(metrics)
+                    status_msg = 'success (舊結構)'
+                
+                return {
+                    'uid': uid,
+                    'status': status_msg,
+                    'metrics': metrics
+                }
+            
+            for uid, result, user_error in run_per_user([user_doc.id for user_doc in users], process_user, max_workers=workers):
+                if user_error is None:
+                    results.append(result)
+                else:
                     results.append({
                         'uid': uid,
                         'status': 'error',
@@ -506,38 +2002,423 @@ def manual_daily_metrics(req: https_fn.CallableRequest) -> any:
         }
 
 
-def get_user_group_path(uid: str, db) -> str:
-    """
-    獲取用戶的分組路徑（control 或 experiment）
-    """
-    try:
-        user_doc = db.collection('users').document(uid).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            app_config = user_data.get('app_config', 1)  # 默認為實驗組
-            return 'control' if app_config == 0 else 'experiment'
-        else:
-            return 'experiment'  # 默認為實驗組
-    except Exception as e:
-        print(f"獲取用戶分組失敗: {e}")
-        return 'experiment'  # 出錯時默認為實驗組
+# run_per_user 為每個用戶設置的取消標記（threading.Event），只在工作線程的 context 中可見
+_user_cancel_event = contextvars.ContextVar('user_cancel_event', default=None)
+
+
+def check_user_cancelled() -> None:
+    """
+    run_per_user 的工作函數在寫入 Firestore 前呼叫：用戶已超時或 run_per_user 已返回時拋出 TimeoutError，
+    避免背景中仍在執行的線程在函數返回後繼續寫入
+    """
+    cancel_event = _user_cancel_event.get()
+    if cancel_event is not None and cancel_event.is_set():
+        raise TimeoutError("用戶處理已取消，不再寫入")
+
+
+def run_per_user(uids: list[str], process_user, max_workers: int = DAILY_METRICS_WORKERS, timeout_sec: float = DAILY_METRICS_USER_TIMEOUT_SEC) -> list[tuple]:
+    """
+    以有限線程池並行處理用戶，單個用戶的錯誤或超時不影響其他用戶
+    超時的用戶記為 TimeoutError；已在執行的線程無法中止，但其取消標記會被設置，
+    process_user 在寫入前呼叫 check_user_cancelled() 即可放棄寫入
+    工作線程繼承呼叫端的 contextvars（structured_log 的執行上下文與限速狀態）
+    返回 [(uid, result, error)]，順序與 uids 一致
+    """
+    started_at: dict[str, float] = {}
+    cancel_events = {uid: threading.Event() for uid in uids}
+
+    def run(uid: str):
+        _user_cancel_event.set(cancel_events[uid])
+        started_at[uid] = time.monotonic()
+        return process_user(uid)
+
+    outcomes: dict[str, tuple] = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        uid_by_future = {executor.submit(contextvars.copy_context().run, run, uid): uid for uid in uids}
+        pending = set(uid_by_future)
+        while pending:
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                uid = uid_by_future[future]
+                try:
+                    outcomes[uid] = (uid, future.result(), None)
+                except Exception as e:
+                    outcomes[uid] = (uid, None, e)
+
+            now = time.monotonic()
+            for future in list(pending):
+                uid = uid_by_future[future]
+                start = started_at.get(uid)
+                if start is not None and now - start > timeout_sec:
+                    pending.discard(future)
+                    cancel_events[uid].set()
+                    outcomes[uid] = (uid, None, TimeoutError(f"處理超過 {timeout_sec:g} 秒"))
+    finally:
+        # 返回後仍在背景執行的線程一律取消，不再寫入
+        for cancel_event in cancel_events.values():
+            cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return [outcomes[uid] for uid in uids]
+
+
+class UserProfileCache:
+    """
+    用戶文檔（users/{uid}）的 LRU 快取，帶有效期，線程安全
+    批量列出用戶時以 seed() 預先填入，之後的分組查詢不再單獨讀取用戶文檔
+    """
+
+    def __init__(self, maxsize: int = USER_PROFILE_CACHE_SIZE, ttl_sec: float = USER_PROFILE_CACHE_TTL_SEC):
+        self.maxsize = maxsize
+        self.ttl_sec = ttl_sec
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: str) -> dict | None:
+        """返回未過期的用戶數據（不存在的用戶為空 dict），未命中返回 None"""
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_sec:
+                if entry is not None:
+                    del self._entries[uid]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, uid: str, user_data: dict | None) -> None:
+        with self._lock:
+            self._entries[uid] = (time.monotonic(), user_data or {})
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def seed(self, user_docs: list) -> None:
+        """以批量讀取到的用戶文檔填入快取"""
+        for user_doc in user_docs:
+            self.put(user_doc.id, user_doc.to_dict() if user_doc.exists else None)
+
+    def fetch(self, uid: str, db) -> dict:
+        """先查快取，未命中時讀取 users/{uid} 並寫入快取"""
+        user_data = self.get(uid)
+        if user_data is None:
+            with firestore_stats.call_site('users'):
+                user_doc = db.collection('users').document(uid).get()
+            user_data = user_doc.to_dict() if user_doc.exists else {}
+            self.put(uid, user_data)
+        return user_data
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+# 模組級快取：同一實例內的所有調用共用
+user_profile_cache = UserProfileCache()
+
+# 教練上下文的實例內快取（沿用 UserProfileCache 的 LRU + 有效期結構），key 為 "{uid}/{日期}"
+coach_context_cache = UserProfileCache(maxsize=COACH_CONTEXT_CACHE_SIZE, ttl_sec=COACH_CONTEXT_CACHE_TTL_SEC)
+
+
+def load_coach_context(uid: str) -> dict:
+    """
+    讀取夜間任務為今天（台灣時間）預先產生的教練上下文，不存在或讀取失敗時返回空 dict
+    結果快取在實例內，同一場對話的後續輪次不再讀取 Firestore
+    """
+    date_str = datetime.now(TAIWAN_TZ).strftime('%Y%m%d')
+    cache_key = f"{uid}/{date_str}"
+    coach_context = coach_context_cache.get(cache_key)
+    if coach_context is None:
+        try:
+            context_doc = get_firestore_client().collection('users').document(uid).collection(COACH_CONTEXT_COLLECTION).document(date_str).get()
+        except Exception as e:
+            structured_log.warning("⚠️ 讀取教練上下文失敗", sample_key='coach_context_read_error', uid=uid, error=str(e))
+            return {}
+        coach_context = context_doc.to_dict() if context_doc.exists else {}
+        coach_context_cache.put(cache_key, coach_context)
+    return coach_context
+
+
+@https_fn.on_call()
+def vocab_review_queue(req: https_fn.CallableRequest) -> any:
+    """
+    返回登入用戶今天（台灣時間）的單字複習佇列
+    正常情況下只讀取夜間任務預先計算的 users/{uid}/vocab_review/{日期}；
+    文檔不存在時（新用戶或夜間任務尚未執行）即時計算並寫回，之後的請求同樣只需一次讀取
+    返回 {'date', 'items': [{word, week, day, position, step, due, overdue_days}], 'count', 'next_due', 'source'}
+    """
+    if req.auth is None:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.UNAUTHENTICATED, message="需要登入")
+
+    try:
+        db = get_firestore_client()
+        now = datetime.now(TAIWAN_TZ)
+        review_ref = db.collection('users').document(req.auth.uid).collection(VOCAB_REVIEW_COLLECTION).document(now.strftime('%Y%m%d'))
+        review_doc = review_ref.get()
+        if review_doc.exists:
+            queue = review_doc.to_dict()
+            source = 'precomputed'
+        else:
+            end_utc = now.replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc)
+            studies = load_user_vocab_studies(db, req.auth.uid, end_utc - VOCAB_REVIEW_LOOKBACK, end_utc)
+            queue = build_vocab_review_document(studies, now)
+            review_ref.set(queue)
+            source = 'computed'
+        queue.pop('updated_at', None)
+        return {**queue, 'source': source}
+
+    except Exception as e:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.UNKNOWN,
+                                  message="vocab_review_queue error",
+                                  details=str(e))
+
+
+def group_path_from_user_data(user_data: dict) -> str:
+    """根據用戶文檔的 app_config 判斷分組（control 或 experiment）"""
+    app_config = user_data.get('app_config', 1)  # 默認為實驗組
+    return 'control' if app_config == 0 else 'experiment'
+
+def get_user_group_path(uid: str, db) -> str:
+    """
+    獲取用戶的分組路徑（control 或 experiment）
+    """
+    try:
+        # 用戶不存在時 fetch 返回空 dict，默認為實驗組
+        return group_path_from_user_data(user_profile_cache.fetch(uid, db))
+    except Exception as e:
+        structured_log.warning("獲取用戶分組失敗", sample_key='user_group_error', uid=uid, error=str(e))
+        return 'experiment'  # 出錯時默認為實驗組
+
+def fetch_event_subcollections(events_ref, events: list) -> dict:
+    """
+    並行讀取每個事件的 chats / review / notifications 子集合（每個子集合只讀一次）
+    返回 {event_id: {子集合名稱: [文檔數據] 或 None（讀取失敗）}}
+    """
+    results = {event_doc.id: {} for event_doc in events}
+    if not events:
+        return results
+
+    def fetch(event_id: str, name: str) -> list[dict]:
+        with firestore_stats.call_site(name):
+            return [doc.to_dict() for doc in events_ref.document(event_id).collection(name).stream()]
+
+    with ThreadPoolExecutor(max_workers=SUBCOLLECTION_FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch, event_doc.id, name): (event_doc.id, name)
+            for event_doc in events
+            for name in EVENT_SUBCOLLECTIONS
+        }
+        for future, (event_id, name) in futures.items():
+            try:
+                results[event_id][name] = future.result()
+            except Exception as e:
+                structured_log.warning(f"獲取事件的{EVENT_SUBCOLLECTIONS[name]}失敗", sample_key='subcollection_error',
+                                       event_id=event_id, subcollection=name, error=str(e))
+                results[event_id][name] = None
+    return results
+
+
+def add_counters(totals: dict, counters: dict, sign: int = 1) -> dict:
+    """把 counters 按 sign（1 或 -1）累加到 totals"""
+    for name, value in counters.items():
+        totals[name] = totals.get(name, 0) + sign * value
+    return totals
+
+
+def event_counters(event_data: dict, end_utc: datetime | None = None) -> dict:
+    """
+    單個事件文檔對 event 指標的貢獻
+    end_utc 為統計日結束時間；省略時以事件自身所在日期為準（排程時間必然早於當天結束）
+    """
+    is_done = event_data.get('isDone', False)
+    scheduled_start = event_data.get('scheduledStartTime')
+    # 檢查是否過期 (過了排程時間但未完成)
+    overdue = bool(scheduled_start) and not is_done and (
+        end_utc is None or scheduled_start.replace(tzinfo=timezone.utc) < end_utc
+    )
+    return {
+        'event_total_count': 1,
+        'event_overdue_count': int(overdue),
+        'event_complete_count': int(bool(is_done)),
+        'event_not_finish_count': int(not is_done),
+    }
+
+
+def chat_has_commit_plan(chat_data: dict) -> bool:
+    """聊天是否包含 commit plan"""
+    return bool(chat_data.get('commit_plan', False))
+
+
+def chat_counters(chat_data: dict) -> dict:
+    """單個聊天文檔對聊天指標的貢獻（commit plan 按事件計算，不在此處）"""
+    result = chat_data.get('result')
+    return {
+        'chat_total_count': 1,
+        'chat_start_count': int(result == 0),  # start
+        'chat_snooze_count': int(result == 1),  # snooze
+        'chat_leave_count': int(result == 2),  # leave
+    }
+
+
+def review_counters(review_data: dict) -> dict:
+    """單個複習文檔對複習次數與總時長的貢獻"""
+    duration = review_data.get('durationMin', 0)
+    return {
+        'review_count': 1,
+        'review_total_duration': duration if isinstance(duration, int) and duration > 0 else 0,
+    }
+
+
+def notification_counters(notif_data: dict) -> dict:
+    """單個通知文檔（包含 -1st 和 -2nd）對通知指標的貢獻"""
+    # 檢查是否被點開
+    opened = bool(notif_data.get('opened_time'))
+    return {
+        'notif_total_count': 1,
+        'notif_open_count': int(opened),
+        'notif_dismiss_count': int(not opened),
+    }
+
+
+def session_counters(session_data: dict) -> dict:
+    """單個 app_sessions 文檔對應用使用指標的貢獻（總時長與有效會話數用於計算平均值）"""
+    duration = session_data.get('duration_seconds')
+    valid = bool(duration) and duration > 0
+    return {
+        'app_open_count': 1,
+        'app_open_by_notif_count': int(bool(session_data.get('opened_by_notification', False))),
+        'app_total_duration': duration if valid else 0,
+        'app_valid_sessions': int(valid),
+    }
+
+
+# 事件類指標（事件與其子集合）
+EVENT_METRIC_NAMES = (
+    'event_total_count',
+    'event_overdue_count',
+    'event_complete_count',
+    'event_not_finish_count',
+    'event_commit_plan_count',
+    'review_count',
+    'review_total_duration',
+    'notif_total_count',
+    'notif_open_count',
+    'notif_dismiss_count',
+    'chat_total_count',
+    'chat_leave_count',
+    'chat_start_count',
+    'chat_snooze_count',
+)
+# 應用會話類累計計數（平均值由此推算）
+SESSION_COUNTER_NAMES = ('app_open_count', 'app_open_by_notif_count', 'app_total_duration', 'app_valid_sessions')
+
+
+def reduce_event_metrics(events: list, subcollections: dict, end_utc: datetime) -> dict:
+    """根據事件及其子集合數據計算 event / 複習 / 通知 / 聊天指標"""
+    metrics = dict.fromkeys(EVENT_METRIC_NAMES, 0)
+
+    for event_doc in events:
+        add_counters(metrics, event_counters(event_doc.to_dict(), end_utc))
+
+        event_subs = subcollections.get(event_doc.id, {})
+
+        # 聊天：commit plan（一個事件只計算一次）與結果統計共用同一份數據
+        chats = event_subs.get('chats')
+        if chats is not None:
+            if any(chat_has_commit_plan(chat) for chat in chats):
+                metrics['event_commit_plan_count'] += 1
+            for chat in chats:
+                add_counters(metrics, chat_counters(chat))
+
+        # 複習次數與總時長
+        reviews = event_subs.get('review')
+        if reviews is not None:
+            for session in reviews:
+                add_counters(metrics, review_counters(session))
+
+        # 通知記錄
+        notifications = event_subs.get('notifications')
+        if notifications is not None:
+            for notif in notifications:
+                add_counters(metrics, notification_counters(notif))
+
+    return metrics
+
+
+def finalize_session_metrics(totals: dict) -> dict:
+    """把應用會話累計計數換算成 daily_metrics 中的應用使用指標"""
+    valid_sessions = totals.get('app_valid_sessions', 0)
+    return {
+        'app_open_count': totals.get('app_open_count', 0),
+        'app_average_open_time': totals.get('app_total_duration', 0) // valid_sessions if valid_sessions > 0 else 0,
+        'app_open_by_notif_count': totals.get('app_open_by_notif_count', 0),
+    }
+
+
+def reduce_app_session_metrics(sessions: list) -> dict:
+    """根據 app_sessions 文檔計算應用使用指標"""
+    totals = dict.fromkeys(SESSION_COUNTER_NAMES, 0)
+    for session_doc in sessions:
+        add_counters(totals, session_counters(session_doc.to_dict()))
+    return finalize_session_metrics(totals)
+
+
+def assemble_daily_metrics(event_metrics: dict, session_metrics: dict, date_string: str) -> dict:
+    """按固定欄位順序組合 daily_metrics 文檔"""
+    taiwan_tz = TAIWAN_TZ
+    return {
+        # Event相關
+        'event_total_count': event_metrics['event_total_count'],
+        'event_overdue_count': event_metrics['event_overdue_count'],
+        'event_complete_count': event_metrics['event_complete_count'],
+        'event_not_finish_count': event_metrics['event_not_finish_count'],
+        'event_commit_plan_count': event_metrics['event_commit_plan_count'],
+
+        # 複習相關
+        'review_count': event_metrics['review_count'],
+        'review_total_duration': event_metrics['review_total_duration'],
+
+        # 通知相關
+        'notif_total_count': event_metrics['notif_total_count'],
+        'notif_open_count': event_metrics['notif_open_count'],
+        'notif_dismiss_count': event_metrics['notif_dismiss_count'],
+
+        # 應用使用相關
+        'app_open_count': session_metrics['app_open_count'],
+        'app_average_open_time': session_metrics['app_average_open_time'],
+        'app_open_by_notif_count': session_metrics['app_open_by_notif_count'],
+
+        # 聊天相關
+        'chat_total_count': event_metrics['chat_total_count'],
+        'chat_leave_count': event_metrics['chat_leave_count'],
+        'chat_start_count': event_metrics['chat_start_count'],
+        'chat_snooze_count': event_metrics['chat_snooze_count'],
+
+        # 元數據
+        'date': date_string,
+        'created_at': datetime.now(taiwan_tz),
+        'timezone': 'Asia/Taipei'
+    }
+
 
 def calculate_daily_metrics(uid: str, target_date: datetime, db) -> dict:
     """
     計算指定用戶在指定日期的所有指標（支持分組數據結構）
     """
     # 設定時間範圍（台灣時區的一整天）
-    taiwan_tz = pytz.timezone('Asia/Taipei')
     start_of_day = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
     end_of_day = start_of_day + timedelta(days=1)
     
     # 轉換為UTC進行Firestore查詢
-    start_utc = start_of_day.astimezone(pytz.UTC)
-    end_utc = end_of_day.astimezone(pytz.UTC)
+    start_utc = start_of_day.astimezone(timezone.utc)
+    end_utc = end_of_day.astimezone(timezone.utc)
     
     # 獲取用戶分組路徑
     group_path = get_user_group_path(uid, db)
-    print(f"用戶 {uid} 分組: {group_path}")
     
     # === Event相關指標（使用新的數據結構） ===
     # 初始化變量
@@ -552,15 +2433,17 @@ def calculate_daily_metrics(uid: str, target_date: datetime, db) -> dict:
         # 查詢時間範圍
         try:
             exp_query = experiment_events_ref.where('scheduledStartTime', '>=', start_utc).where('scheduledStartTime', '<', end_utc)
-            events += list(exp_query.stream())
+            with firestore_stats.call_site('events'):
+                events += list(exp_query.stream())
         except Exception as e:
-            print(f"查詢 experiment_events 失敗: {e}")
+            structured_log.warning("查詢 experiment_events 失敗", sample_key='events_query_error', uid=uid, error=str(e))
         try:
             ctrl_query = control_events_ref.where('scheduledStartTime', '>=', start_utc).where('scheduledStartTime', '<', end_utc)
-            events += list(ctrl_query.stream())
+            with firestore_stats.call_site('events'):
+                events += list(ctrl_query.stream())
         except Exception as e:
-            print(f"查詢 control_events 失敗: {e}")
-        print(f"從新結構獲取到 {len(events)} 個事件")
+            structured_log.warning("查詢 control_events 失敗", sample_key='events_query_error', uid=uid, error=str(e))
+        structured_log.debug("從新結構獲取事件", uid=uid, group=group_path, events=len(events))
         
         # 為新結構設置 events_ref（用於後續查詢）
         if group_path == 'experiment':
@@ -569,93 +2452,16 @@ def calculate_daily_metrics(uid: str, target_date: datetime, db) -> dict:
             events_ref = control_events_ref
             
     except Exception as e:
-        print(f"新結構查詢失敗，嘗試舊結構: {e}")
+        structured_log.warning("新結構查詢失敗，嘗試舊結構", sample_key='events_fallback', uid=uid, error=str(e))
         # 如果新結構失敗，回退到舊結構
         events_ref = db.collection('users').document(uid).collection('events')
         events_query = events_ref.where('scheduledStartTime', '>=', start_utc).where('scheduledStartTime', '<', end_utc)
-        events = list(events_query.stream())
-    
-    event_total_count = len(events)
-    event_complete_count = 0
-    event_overdue_count = 0
-    event_not_finish_count = 0
-    event_commit_plan_count = 0
-    
-    for event_doc in events:
-        event_data = event_doc.to_dict()
-        is_done = event_data.get('isDone', False)
-        status = event_data.get('status')
-        scheduled_start = event_data.get('scheduledStartTime')
-        
-        if is_done:
-            event_complete_count += 1
-        else:
-            event_not_finish_count += 1
-            
-        # 檢查是否過期 (過了排程時間但未完成)
-        if scheduled_start and scheduled_start.replace(tzinfo=pytz.UTC) < end_utc and not is_done:
-            event_overdue_count += 1
-            
-        # 檢查是否有commit plan（從chats sub-collection中查詢）
-        try:
-            chats_ref = events_ref.document(event_doc.id).collection('chats')
-            chats = list(chats_ref.stream())
-            for chat_doc in chats:
-                chat_data = chat_doc.to_dict()
-                if chat_data.get('commit_plan', False):
-                    event_commit_plan_count += 1
-                    break  # 一個事件只計算一次
-        except Exception as e:
-            print(f"檢查事件 {event_doc.id} 的commit plan失敗: {e}")
-            continue
-    
-    # === 複習相關指標 (新結構) ===
-    review_count = 0
-    review_total_duration = 0
-    
-    for event_doc in events:
-        try:
-            # 查詢 review 子集合
-            reviews_ref = events_ref.document(event_doc.id).collection('review')
-            review_sessions = list(reviews_ref.stream())
-            
-            # 累加複習次數
-            review_count += len(review_sessions)
-            
-            # 累加複習總時長
-            for session in review_sessions:
-                session_data = session.to_dict()
-                duration = session_data.get('durationMin', 0)
-                if isinstance(duration, int) and duration > 0:
-                    review_total_duration += duration
-                    
-        except Exception as e:
-            print(f"獲取事件 {event_doc.id} 的複習記錄失敗: {e}")
-            continue
-
-    # === 通知相關指標 ===
-    notif_total_count = 0
-    notif_open_count = 0 
-    notif_dismiss_count = 0
+        with firestore_stats.call_site('events'):
+            events = list(events_query.stream())
     
-    for event_doc in events:
-        # 獲取所有通知記錄（包含 -1st 和 -2nd）
-        try:
-            notifications_ref = events_ref.document(event_doc.id).collection('notifications')
-            notifications = list(notifications_ref.stream())
-            
-            for notif_doc in notifications:
-                notif_data = notif_doc.to_dict()
-                notif_total_count += 1
-                
-                # 檢查是否被點開
-                if notif_data.get('opened_time'):
-                    notif_open_count += 1
-                else:
-                    notif_dismiss_count += 1
-        except Exception as e:
-            print(f"獲取事件 {event_doc.id} 的通知記錄失敗: {e}")
-            continue
+    # === 子集合（chats / review / notifications）：每個事件各讀一次，並行執行 ===
+    subcollections = fetch_event_subcollections(events_ref, events)
+    event_metrics = reduce_event_metrics(events, subcollections, end_utc)
     
     # === 應用使用相關指標（使用新的數據結構） ===
     date_string = target_date.strftime('%Y%m%d')
@@ -663,102 +2469,627 @@ def calculate_daily_metrics(uid: str, target_date: datetime, db) -> dict:
         # 優先嘗試新的數據結構
         app_sessions_ref = db.collection('users').document(uid).collection(group_path).document('data').collection('app_sessions')
         sessions_query = app_sessions_ref.where('date', '==', date_string)
-        sessions = list(sessions_query.stream())
-        print(f"從新結構獲取到 {len(sessions)} 個會話")
+        with firestore_stats.call_site('app_sessions'):
+            sessions = list(sessions_query.stream())
+        structured_log.debug("從新結構獲取會話", uid=uid, sessions=len(sessions))
     except Exception as e:
-        print(f"新結構會話查詢失敗，嘗試舊結構: {e}")
+        structured_log.warning("新結構會話查詢失敗，嘗試舊結構", sample_key='sessions_fallback', uid=uid, error=str(e))
         # 如果新結構失敗，回退到舊結構
         app_sessions_ref = db.collection('users').document(uid).collection('app_sessions')
         sessions_query = app_sessions_ref.where('date', '==', date_string)
-        sessions = list(sessions_query.stream())
-    
-    app_open_count = len(sessions)
-    app_open_by_notif_count = 0
-    total_duration = 0
-    valid_sessions = 0
-    
-    for session_doc in sessions:
-        session_data = session_doc.to_dict()
-        
-        if session_data.get('opened_by_notification', False):
-            app_open_by_notif_count += 1
-            
-        duration = session_data.get('duration_seconds')
-        if duration and duration > 0:
-            total_duration += duration
-            valid_sessions += 1
-    
-    app_average_open_time = total_duration // valid_sessions if valid_sessions > 0 else 0
+        with firestore_stats.call_site('app_sessions'):
+            sessions = list(sessions_query.stream())
     
-    # === 聊天相關指標 ===
-    chat_total_count = 0
-    chat_leave_count = 0
-    chat_start_count = 0
-    chat_snooze_count = 0
+    session_metrics = reduce_app_session_metrics(sessions)
     
-    for event_doc in events:
+    # 返回所有指標
+    return assemble_daily_metrics(event_metrics, session_metrics, date_string)
+
+
+def event_day_string(scheduled_start) -> str | None:
+    """把事件的 scheduledStartTime 轉為台灣時區的日期字串（YYYYMMDD）"""
+    if not scheduled_start:
+        return None
+    taiwan_tz = TAIWAN_TZ
+    return scheduled_start.replace(tzinfo=scheduled_start.tzinfo or timezone.utc).astimezone(taiwan_tz).strftime('%Y%m%d')
+
+
+def counter_deltas(before: dict | None, after: dict | None, counters_fn, before_day: str | None, after_day: str | None) -> dict:
+    """
+    根據文檔寫入前後的數據計算各日期的計數增量
+    返回 {date: {counter: delta}}，只保留非零增量
+    """
+    deltas: dict[str, dict] = {}
+    if before is not None and before_day:
+        add_counters(deltas.setdefault(before_day, {}), counters_fn(before), -1)
+    if after is not None and after_day:
+        add_counters(deltas.setdefault(after_day, {}), counters_fn(after))
+    deltas = {
+        day: {name: value for name, value in counters.items() if value}
+        for day, counters in deltas.items()
+    }
+    return {day: counters for day, counters in deltas.items() if counters}
+
+
+def merge_live_metrics(live_data: dict, deltas: dict, plan_chats: dict | None = None) -> dict:
+    """
+    把計數增量合併到即時指標文檔數據，返回需要寫入的欄位
+    plan_chats: {event_id: [chat_id, ...]}，替換這些事件中含 commit plan 的聊天；
+    event_commit_plan_count 為含 commit plan 聊天的事件數
+    """
+    updated = {name: live_data.get(name, 0) + delta for name, delta in deltas.items()}
+    if plan_chats:
+        merged_plan_chats = dict(live_data.get('commit_plan_chats') or {})
+        for event_id, chat_ids in plan_chats.items():
+            # 以 merge 寫入時移除的 key 不會被刪除，因此保留空列表
+            merged_plan_chats[event_id] = sorted(chat_ids)
+        updated['commit_plan_chats'] = merged_plan_chats
+        updated['event_commit_plan_count'] = sum(1 for ids in merged_plan_chats.values() if ids)
+    return updated
+
+
+def apply_live_metrics_changes(db, uid: str, deltas: dict, commit_plan: tuple | None = None,
+                               moved_event: tuple | None = None, trigger_event_id: str | None = None) -> bool:
+    """
+    在事務中把計數增量寫入 users/{uid}/daily_metrics_live/{date}
+    deltas: {date: {counter: delta}}；commit_plan: (date, event_id, chat_id, has_plan)
+    moved_event: (event_id, before_day, after_day)，事件改期或刪除時把其 commit plan 聊天從舊日期移到新日期（after_day 為 None 時只移除）
+    trigger_event_id: 觸發器事件的 event.id；同一事務中記錄到 LIVE_METRICS_PROCESSED_COLLECTION，
+    重複投遞的事件直接略過
+    返回是否寫入（重複事件返回 False）
+    """
+    days = set(deltas)
+    if commit_plan is not None:
+        days.add(commit_plan[0])
+    if moved_event is not None:
+        days.update(day for day in moved_event[1:] if day)
+    if not days:
+        return False
+
+    user_ref = db.collection('users').document(uid)
+    live_collection = user_ref.collection(LIVE_METRICS_COLLECTION)
+    processed_ref = user_ref.collection(LIVE_METRICS_PROCESSED_COLLECTION).document(trigger_event_id) if trigger_event_id else None
+    taiwan_tz = TAIWAN_TZ
+
+    @firestore.transactional
+    def update(transaction) -> bool:
+        # 事務中需先完成所有讀取再寫入
+        if processed_ref is not None and processed_ref.get(transaction=transaction).exists:
+            return False
+        snapshots = {day: live_collection.document(day).get(transaction=transaction) for day in days}
+        live_data = {day: snapshot.to_dict() if snapshot.exists else {} for day, snapshot in snapshots.items()}
+
+        plan_chats: dict[str, dict] = {}
+        if moved_event is not None:
+            event_id, before_day, after_day = moved_event
+            moved_ids = set((live_data[before_day].get('commit_plan_chats') or {}).get(event_id) or []) if before_day else set()
+            if before_day:
+                plan_chats.setdefault(before_day, {})[event_id] = []
+            if after_day and moved_ids:
+                existing = set((live_data[after_day].get('commit_plan_chats') or {}).get(event_id) or [])
+                plan_chats.setdefault(after_day, {})[event_id] = existing | moved_ids
+        if commit_plan is not None:
+            day, event_id, chat_id, has_plan = commit_plan
+            day_plans = plan_chats.setdefault(day, {})
+            chat_ids = set(day_plans.get(event_id, (live_data[day].get('commit_plan_chats') or {}).get(event_id) or []))
+            if has_plan:
+                chat_ids.add(chat_id)
+            else:
+                chat_ids.discard(chat_id)
+            day_plans[event_id] = chat_ids
+
+        now = datetime.now(taiwan_tz)
+        for day in days:
+            updated = merge_live_metrics(live_data[day], deltas.get(day, {}), plan_chats.get(day))
+            updated.update({
+                'date': day,
+                'updated_at': now,
+                'timezone': 'Asia/Taipei',
+            })
+            transaction.set(live_collection.document(day), updated, merge=True)
+        if processed_ref is not None:
+            transaction.set(processed_ref, {
+                'processed_at': now,
+                'expires_at': now + timedelta(days=LIVE_METRICS_PROCESSED_TTL_DAYS),
+            })
+        return True
+
+    return update(db.transaction())
+
+
+def snapshot_data(snapshot) -> dict | None:
+    """觸發器事件中的文檔快照轉為 dict，文檔不存在時返回 None"""
+    if snapshot is None or not snapshot.exists:
+        return None
+    return snapshot.to_dict()
+
+
+def event_children_counters(event_ref) -> dict:
+    """事件底下 chats / review / notifications 子集合對指標的總貢獻（不含 commit plan）"""
+    subcollections = fetch_event_subcollections(event_ref.parent, [event_ref])[event_ref.id]
+    totals = {}
+    for name, counters_fn in (('chats', chat_counters), ('review', review_counters), ('notifications', notification_counters)):
+        for data in subcollections.get(name) or []:
+            add_counters(totals, counters_fn(data))
+    return totals
+
+
+def update_live_event_metrics(uid: str, change, trigger_event_id: str | None = None) -> None:
+    """
+    事件文檔寫入時更新即時 event 指標（改期時從舊日期扣除、加到新日期）
+    改期或刪除時，子集合（聊天、複習、通知）已計入舊日期的計數與 commit plan 一併移到新日期（刪除時只扣除），
+    與 calculate_daily_metrics 按事件當前日期歸屬子集合一致
+    """
+    before = snapshot_data(change.before)
+    after = snapshot_data(change.after)
+    before_day = event_day_string(before.get('scheduledStartTime')) if before else None
+    after_day = event_day_string(after.get('scheduledStartTime')) if after else None
+    deltas = counter_deltas(before, after, event_counters, before_day, after_day)
+
+    moved_event = None
+    if before_day and before_day != after_day:
+        event_ref = change.before.reference
+        children = event_children_counters(event_ref)
+        for day, sign in ((before_day, -1), (after_day, 1)):
+            if day and children:
+                add_counters(deltas.setdefault(day, {}), children, sign)
+        deltas = {
+            day: {name: value for name, value in counters.items() if value}
+            for day, counters in deltas.items()
+        }
+        moved_event = (event_ref.id, before_day, after_day)
+
+    if deltas or moved_event is not None:
+        apply_live_metrics_changes(get_firestore_client(), uid, deltas, moved_event=moved_event, trigger_event_id=trigger_event_id)
+
+
+def update_live_subcollection_metrics(uid: str, events_collection: str, event_id: str, change, counters_fn,
+                                      chat_id: str | None = None, trigger_event_id: str | None = None) -> None:
+    """
+    事件子集合（chats / review / notifications）文檔寫入時，按所屬事件當前的日期更新即時指標
+    事件之後改期或刪除時，由 update_live_event_metrics 把子集合的計數移到新日期
+    """
+    if events_collection not in LIVE_METRICS_EVENT_COLLECTIONS:
+        return
+    before = snapshot_data(change.before)
+    after = snapshot_data(change.after)
+
+    # commit plan 只在狀態變化時更新
+    commit_plan = None
+    if chat_id is not None:
+        had_plan = chat_has_commit_plan(before) if before else False
+        has_plan = chat_has_commit_plan(after) if after else False
+        if had_plan != has_plan:
+            commit_plan = (event_id, chat_id, has_plan)
+
+    # 先比較增量，沒有變化時不讀取父事件
+    if not counter_deltas(before, after, counters_fn, 'day', 'day') and commit_plan is None:
+        return
+
+    db = get_firestore_client()
+    event_doc = db.collection('users').document(uid).collection(events_collection).document(event_id).get()
+    day = event_day_string(event_doc.get('scheduledStartTime')) if event_doc.exists else None
+    if day is None:
+        structured_log.info("事件不存在或沒有排程時間，略過即時指標更新", sample_key='live_event_missing', uid=uid, event_id=event_id)
+        return
+
+    deltas = counter_deltas(before, after, counters_fn, day, day)
+    apply_live_metrics_changes(db, uid, deltas, (day, *commit_plan) if commit_plan else None, trigger_event_id=trigger_event_id)
+
+
+@firestore_fn.on_document_written(document="users/{uid}/experiment_events/{eventId}")
+def live_metrics_on_experiment_event(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """實驗組事件寫入時更新即時每日指標"""
+    update_live_event_metrics(event.params['uid'], event.data, trigger_event_id=event.id)
+
+
+@firestore_fn.on_document_written(document="users/{uid}/control_events/{eventId}")
+def live_metrics_on_control_event(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """對照組事件寫入時更新即時每日指標"""
+    update_live_event_metrics(event.params['uid'], event.data, trigger_event_id=event.id)
+
+
+@firestore_fn.on_document_written(document="users/{uid}/{eventsCollection}/{eventId}/chats/{chatId}")
+def live_metrics_on_chat(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """聊天寫入時更新即時聊天指標與 commit plan 計數"""
+    params = event.params
+    update_live_subcollection_metrics(
+        params['uid'], params['eventsCollection'], params['eventId'], event.data, chat_counters,
+        chat_id=params['chatId'], trigger_event_id=event.id,
+    )
+
+
+@firestore_fn.on_document_written(document="users/{uid}/{eventsCollection}/{eventId}/review/{sessionId}")
+def live_metrics_on_review(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """複習會話寫入時更新即時複習指標"""
+    params = event.params
+    update_live_subcollection_metrics(
+        params['uid'], params['eventsCollection'], params['eventId'], event.data, review_counters, trigger_event_id=event.id
+    )
+
+
+@firestore_fn.on_document_written(document="users/{uid}/{eventsCollection}/{eventId}/notifications/{notifId}")
+def live_metrics_on_notification(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """通知記錄寫入時更新即時通知指標"""
+    params = event.params
+    update_live_subcollection_metrics(
+        params['uid'], params['eventsCollection'], params['eventId'], event.data, notification_counters, trigger_event_id=event.id
+    )
+
+
+@firestore_fn.on_document_written(document="users/{uid}/{group}/data/app_sessions/{sessionId}")
+def live_metrics_on_app_session(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """應用會話寫入時更新即時應用使用指標（按會話的 date 欄位歸入日期）"""
+    if event.params['group'] not in ('experiment', 'control'):
+        return
+    before = snapshot_data(event.data.before)
+    after = snapshot_data(event.data.after)
+    deltas = counter_deltas(
+        before, after, session_counters,
+        before.get('date') if before else None,
+        after.get('date') if after else None,
+    )
+    if deltas:
+        apply_live_metrics_changes(get_firestore_client(), event.params['uid'], deltas, trigger_event_id=event.id)
+
+
+def metrics_from_live_counters(live_data: dict, date_string: str) -> dict:
+    """把即時計數文檔整理成與 calculate_daily_metrics 相同格式的 daily_metrics"""
+    event_metrics = {name: live_data.get(name, 0) for name in EVENT_METRIC_NAMES}
+    session_metrics = finalize_session_metrics({name: live_data.get(name, 0) for name in SESSION_COUNTER_NAMES})
+    return assemble_daily_metrics(event_metrics, session_metrics, date_string)
+
+
+def live_verify_sample(uids: list[str], date_string: str, sample_size: int = LIVE_METRICS_VERIFY_SAMPLE) -> list[str]:
+    """按 uid 與日期的雜湊挑選最多 sample_size 個用戶：同一天重跑時抽樣相同，不同日期輪到不同用戶"""
+    return sorted(uids, key=lambda uid: hashlib.sha1(f"{uid}:{date_string}".encode('utf-8')).hexdigest())[:sample_size]
+
+
+def finalize_live_metrics(db, user_docs: list, target_date: datetime, sample_size: int = LIVE_METRICS_VERIFY_SAMPLE) -> tuple[dict, int]:
+    """
+    incremental 模式：以一次 get_all 讀取這些用戶的即時計數文檔，直接整理成 daily_metrics，不重新掃描原始數據
+    沒有即時文檔的用戶不在結果中（由呼叫方以 calculate_daily_metrics 完整計算）；
+    有即時文檔的用戶中抽樣 sample_size 個重新完整計算並核對，不一致時記錄警告並改用完整計算的結果
+    返回 ({uid: metrics}, 不一致的用戶數)
+    """
+    date_string = target_date.strftime('%Y%m%d')
+    refs = [
+        db.collection('users').document(user_doc.id).collection(LIVE_METRICS_COLLECTION).document(date_string)
+        for user_doc in user_docs
+    ]
+    with firestore_stats.call_site(LIVE_METRICS_COLLECTION):
+        snapshots = list(db.get_all(refs)) if refs else []
+    all_metrics = {
+        snapshot.reference.parent.parent.id: metrics_from_live_counters(snapshot.to_dict(), date_string)
+        for snapshot in snapshots
+        if snapshot.exists
+    }
+
+    drift_count = 0
+    for uid in live_verify_sample(list(all_metrics), date_string, sample_size):
+        full_metrics = calculate_daily_metrics(uid=uid, target_date=target_date, db=db)
+        mismatched = [
+            name for name in (*EVENT_METRIC_NAMES, 'app_open_count', 'app_average_open_time', 'app_open_by_notif_count')
+            if full_metrics[name] != all_metrics[uid][name]
+        ]
+        if mismatched:
+            structured_log.warning("⚠️ 即時計數與完整計算不一致", sample_key='live_drift', uid=uid, mismatched=mismatched)
+            drift_count += 1
+            all_metrics[uid] = full_metrics
+    return all_metrics, drift_count
+
+
+def stream_collection_group(db, collection_id: str, filters: list[tuple], order_field, site: str | None = None):
+    """
+    分頁掃描 collection group：按 order_field 排序並以游標翻頁，每頁 COLLECTION_GROUP_PAGE_SIZE 筆
+    filters: [(field, op, value), ...]
+    site: RPC 統計中的呼叫位置，默認為 collection_id
+    """
+    query = db.collection_group(collection_id)
+    for field, op, value in filters:
+        query = query.where(field, op, value)
+    query = query.order_by(order_field).limit(COLLECTION_GROUP_PAGE_SIZE)
+
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        with firestore_stats.call_site(site or collection_id):
+            docs = list(page_query.stream())
+        yield from docs
+        if len(docs) < COLLECTION_GROUP_PAGE_SIZE:
+            return
+        last_doc = docs[-1]
+
+
+def scan_daily_collection_groups(target_date: datetime, db) -> dict:
+    """
+    以 collection-group 查詢掃描指定日期的事件、子集合與會話，按 uid 分桶
+    返回的分桶可供 metrics_from_collection_groups 對任意用戶子集重複使用
+    """
+    start_of_day = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end_of_day = start_of_day + timedelta(days=1)
+    start_utc = start_of_day.astimezone(timezone.utc)
+    end_utc = end_of_day.astimezone(timezone.utc)
+    date_string = target_date.strftime('%Y%m%d')
+
+    # === 事件：users/{uid}/{experiment|control}_events/{eventId} ===
+    events_by_uid: dict[str, list] = {}
+    for collection_id in ('experiment_events', 'control_events'):
         try:
-            chats_ref = events_ref.document(event_doc.id).collection('chats')
-            chats = list(chats_ref.stream())
-            
-            for chat_doc in chats:
-                chat_data = chat_doc.to_dict()
-                chat_total_count += 1
-                
-                result = chat_data.get('result')
-                if result == 0:  # start
-                    chat_start_count += 1
-                elif result == 1:  # snooze
-                    chat_snooze_count += 1
-                elif result == 2:  # leave
-                    chat_leave_count += 1
+            docs = stream_collection_group(
+                db,
+                collection_id,
+                [('scheduledStartTime', '>=', start_utc), ('scheduledStartTime', '<', end_utc)],
+                'scheduledStartTime',
+                site='events',
+            )
+            for event_doc in docs:
+                uid = event_doc.reference.parent.parent.id
+                events_by_uid.setdefault(uid, []).append(event_doc)
         except Exception as e:
-            print(f"獲取事件 {event_doc.id} 的聊天記錄失敗: {e}")
-            continue
-    
-    # 返回所有指標
+            structured_log.warning("collection-group 查詢失敗", collection=collection_id, error=str(e))
+    structured_log.info("collection-group 獲取事件", events=sum(len(v) for v in events_by_uid.values()))
+
+    # 只保留當天事件底下的子集合文檔，按事件文檔路徑分桶
+    event_paths = {
+        event_doc.reference.path
+        for events in events_by_uid.values()
+        for event_doc in events
+    }
+
+    # === 子集合：.../{eventId}/{chats|review|notifications}/{docId} ===
+    # 時間下限向前放寬 COLLECTION_GROUP_LOOKBACK，上限為執行當下，盡量涵蓋屬於當天事件的文檔
+    scan_start = start_utc - COLLECTION_GROUP_LOOKBACK
+    scan_end = max(end_utc, datetime.now(timezone.utc))
+    subdocs_by_event: dict[str, dict] = {}
+    failed_subcollections = set()
+    for name, time_field in SUBCOLLECTION_TIME_FIELDS.items():
+        try:
+            docs = stream_collection_group(
+                db,
+                name,
+                [(time_field, '>=', scan_start), (time_field, '<', scan_end)],
+                time_field,
+            )
+            for doc in docs:
+                event_path = doc.reference.parent.parent.path
+                if event_path in event_paths:
+                    subdocs_by_event.setdefault(event_path, {}).setdefault(name, []).append(doc.to_dict())
+        except Exception as e:
+            structured_log.warning("collection-group 查詢失敗", collection=name, error=str(e))
+            failed_subcollections.add(name)
+
+    # === 應用會話：users/{uid}/{group}/data/app_sessions/{sessionId} ===
+    sessions_by_group: dict[tuple[str, str], list] = {}
+    try:
+        docs = stream_collection_group(
+            db,
+            'app_sessions',
+            [('date', '==', date_string)],
+            '__name__',  # 按文檔 ID 排序
+        )
+        for session_doc in docs:
+            data_doc = session_doc.reference.parent.parent
+            # 跳過舊結構 users/{uid}/app_sessions
+            if data_doc is None or data_doc.id != 'data' or data_doc.parent.parent is None:
+                continue
+            group_collection = data_doc.parent
+            uid = group_collection.parent.id
+            sessions_by_group.setdefault((uid, group_collection.id), []).append(session_doc)
+    except Exception as e:
+        structured_log.warning("collection-group 查詢失敗", collection='app_sessions', error=str(e))
+
     return {
-        # Event相關
-        'event_total_count': event_total_count,
-        'event_overdue_count': event_overdue_count,
-        'event_complete_count': event_complete_count,
-        'event_not_finish_count': event_not_finish_count,
-        'event_commit_plan_count': event_commit_plan_count,
-        
-        # 複習相關
-        'review_count': review_count,
-        'review_total_duration': review_total_duration,
+        'date_string': date_string,
+        'end_utc': end_utc,
+        'events_by_uid': events_by_uid,
+        'subdocs_by_event': subdocs_by_event,
+        'failed_subcollections': failed_subcollections,
+        'sessions_by_group': sessions_by_group,
+    }
 
-        # 通知相關
-        'notif_total_count': notif_total_count,
-        'notif_open_count': notif_open_count,
-        'notif_dismiss_count': notif_dismiss_count,
-        
-        # 應用使用相關
-        'app_open_count': app_open_count,
-        'app_average_open_time': app_average_open_time,
-        'app_open_by_notif_count': app_open_by_notif_count,
-        
-        # 聊天相關
-        'chat_total_count': chat_total_count,
-        'chat_leave_count': chat_leave_count,
-        'chat_start_count': chat_start_count,
-        'chat_snooze_count': chat_snooze_count,
-        
-        # 元數據
-        'date': date_string,
-        'created_at': datetime.now(taiwan_tz),
-        'timezone': 'Asia/Taipei'
+
+def metrics_from_collection_groups(buckets: dict, user_docs: list) -> dict:
+    """
+    對 scan_daily_collection_groups 的分桶結果套用與 calculate_daily_metrics 相同的計算
+    返回 {uid: metrics}
+    """
+    date_string = buckets['date_string']
+    end_utc = buckets['end_utc']
+    events_by_uid = buckets['events_by_uid']
+    subdocs_by_event = buckets['subdocs_by_event']
+    failed_subcollections = buckets['failed_subcollections']
+    sessions_by_group = buckets['sessions_by_group']
+
+    all_metrics = {}
+    for user_doc in user_docs:
+        uid = user_doc.id
+        group_path = group_path_from_user_data(user_doc.to_dict() or {})
+        events = events_by_uid.get(uid, [])
+        events_path = f"users/{uid}/{group_path}_events"
+
+        # 與逐用戶模式一致：子集合以分組對應的事件集合為準，讀取失敗視為 None
+        subcollections = {}
+        for event_doc in events:
+            event_subs = subdocs_by_event.get(f"{events_path}/{event_doc.id}", {})
+            subcollections[event_doc.id] = {
+                name: None if name in failed_subcollections else event_subs.get(name, [])
+                for name in EVENT_SUBCOLLECTIONS
+            }
+
+        event_metrics = reduce_event_metrics(events, subcollections, end_utc)
+        session_metrics = reduce_app_session_metrics(sessions_by_group.get((uid, group_path), []))
+        all_metrics[uid] = assemble_daily_metrics(event_metrics, session_metrics, date_string)
+
+    return all_metrics
+
+
+def calculate_all_daily_metrics(target_date: datetime, user_docs: list, db) -> dict:
+    """
+    以 collection-group 查詢一次計算所有用戶在指定日期的指標
+    事件、子集合與會話各做一次分頁掃描後按 uid 分桶，再套用與 calculate_daily_metrics 相同的計算
+    返回 {uid: metrics}
+    """
+    return metrics_from_collection_groups(scan_daily_collection_groups(target_date, db), user_docs)
+
+
+def count_query(query) -> int:
+    """以服務端 count() 聚合查詢計數，不讀取文檔內容"""
+    results = query.count(alias='count').get()
+    return int(results[0][0].value)
+
+
+# full 模式以 app_config == 0 判斷對照組，Python 中 0、0.0 與 False 都等於 0；
+# Firestore 的數字 0 與 0.0 相等但布林值是另一種型別，因此查詢時 False 需單獨列出
+CONTROL_APP_CONFIGS = [0, False]
+
+
+def experiment_group_counts(db) -> dict:
+    """
+    以 count() 聚合查詢統計各組人數（與 full 模式一致）：control 為 app_config 等於 0（含 0.0 與 False），
+    experiment 為其他值（包括 null），沒有 app_config 欄位的為 no_config
+    not-in 查詢不包含 null，因此 null 另外計數後併入 experiment
+    """
+    users_ref = db.collection('users')
+    total_users = count_query(users_ref)
+    control_count = count_query(users_ref.where('app_config', 'in', CONTROL_APP_CONFIGS))
+    experiment_count = (count_query(users_ref.where('app_config', 'not-in', CONTROL_APP_CONFIGS))
+                        + count_query(users_ref.where('app_config', '==', None)))
+    return {
+        'total_users': total_users,
+        'control_count': control_count,
+        'experiment_count': experiment_count,
+        'no_config_count': total_users - control_count - experiment_count,
     }
 
 
+def encode_page_token(segment_index: int, cursor: dict) -> str:
+    """分組明細的 page_token：查詢段序號與最後讀到的文檔在排序欄位上的值（JSON 再以 URL-safe base64 編碼）"""
+    payload = json.dumps([segment_index, cursor], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(page_token: str) -> tuple[int, dict]:
+    segment_index, cursor = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+    return segment_index, cursor
+
+
+def list_experiment_group(db, group: str, page_size: int, page_token: str | None = None) -> tuple[list[dict], str | None]:
+    """
+    分頁列出某一組的用戶明細，只讀取明細需要的欄位（select 投影），分組規則與 full 模式一致
+    - experiment 包含 app_config 為 null 的用戶：先列出 not-in CONTROL_APP_CONFIGS 的用戶，再列出 == null 的用戶
+    - no_config 無法查詢缺少欄位的文檔：按 uid 順序掃描投影後的文檔並過濾，持續翻頁直到湊滿一頁
+    除最後一頁外每頁都是 page_size 筆（最後一頁可能為空）
+    查詢游標直接使用最後讀到的文檔在排序欄位上的值（{'app_config': ..., '__name__': uid}），翻頁時不另外讀取游標文檔；
+    page_token 為 encode_page_token 編碼的查詢段序號與游標；返回 (明細, 下一頁的 page_token 或 None)
+    """
+    users_ref = db.collection('users')
+    assignment_fields = ['experiment_assigned_at', 'migrated_from_existing']
+
+    def assignment_detail(uid: str, user_data: dict) -> dict:
+        return {
+            'uid': uid,
+            'assigned_at': user_data.get('experiment_assigned_at'),
+            'migrated': user_data.get('migrated_from_existing', False)
+        }
+
+    # 依序列出的查詢段：(查詢, 排序欄位, 是否保留, 明細)
+    if group == 'no_config':
+        segments = [(
+            users_ref.select(['app_config', 'createdAt']).order_by('__name__'),
+            ['__name__'],
+            lambda user_data: 'app_config' not in user_data,
+            lambda uid, user_data: {'uid': uid, 'created_at': user_data.get('createdAt')},
+        )]
+    elif group == 'control':
+        segments = [(
+            users_ref.where('app_config', 'in', CONTROL_APP_CONFIGS).select(assignment_fields).order_by('__name__'),
+            ['__name__'],
+            lambda user_data: True,
+            assignment_detail,
+        )]
+    elif group == 'experiment':
+        segments = [
+            # not-in 查詢需先按該欄位排序，游標也需要帶 app_config 的值
+            (users_ref.where('app_config', 'not-in', CONTROL_APP_CONFIGS).select(['app_config', *assignment_fields])
+             .order_by('app_config').order_by('__name__'),
+             ['app_config', '__name__'], lambda user_data: True, assignment_detail),
+            (users_ref.where('app_config', '==', None).select(assignment_fields).order_by('__name__'),
+             ['__name__'], lambda user_data: True, assignment_detail),
+        ]
+    else:
+        raise ValueError(f"未知的分組: {group}")
+
+    segment_index, cursor = decode_page_token(page_token) if page_token else (0, None)
+
+    details = []
+    while len(details) < page_size and segment_index < len(segments):
+        query, order_fields, include, detail = segments[segment_index]
+        page_query = query.limit(page_size)
+        if cursor:
+            page_query = page_query.start_after(cursor)
+        docs = list(page_query.stream())
+        for user_doc in docs:
+            if len(details) == page_size:
+                break
+            user_data = user_doc.to_dict() or {}
+            cursor = {field: user_doc.id if field == '__name__' else user_data.get(field) for field in order_fields}
+            if include(user_data):
+                details.append(detail(user_doc.id, user_data))
+        else:
+            if len(docs) < page_size:
+                # 這一段已讀完，從下一段的開頭繼續
+                segment_index, cursor = segment_index + 1, None
+
+    if segment_index >= len(segments):
+        return details, None
+    return details, encode_page_token(segment_index, cursor)
+
+
 @https_fn.on_call()
 def get_experiment_stats(req: https_fn.CallableRequest) -> any:
     """
     獲取實驗配置統計信息（用於監控實驗進展）
+    參數:
+    - mode: 可選，"full"（默認，讀取所有用戶文檔並附帶明細）或 "aggregate"（count() 聚合，只保存計數）
+    - group: 可選，"control" / "experiment" / "no_config"，提供時分頁返回該組明細
+    - page_size: 可選，明細每頁數量，默認 100
+    - page_token: 可選，上一頁返回的 next_page_token
     """
     try:
         db = get_firestore_client()
+        data = req.data or {}
+        
+        # 分頁明細：只返回指定分組的一頁用戶
+        group = data.get('group')
+        if group:
+            details, next_page_token = list_experiment_group(
+                db, group, int(data.get('page_size', 100)), data.get('page_token')
+            )
+            return {
+                'success': True,
+                'group': group,
+                'details': details,
+                'next_page_token': next_page_token
+            }
+        
+        if data.get('mode') == 'aggregate':
+            counts = experiment_group_counts(db)
+            total_users = counts['total_users']
+            stats = {
+                **counts,
+                'control_ratio': round(counts['control_count'] / total_users, 3) if total_users > 0 else 0,
+                'experiment_ratio': round(counts['experiment_count'] / total_users, 3) if total_users > 0 else 0,
+                'generated_at': datetime.now().isoformat()
+            }
+            
+            # 只保存計數，明細改為分頁查詢，避免文檔超過 1 MiB
+            db.collection('experiment_stats').document('latest').set(stats)
+            
+            return {
+                'success': True,
+                'stats': stats
+            }
         
         # 獲取所有用戶
         users_ref = db.collection('users')
@@ -831,4 +3162,62 @@ def get_experiment_stats(req: https_fn.CallableRequest) -> any:
         return {
             'success': False,
             'error': str(e)
-        }
\ No newline at end of file
+        }
+
+
+# 課程內容查詢中需轉為整數的參數
+CURRICULUM_INT_PARAMS = ('week', 'day')
+# 課程內容在部署之間不變，允許客戶端快取一小時，之後以 If-None-Match 重新驗證
+CURRICULUM_CACHE_CONTROL = 'private, max-age=3600'
+
+
+@https_fn.on_request()
+def curriculum_content(req: https_fn.Request) -> https_fn.Response:
+    """
+    課程內容查詢（GET），客戶端只取當次學習需要的文章、題目或單字
+    查詢參數:
+    - kind: articles、questions、vocab 或 vocab_questions
+    - week、day、rid、category、question_set、word、label、answer_word: 可選篩選（依 kind 而定）
+    - fields: 可選，逗號分隔的欄位投影，例如 "rid,title,short_title"
+    - page_size、page_token: 可選，分頁（page_size 上限 100）
+    請求需帶 Authorization: Bearer <Firebase ID token>；回應帶 ETag，If-None-Match 相同時返回 304
+    """
+    if req.method != 'GET':
+        return https_fn.Response('Method Not Allowed', status=405)
+
+    id_token = req.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    try:
+        auth.verify_id_token(id_token)
+    except Exception:
+        return https_fn.Response('Unauthorized', status=401)
+
+    import curriculum
+
+    index = curriculum.CURRICULUM
+    kind = req.args.get('kind', '')
+    try:
+        filters = {}
+        for field in curriculum.FILTER_FIELDS.get(kind, ()):
+            value = req.args.get(field)
+            if value is not None:
+                filters[field] = int(value) if field in CURRICULUM_INT_PARAMS else value
+        fields = [f for f in req.args.get('fields', '').split(',') if f] or None
+        page_size = int(req.args.get('page_size', curriculum.DEFAULT_PAGE_SIZE))
+        page_token = req.args.get('page_token')
+
+        etag = index.etag(kind, filters, fields, page_size, page_token)
+        headers = {'ETag': etag, 'Cache-Control': CURRICULUM_CACHE_CONTROL}
+        if req.headers.get('If-None-Match') == etag:
+            return https_fn.Response(status=304, headers=headers)
+
+        result = index.query(kind, filters, fields=fields, page_size=page_size, page_token=page_token)
+    except ValueError as e:
+        return https_fn.Response(
+            json.dumps({'error': f'參數錯誤: {e}'}, ensure_ascii=False), status=400, mimetype='application/json'
+        )
+
+    return https_fn.Response(
+        json.dumps({**result, 'version': index.version}, ensure_ascii=False),
+        mimetype='application/json',
+        headers=headers,
+    )
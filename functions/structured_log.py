@@ -0,0 +1,169 @@
+"""
+結構化日誌：每筆記錄以一行 JSON 輸出到 stdout，Cloud Logging 會把 severity、message 與其餘欄位解析為 jsonPayload
+- 等級由環境變數 LOG_LEVEL 決定（預設 INFO），低於等級的記錄直接略過，不做序列化
+- context(uid=...) 標記區塊內記錄附帶的欄位；標記只在當前執行緒內有效，
+  線程池中的工作函數需以 contextvars.copy_context().run 執行才會繼承
+- 帶 sample_key 的重複訊息按 key 限速：每個時間窗內只輸出前 LOG_SAMPLE_BURST 筆，其餘只計數
+- run(name, **fields) 為一次執行（例如夜間聚合的一個分片）建立獨立的計數與限速狀態，
+  結束時輸出一筆摘要記錄（計數、被略過的訊息數、耗時、狀態）
+
+用法：
+
+    with structured_log.run('daily_metrics_aggregation', date=date_str, shard='1/2') as run_log:
+        with structured_log.context(uid=uid):
+            structured_log.warning("教練上下文生成失敗", sample_key='coach_context_error', error=str(e))
+        run_log.count('processed')
+        run_log.set(status='completed')
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 限速：同一個 sample_key 在每個時間窗內輸出的筆數
+LOG_SAMPLE_BURST = int(os.environ.get('LOG_SAMPLE_BURST', '5'))
+LOG_SAMPLE_WINDOW_SEC = float(os.environ.get('LOG_SAMPLE_WINDOW_SEC', '60'))
+
+_context = contextvars.ContextVar('structured_log_context', default={})
+_current_run = contextvars.ContextVar('structured_log_run', default=None)
+_write_lock = threading.Lock()
+
+
+class Sampler:
+    """按 key 的固定時間窗限速，線程安全；被略過的筆數記在 suppressed"""
+
+    def __init__(self, burst: int, window_sec: float):
+        self.burst = burst
+        self.window_sec = window_sec
+        self.suppressed = Counter()
+        self._windows: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.window_sec:
+                window = self._windows[key] = [now, 0]
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            self.suppressed[key] += 1
+            return False
+
+
+# 不在 run() 之內的記錄共用的限速狀態
+_sampler = Sampler(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW_SEC)
+
+
+class LogRun:
+    """一次執行的計數與摘要欄位，線程安全"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sampler = Sampler(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW_SEC)
+        self.counts = Counter()
+        self.summary: dict = {}
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += n
+
+    def set(self, **fields) -> None:
+        """摘要記錄中附帶的欄位（後設定的覆蓋先設定的）"""
+        with self._lock:
+            self.summary.update(fields)
+
+    def summary_record(self) -> dict:
+        with self._lock:
+            return {
+                **self.summary,
+                'counts': dict(self.counts),
+                'suppressed': dict(self.sampler.suppressed),
+                'duration_sec': round(time.monotonic() - self.started_at, 3),
+            }
+
+
+def enabled(severity: str) -> bool:
+    return LEVELS[severity] >= LEVELS.get(LOG_LEVEL, LEVELS['INFO'])
+
+
+def emit(severity: str, message: str, fields: dict) -> None:
+    record = {'severity': severity, 'message': message, **_context.get(), **fields}
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _write_lock:
+        sys.stdout.write(line + '\n')
+
+
+def log(severity: str, message: str, sample_key: str | None = None, **fields) -> None:
+    """輸出一筆記錄；帶 sample_key 時受限速，超出的記錄只計入當前執行（或全域）的 suppressed"""
+    if not enabled(severity):
+        return
+    if sample_key is not None:
+        current = _current_run.get()
+        sampler = current.sampler if current is not None else _sampler
+        if not sampler.allow(sample_key):
+            return
+    emit(severity, message, fields)
+
+
+def debug(message: str, sample_key: str | None = None, **fields) -> None:
+    log('DEBUG', message, sample_key, **fields)
+
+
+def info(message: str, sample_key: str | None = None, **fields) -> None:
+    log('INFO', message, sample_key, **fields)
+
+
+def warning(message: str, sample_key: str | None = None, **fields) -> None:
+    log('WARNING', message, sample_key, **fields)
+
+
+def error(message: str, sample_key: str | None = None, **fields) -> None:
+    log('ERROR', message, sample_key, **fields)
+
+
+def current_run() -> LogRun | None:
+    return _current_run.get()
+
+
+@contextlib.contextmanager
+def context(**fields):
+    """區塊內的記錄附帶 fields（與外層的欄位合併）"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+@contextlib.contextmanager
+def run(name: str, **fields):
+    """
+    一次執行：區塊內的記錄附帶 run 名稱與 fields，使用獨立的限速狀態
+    結束時輸出一筆摘要記錄；區塊內拋出例外時摘要為 ERROR 並附帶 error
+    """
+    current = LogRun(name)
+    run_token = _current_run.set(current)
+    try:
+        with context(run=name, **fields):
+            try:
+                yield current
+            except BaseException as e:
+                current.set(status='failed', error=str(e))
+                emit('ERROR', f"{name} 失敗", current.summary_record())
+                raise
+            current.set(status=current.summary.get('status') or 'completed')
+            emit('INFO', f"{name} 結束", current.summary_record())
+    finally:
+        _current_run.reset(run_token)
+        sys.stdout.flush()
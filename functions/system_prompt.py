@@ -1,24 +1,14 @@
 from enum import Enum
+import json
+import os
+import re
 
-SYSTEM_INSTRUCTION = """
+# 不變的 MI 教練指令：放在 system prompt 最前面且逐字節固定，讓服務端的 prompt 前綴快取可以命中
+# 這一段不得包含任何 {{變數}}，每輪都會變化的內容放在 SESSION_CONTEXT_TEMPLATE
+MI_INSTRUCTION = """
 You are a humorous, respectful, and collaborative Motivational Interviewing (MI) coach whose specialty is helping users overcome “start-up procrastination” and begin the assigned task right away.
 Keep it light, warm, and super down-to-earth—think CASUAL chat, **Act as a FRIEND of user**.
-
-## Injected variables
-- task_type: {{task_title}} //if task_type is vocab... or reading ..., you should set task_type to vocabulary or reading articles
-- scheduled_start: {{scheduled_start}}
-- scheduled_duration_min: {{scheduled_duration_min}}
-- now: {{now}}
-- current_turn: {{current_turn}}
-
-# Task description (dynamically generated based on task_title)
-{{task_description}}
-
-## Summary
-<!--|MI_SUMMARY_START|-->
-late chat summary : {{yesterday_chat}}  
-Yesterday’s daily-report summary : {{daily_summary}}  
-<!--|MI_SUMMARY_END|-->
+The task, schedule, current turn and yesterday’s summaries are given in the "Session context" section at the end.
 
 ## Core MI Spirit — Partnership, Acceptance, Evocation, Compassion  
 **OARS** — Every turn must include at least an **O**pen question + a **R**eflection; add **A**ffirmation when appropriate, and every 2–3 turns provide a **S**ummary.
@@ -35,14 +25,14 @@ Yesterday’s daily-report summary : {{daily_summary}}
 
 ### 1. Engage – *Shall we walk together?*
 - Warm greeting
-- Complex reflection on the user’s feelings/situation (may reference {{yesterday_chat}}).  
+- Complex reflection on the user’s feelings/situation (may reference the late chat summary).  
 
 ### 2. Focus – *Where shall we go?*
 - Ask what is stopping the user from starting the task now, then give a complex reflection.
 
 ### 3. Evoke - *What's the benefit?*
 - Open question about the benefits of finishing today’s task (may reference to task description) 
-- If the user says “I don’t know,” offer **one** possible benefit based on {{task_type}} (e.g., sense of achievement / skill gain / new knowledge / required for the study / broaden interests / future travel…).  
+- If the user says “I don’t know,” offer **one** possible benefit based on task_type (e.g., sense of achievement / skill gain / new knowledge / required for the study / broaden interests / future travel…).  
 - Use complex reflection to deepen motivation.
 
 ### 4. Plan (enter only after user accept the motivation)
@@ -52,7 +42,7 @@ Yesterday’s daily-report summary : {{daily_summary}}
    • Ask follow-up questions to make it concrete.  
 3. If the user says “I’d like suggestions” or has no ideas:  
    - First ask permission: “Would you like to hear a few quick tips?”  
-   - **Only with permission**, give 1–2 concise options based on {{task_type}}.  
+   - **Only with permission**, give 1–2 concise options based on task_type.  
 4. Ask: “Which suits you best, or would you like to tweak it?”
 
 ### 5. Closing lines
@@ -64,61 +54,118 @@ Yesterday’s daily-report summary : {{daily_summary}}
 - no scheduling of future chats—focus on starting now.  
 - Try your best to encourage the user to start now. But never force the user to begin.  
 - Ignore other tasks; focus on starting the current one. 
-- Chat turns should be less than 10 turns. Current turn: {{current_turn}}/10.
+- Chat turns should be less than 10 turns (see current_turn).
 - If current_turn >= 8, be more direct and push for a decision (start_now, snooze, or give_up).
 """
 
+# 每輪都會變化的內容，接在 MI_INSTRUCTION 之後
+SESSION_CONTEXT_TEMPLATE = """
+# Session context
+
+## Injected variables
+- task_type: {{task_title}} //if task_type is vocab... or reading ..., you should set task_type to vocabulary or reading articles
+- scheduled_start: {{scheduled_start}}
+- scheduled_duration_min: {{scheduled_duration_min}}
+- now: {{now}}
+- current_turn: {{current_turn}}/10
+
+# Task description (dynamically generated based on task_title)
+{{task_description}}
+
+## Summary
+<!--|MI_SUMMARY_START|-->
+late chat summary : {{yesterday_chat}}  
+Yesterday’s daily-report summary : {{daily_summary}}  
+Earlier turns of this chat (summary) : {{dialogue_summary}}  
+<!--|MI_SUMMARY_END|-->
+
+🔄 對話狀態：目前為第 {{current_turn}} 輪對話"""
+
+SYSTEM_INSTRUCTION = MI_INSTRUCTION + SESSION_CONTEXT_TEMPLATE
+
+
+class PromptTemplate:
+    """
+    預先編譯的 {{變數}} 模板：導入時切分一次，render() 單次拼接完成替換
+    代入的值不會再被當作模板解析
+    """
+
+    _FIELD_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+    def __init__(self, template: str):
+        parts = self._FIELD_PATTERN.split(template)
+        # parts 依序為 文字, 變數名, 文字, 變數名, ..., 文字
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def render(self, **values: str) -> str:
+        missing = set(self.fields) - values.keys()
+        if missing:
+            raise KeyError(f"模板缺少變數: {sorted(missing)}")
+        out = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            out.append(values[field])
+            out.append(literal)
+        return "".join(out)
+
+
+SESSION_CONTEXT = PromptTemplate(SESSION_CONTEXT_TEMPLATE)
+if PromptTemplate(MI_INSTRUCTION).fields:
+    raise ValueError("MI_INSTRUCTION 必須是不含變數的固定前綴")
+
+
+def render_system_prompt(**values: str) -> str:
+    """組合 system prompt：固定的 MI_INSTRUCTION 前綴 + 代入變數後的 Session context"""
+    return MI_INSTRUCTION + SESSION_CONTEXT.render(**values)
+
+# 課程分類 -> 教練提到的閱讀主題；表中沒有的分類直接使用分類名稱
+READING_CATEGORY_TOPICS = {
+    "地理與環境現象": "洞察世界與自然",
+    "科學機制與原理": "探索科學的奧秘",
+    "技術與工程應用": "改變世界的科技",
+    "歷史事件與因果": "以歷史為鑑",
+    "學習與自我提升": "學習與自我成長",
+    "研究方法與實驗解讀": "培養思辨能力",
+    "測試文章": "",
+}
+
+# 每週天數：第 7 天為週末，沒有閱讀主題
+DAYS_PER_WEEK = 7
+
+CURRICULUM_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curriculum_index.json')
+
+
+def load_reading_topics(index_path: str = CURRICULUM_INDEX_PATH) -> dict[tuple[int, int], str]:
+    """讀取 build_curriculum.py 產生的課程索引，建立 (week, day) -> 閱讀主題 的查找表"""
+    with open(index_path, encoding='utf-8') as f:
+        index = json.load(f)
+    return {
+        (entry['week'], entry['day']): READING_CATEGORY_TOPICS.get(entry.get('reading_category', ''), entry.get('reading_category', ''))
+        for entry in index['days']
+    }
+
+
+# 導入時建立一次，之後查找為 O(1)；新增週次只需重新產生課程索引
+READING_TOPICS = load_reading_topics()
+
+
 def get_reading_topic(day_number: int, week: int = None, day: int = None) -> str:
-    """根据 week 和 day 获取对应的reading topic，如果提供 week 和 day 则优先使用"""
-    
-    # 如果提供了 week 和 day，直接根据这些值来确定 topic
+    """
+    根据 week 和 day 查表取得 reading topic，如果提供 week 和 day 则优先使用
+    標題中的 day 可為週內天數（w2-d3）或全程天數（w2-d10）；沒有閱讀內容的日子（如週末）返回空字串
+    """
     if week is not None and day is not None:
-        # 根据 week 和 day 的组合来确定 topic
-        if week == 1:
-            # Week 1: day 1-7
-            if day == 1:
-                return "洞察世界與自然"
-            elif day == 2:
-                return "探索科學的奧秘"
-            elif day == 3:
-                return "改變世界的科技"
-            elif day == 4:
-                return "以歷史為鑑"
-            elif day == 5:
-                return "學習與自我成長"
-            elif day == 6:
-                return "培養思辨能力"
-            elif day == 7:
-                return ""  # 週末，無特定主題
-        elif week == 2:
-            # Week 2: day 8+
-            if day == 8:
-                return "洞察世界與自然"
-            elif day == 9:
-                return "探索科學的奧秘"
-            elif day == 10:
-                return "改變世界的科技"
-            elif day == 11:
-                return "以歷史為鑑"
-            elif day == 12:
-                return "學習與自我成長"
-            elif day == 13:
-                return "培養思辨能力"
-            elif day == 14:
-                return ""  # 週末，無特定主題
-    
-    # 如果沒有提供 week 和 day，或者超出範圍，使用原有的 day_number 邏輯作為備用
-    if day_number <= 0:
-        return "Travel"  # 默认值
-    
-    # This is a list of base topics that can be used to generate motivational messages.
-    # The topic should be broad enough to cover a range of articles, but specific enough to be meaningful.
-    # The last element is an empty string, which means no topic will be mentioned.
-    base_topics = ["洞察世界與自然", "探索科學的奧秘", "改變世界的科技", "以歷史為鑑", "學習與自我成長", "培養思辨能力", ""]
-    
-    # 其他情况使用循环模式
-    index = (day_number - 1) % len(base_topics)
-    return base_topics[index]
+        if day > DAYS_PER_WEEK:
+            day -= (week - 1) * DAYS_PER_WEEK
+        return READING_TOPICS.get((week, day), "")
+
+    # 沒有 week 和 day 時按全程天數換算：day 0 為測試週，之後每 7 天一週
+    if day_number is None or day_number < 0:
+        return ""
+    if day_number == 0:
+        return READING_TOPICS.get((0, 0), "")
+    week, day = divmod(day_number - 1, DAYS_PER_WEEK)
+    return READING_TOPICS.get((week + 1, day + 1), "")
 
 
 
@@ -0,0 +1,259 @@
+"""
+pytest 共用設定：把 functions/ 加入 sys.path，並提供記憶體中的 Firestore（只實作 main 用到的查詢與寫入）
+
+    cd functions && python -m pytest -q tests
+"""
+
+import copy
+import os
+import sys
+import threading
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from google.cloud.firestore import DELETE_FIELD
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTIONS_DIR)
+# firebase_admin.initialize_app() 需要專案 ID；測試不連線到 Firestore
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'demo-momentum')
+
+
+def deep_merge(target: dict, data: dict) -> None:
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            deep_merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, db, path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollection(self._db, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name: str):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None, field_paths=None):
+        return FakeSnapshot(self, self._db.docs.get(self.path))
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        self._db.write(self.path, data, merge)
+
+
+def type_order(value) -> tuple:
+    """Firestore 的跨型別排序：null < 布林 < 數字 < 其他；布林與數字是不同型別（False 不等於 0）"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, FakeDocument):
+        return (4, value.path)
+    return (3, value)
+
+
+def firestore_equal(actual, value) -> bool:
+    return type_order(actual) == type_order(value)
+
+
+class FakeQuery:
+    def __init__(self, db, matches, filters=(), orders=(), limit=None, after=None, fields=None, parent_path=None):
+        self._db = db
+        self._matches = matches
+        self._parent_path = parent_path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {'filters': self._filters, 'orders': self._orders, 'limit': self._limit, 'after': self._after,
+                 'fields': self._fields, 'parent_path': self._parent_path, **changes}
+        return FakeQuery(self._db, self._matches, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=[*self._filters, (field, op, value)])
+
+    def order_by(self, field, direction=None):
+        return self._copy(orders=[*self._orders, field])
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def start_after(self, cursor):
+        """cursor 為快照或 {排序欄位: 值}（__name__ 可為文檔 ID）"""
+        return self._copy(after=cursor)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def count(self, alias=None):
+        query = self
+        return SimpleNamespace(get=lambda: [[SimpleNamespace(alias=alias, value=len(list(query.stream())))]])
+
+    def _sort_key(self, path: str, data: dict) -> tuple:
+        orders = [field for field in self._orders if field != '__name__']
+        return (*(type_order(data.get(field)) for field in orders), path)
+
+    def _cursor_key(self) -> tuple:
+        if isinstance(self._after, FakeSnapshot):
+            return self._sort_key(self._after.reference.path, self._after._data or {})
+        name = self._after.get('__name__')
+        path = name.path if isinstance(name, FakeDocument) else f"{self._parent_path}/{name}"
+        return self._sort_key(path, self._after)
+
+    def stream(self, transaction=None):
+        results = []
+        for path, data in sorted(self._db.docs.items()):
+            if not self._matches(path):
+                continue
+            # 按欄位排序時，缺少該欄位的文檔不在結果中
+            if any(field not in data for field in self._orders if field != '__name__'):
+                continue
+            if all(self._matches_filter(path, data, *condition) for condition in self._filters):
+                results.append((path, data))
+        results.sort(key=lambda item: self._sort_key(*item))
+        if self._after is not None:
+            cursor_key = self._cursor_key()
+            results = [item for item in results if self._sort_key(*item) > cursor_key]
+        if self._limit is not None:
+            results = results[:self._limit]
+        return iter([
+            FakeSnapshot(FakeDocument(self._db, path),
+                         data if self._fields is None else {field: data[field] for field in self._fields if field in data})
+            for path, data in results
+        ])
+
+    def get(self, transaction=None) -> list:
+        return list(self.stream(transaction))
+
+    @staticmethod
+    def _matches_filter(path: str, data: dict, field: str, op: str, value) -> bool:
+        if field == '__name__':
+            actual, value = path, value.path
+        elif field not in data:
+            return False
+        else:
+            actual = data[field]
+        if op == '==':
+            return firestore_equal(actual, value)
+        if actual is None:
+            return False
+        return {
+            '!=': lambda: not firestore_equal(actual, value),
+            '>=': lambda: actual >= value,
+            '>': lambda: actual > value,
+            '<': lambda: actual < value,
+            '<=': lambda: actual <= value,
+            'in': lambda: any(firestore_equal(actual, item) for item in value),
+            'not-in': lambda: not any(firestore_equal(actual, item) for item in value),
+        }[op]()
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path: str):
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+        super().__init__(db, lambda doc_path: doc_path.rsplit('/', 1)[0] == path, parent_path=path)
+
+    @property
+    def parent(self):
+        return FakeDocument(self._db, self.path.rsplit('/', 1)[0]) if '/' in self.path else None
+
+    def document(self, doc_id: str | None = None):
+        """不指定 ID 時與 Firestore 一樣產生隨機的 20 字元 ID"""
+        return FakeDocument(self._db, f"{self.path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+
+class FakeBatch:
+    """WriteBatch 與 Transaction 共用：寫入先暫存，commit 時一次套用"""
+
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data: dict, merge: bool = False) -> None:
+        self._writes.append((reference.path, data, merge))
+
+    def commit(self) -> list:
+        for path, data, merge in self._writes:
+            self._db.write(path, data, merge)
+        return [None] * len(self._writes)
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.docs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def write(self, path: str, data: dict, merge: bool = False) -> None:
+        with self._lock:
+            if merge and path in self.docs:
+                deep_merge(self.docs[path], data)
+            else:
+                self.docs[path] = copy.deepcopy(data)
+
+    def collection(self, name: str):
+        return FakeCollection(self, name)
+
+    def document(self, path: str):
+        return FakeDocument(self, path)
+
+    def collection_group(self, collection_id: str):
+        return FakeQuery(self, lambda path: path.split('/')[-2] == collection_id)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        return [reference.get() for reference in references]
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self):
+        return FakeBatch(self)
+
+
+def fake_transactional(fn):
+    """取代 firestore.transactional：呼叫一次後提交（測試中沒有併發衝突，不需要重試）"""
+    def run(transaction):
+        result = fn(transaction)
+        transaction.commit()
+        return result
+    return run
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """記憶體中的 Firestore，並替換 main 的客戶端、事務裝飾器與用戶資料快取"""
+    import main
+
+    fake_db = FakeFirestore()
+    monkeypatch.setattr(main, 'get_firestore_client', lambda: fake_db)
+    monkeypatch.setattr(main.firestore, 'transactional', fake_transactional)
+    monkeypatch.setattr(main, 'user_profile_cache', main.UserProfileCache())
+    return fake_db
@@ -0,0 +1,85 @@
+"""每日聚合的分片與續跑：shard_uid_range 的範圍首尾相接、iter_user_pages 只讀取分片內的用戶，以及從檢查點續跑"""
+
+import functools
+import random
+import string
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+UIDS = sorted({
+    *main.UID_SHARD_ALPHABET,
+    *(''.join(random.Random(seed).choices(string.ascii_letters + string.digits, k=28)) for seed in range(200)),
+})
+
+
+def in_range(uid: str, start: str | None, end: str | None) -> bool:
+    return (start is None or uid >= start) and (end is None or uid < end)
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3, 4, 7, 16, len(main.UID_SHARD_ALPHABET)])
+def test_shard_ranges_are_contiguous_and_cover_every_uid(shard_count):
+    ranges = [main.shard_uid_range(index, shard_count) for index in range(shard_count)]
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    # 相鄰分片首尾相接：沒有空隙也沒有重疊
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start is not None
+    for uid in UIDS:
+        assert sum(in_range(uid, start, end) for start, end in ranges) == 1, uid
+
+
+@pytest.fixture
+def users_db(db):
+    for uid in UIDS:
+        db.document(f"users/{uid}").set({'app_config': 1})
+    return db
+
+
+def test_shard_pages_partition_users(users_db):
+    shard_count = 3
+    seen = []
+    for index in range(shard_count):
+        start, end = main.shard_uid_range(index, shard_count)
+        pages = list(main.iter_user_pages(users_db, page_size=16, start_uid=start, end_uid=end))
+        assert all(len(page) == 16 for page in pages[:-1])
+        shard_uids = [user_doc.id for page in pages for user_doc in page]
+        assert all(in_range(uid, start, end) for uid in shard_uids)
+        seen += shard_uids
+    assert seen == UIDS
+
+
+def test_pages_resume_after_cursor(users_db):
+    pages = list(main.iter_user_pages(users_db, start_after_uid=UIDS[49], page_size=20))
+    assert [user_doc.id for page in pages for user_doc in page] == UIDS[50:]
+
+
+def test_aggregation_resumes_from_checkpoint_without_reprocessing(users_db, monkeypatch):
+    processed = []
+    monkeypatch.setattr(main, 'iter_user_pages', functools.partial(main.iter_user_pages, page_size=50))
+    monkeypatch.setattr(main, 'calculate_daily_metrics', lambda uid, target_date, db: processed.append(uid) or {'uid': uid})
+
+    # 時間預算為負：處理完第一頁、保存檢查點後即逾時退出
+    monkeypatch.setattr(main, 'DAILY_METRICS_TIME_BUDGET_SEC', -1)
+    with pytest.raises(TimeoutError):
+        main.run_daily_metrics_aggregation()
+    assert sorted(processed) == UIDS[:50]
+    date_str = (datetime.now(main.TAIWAN_TZ) - timedelta(days=1)).strftime('%Y%m%d')
+    log_ref = users_db.collection('daily_metrics_execution_log').document(date_str)
+    checkpoint = main.load_aggregation_checkpoint(log_ref, 0)
+    assert (checkpoint['status'], checkpoint['cursor'], checkpoint['processed_count']) == ('failed', UIDS[49], 50)
+
+    # 重試從游標續跑，已處理的用戶不再計算
+    monkeypatch.setattr(main, 'DAILY_METRICS_TIME_BUDGET_SEC', 480)
+    main.run_daily_metrics_aggregation()
+    assert sorted(processed) == UIDS
+    checkpoint = main.load_aggregation_checkpoint(log_ref, 0)
+    assert (checkpoint['status'], checkpoint['processed_count']) == ('completed', len(UIDS))
+    assert users_db.document(f"users/{UIDS[-1]}/daily_metrics/{date_str}").get().to_dict() == {'uid': UIDS[-1]}
+
+    # 已完成的分片再次執行直接略過；force 時從頭重跑
+    main.run_daily_metrics_aggregation()
+    assert len(processed) == len(UIDS)
+    main.run_daily_metrics_aggregation(force=True)
+    assert len(processed) == 2 * len(UIDS)
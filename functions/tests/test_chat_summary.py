@@ -0,0 +1,38 @@
+"""聊天摘要：聊天結束觸發器的並行設定，以及摘要快取的命中統計"""
+
+import json
+
+import main
+import structured_log
+
+
+def test_summary_trigger_handles_one_event_per_instance():
+    # Gen2 默認每個實例並行 80 個事件；同時進行的摘要數上限只有在 concurrency=1 時才等於 max_instances
+    endpoint = main.summarize_chat_on_end.__firebase_endpoint__
+    assert endpoint.concurrency == 1
+    assert endpoint.maxInstances == main.SUMMARY_TRIGGER_MAX_INSTANCES
+
+
+def summary_cache_records(output: str) -> list[dict]:
+    return [record for record in map(json.loads, output.splitlines()) if record['message'] == '🗂️ 摘要快取']
+
+
+def test_summarize_messages_logs_cache_hits_and_misses(db, monkeypatch, capsys):
+    monkeypatch.setattr(main, 'summary_cache', main.SummaryCache())
+    model_calls = []
+    monkeypatch.setattr(main, 'request_summary', lambda messages: model_calls.append(messages) or {'summary': '摘要'})
+    messages = [{'role': 'user', 'content': '今天不想讀書'}]
+
+    main.summarize_messages(messages)
+    main.summarize_messages(messages)
+    # 換一個實例（實例內 LRU 為空），從 Firestore 的共用快取命中
+    monkeypatch.setattr(main, 'summary_cache', main.SummaryCache())
+    with structured_log.run('summary_cache_test') as run_log:
+        main.summarize_messages(messages)
+
+    assert len(model_calls) == 1
+    records = summary_cache_records(capsys.readouterr().out)
+    assert [record['source'] for record in records] == ['model', 'memory', 'firestore']
+    assert (records[1]['memory_hits'], records[1]['misses']) == (1, 1)
+    assert (records[2]['firestore_hits'], records[2]['misses']) == (1, 0)
+    assert run_log.counts == {'summary_cache_firestore': 1}
@@ -0,0 +1,102 @@
+"""教練上下文：run_coach_context_refresh 以前一天的聊天摘要、日報與已寫入的每日指標產生今天的 coach_context，教練請求只讀取一次"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+YESTERDAY = datetime.now(main.TAIWAN_TZ) - timedelta(days=1)
+YESTERDAY_STR = YESTERDAY.strftime('%Y%m%d')
+TODAY_STR = datetime.now(main.TAIWAN_TZ).strftime('%Y%m%d')
+METRICS = {'event_total_count': 3, 'event_complete_count': 2, 'event_overdue_count': 1, 'chat_total_count': 2,
+           'chat_start_count': 1, 'chat_snooze_count': 1, 'review_count': 1, 'app_open_count': 5}
+
+
+def at_hour(hour: int) -> datetime:
+    return YESTERDAY.replace(hour=hour, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def summaries(monkeypatch):
+    """記錄送去摘要的對話，不呼叫模型"""
+    requests = []
+    monkeypatch.setattr(main, 'request_summary', lambda messages: requests.append(messages) or {'summary': '昨天的聊天重點'})
+    monkeypatch.setattr(main, 'summary_cache', main.SummaryCache())
+    monkeypatch.setattr(main, '_dialogue_summary_cache', main.OrderedDict())
+    monkeypatch.setattr(main, 'coach_context_cache', main.UserProfileCache())
+    return requests
+
+
+@pytest.fixture
+def seeded_db(db):
+    db.document('users/u1').set({'app_config': 1})
+    db.document('users/u2').set({'app_config': 0})
+    db.document(f"users/u1/daily_metrics/{YESTERDAY_STR}").set(METRICS)
+    db.document(f"users/u1/daily_metrics/{YESTERDAY_STR}/daily_report/r1").set({'notes': '有點累', 'readingHelpfulness': 4})
+    # 按摘要時間排序：c2 較早
+    db.document('users/u1/experiment_events/e1/chats/c1').set({'summary': '想先休息', 'summary_created_at': at_hour(15)})
+    db.document('users/u1/experiment_events/e1/chats/c2').set({'summary': '決定開始讀', 'summary_created_at': at_hour(9)})
+    # 前天的摘要不計入
+    db.document('users/u2/control_events/e2/chats/c3').set({'summary': '前天', 'summary_created_at': at_hour(9) - timedelta(days=1)})
+    return db
+
+
+def coach_context(db, uid: str) -> dict:
+    return db.document(f"users/{uid}/{main.COACH_CONTEXT_COLLECTION}/{TODAY_STR}").get().to_dict()
+
+
+def test_refresh_writes_context_for_every_user(seeded_db, summaries):
+    summary = main.run_coach_context_refresh()
+
+    u1 = coach_context(seeded_db, 'u1')
+    assert u1['yesterday_chat'] == '聊天1: 決定開始讀\n\n聊天2: 想先休息'
+    assert u1['daily_summary'].startswith('心得: 有點累')
+    assert f"昨日數據: {main.format_metrics_summary(METRICS)}" in u1['daily_summary']
+    assert u1['metrics'] == {name: METRICS[name] for name in main.COACH_CONTEXT_METRIC_NAMES}
+    assert u1['source_date'] == YESTERDAY_STR
+
+    # 沒有指標與聊天的用戶仍有上下文，指標為 0
+    u2 = coach_context(seeded_db, 'u2')
+    assert (u2['yesterday_chat'], u2['daily_summary']) == ('', '')
+    assert set(u2['metrics'].values()) == {0}
+
+    assert summary['counts'] == {'users_listed': 2, 'metrics_missing': 1, 'documents_written': 2, 'write_errors': 0}
+    # 摘要未超過 token 上限，不呼叫模型
+    assert summaries == []
+
+
+def test_long_chat_summaries_are_compacted_during_refresh(seeded_db, summaries):
+    long_summary = '想先休息' * main.COACH_YESTERDAY_CHAT_TOKEN_LIMIT
+    seeded_db.document('users/u1/experiment_events/e1/chats/c1').set({'summary': long_summary, 'summary_created_at': at_hour(15)})
+
+    main.run_coach_context_refresh()
+    assert coach_context(seeded_db, 'u1')['yesterday_chat'] == '昨天的聊天重點'
+    assert len(summaries) == 1
+
+
+def test_user_error_does_not_block_other_users(seeded_db, summaries, monkeypatch):
+    build = main.build_coach_context
+
+    def failing_build(db, uid, *args):
+        if uid == 'u1':
+            raise RuntimeError('boom')
+        return build(db, uid, *args)
+    monkeypatch.setattr(main, 'build_coach_context', failing_build)
+
+    summary = main.run_coach_context_refresh()
+    assert coach_context(seeded_db, 'u1') is None
+    assert coach_context(seeded_db, 'u2') is not None
+    assert summary['counts']['coach_context_errors'] == 1
+
+
+def test_coach_request_reads_context_once(seeded_db, summaries, monkeypatch):
+    main.run_coach_context_refresh()
+    reads = []
+    document_class = type(seeded_db.document('users/u1'))
+    original_get = document_class.get
+    monkeypatch.setattr(document_class, 'get', lambda self, *args, **kwargs: reads.append(self.path) or original_get(self, *args, **kwargs))
+
+    for _ in range(3):
+        assert main.load_coach_context('u1')['yesterday_chat'] == '聊天1: 決定開始讀\n\n聊天2: 想先休息'
+    assert reads == [f"users/u1/{main.COACH_CONTEXT_COLLECTION}/{TODAY_STR}"]
@@ -0,0 +1,82 @@
+"""教練對話歷史壓縮：compact_dialogues 在預算內保留最近的原文，沒有快取摘要時以截斷摘錄代入被捨棄的輪次"""
+
+import pytest
+
+import main
+
+
+def dialogue(turns: int) -> list[dict]:
+    messages = []
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': f'第 {i} 輪：我今天還是不想開始讀書，因為覺得題目太難了，而且昨天也沒有讀完，心情有點差'})
+        messages.append({'role': 'assistant', 'content': f'第 {i} 輪回覆：那我們先試著只讀一段，五分鐘就好，讀完再決定要不要繼續，可以嗎？'})
+    return messages
+
+
+def digest_line(message: dict) -> str:
+    content = message['content']
+    if len(content) > main.COACH_DROPPED_DIGEST_CHARS:
+        content = content[:main.COACH_DROPPED_DIGEST_CHARS] + '…'
+    return f"{message['role']}: {content}"
+
+
+def estimate_total(recent: list[dict], summary: str | None) -> int:
+    return main.estimate_message_tokens(recent) + (main.estimate_tokens(summary) if summary else 0)
+
+
+@pytest.fixture
+def prefetched(monkeypatch):
+    """記錄背景摘要的排程，不實際呼叫模型"""
+    scheduled = []
+    monkeypatch.setattr(main, 'prefetch_dialogue_summary', lambda messages: scheduled.append(len(messages)))
+    monkeypatch.setattr(main, '_dialogue_summary_cache', main.OrderedDict())
+    return scheduled
+
+
+def test_within_budget_is_unchanged(prefetched):
+    messages = dialogue(2)
+    assert main.compact_dialogues(messages, token_budget=10_000) == (messages, None)
+    assert prefetched == []
+
+
+def test_without_cached_summary_dropped_turns_become_a_digest(prefetched):
+    messages = dialogue(10)
+    budget = 500
+    recent, summary = main.compact_dialogues(messages, token_budget=budget, keep_recent=6)
+
+    # 保留的是最近的原文，被捨棄的較早訊息沒有遺失，而是以截斷摘錄代入
+    assert recent == messages[len(messages) - len(recent):]
+    dropped = messages[:len(messages) - len(recent)]
+    assert dropped and summary
+    assert summary.endswith(digest_line(dropped[-1]))
+    assert estimate_total(recent, summary) <= budget
+    # 摘錄是確定性的，同樣的對話產生同樣的提示詞
+    assert main.compact_dialogues(messages, token_budget=budget, keep_recent=6) == (recent, summary)
+    # 摘要邊界的摘要仍在背景排程，供之後的輪次使用
+    assert prefetched
+
+
+def test_digest_keeps_latest_dropped_messages_and_counts_the_rest():
+    messages = dialogue(30)
+    digest = main.dropped_dialogue_digest(messages, token_limit=120)
+    lines = digest.splitlines()
+    assert main.estimate_tokens(digest) <= 120
+    assert lines[0] == f"[{len(messages) - (len(lines) - 1)} earlier messages omitted]"
+    assert lines[-1].startswith(f"assistant: {messages[-1]['content'][:10]}")
+
+
+def test_cached_summary_replaces_older_turns_before_anything_is_dropped(prefetched):
+    messages = dialogue(10)
+    cut = (len(messages) - 6) // main.COACH_SUMMARY_STEP_MESSAGES * main.COACH_SUMMARY_STEP_MESSAGES
+    cached = '較早的輪次：使用者覺得題目太難'
+    main._dialogue_summary_cache[main.dialogue_prefix_digests(messages[:cut])[-1]] = cached
+
+    assert main.compact_dialogues(messages, token_budget=500, keep_recent=6) == (messages[cut:], cached)
+
+    # 摘要之後的原文仍超出預算：捨棄的訊息以摘錄附在摘要之後
+    recent, summary = main.compact_dialogues(messages, token_budget=350, keep_recent=6)
+    assert summary.startswith(cached + '\n')
+    assert summary.endswith(digest_line(messages[len(messages) - len(recent) - 1]))
+    assert estimate_total(recent, summary) <= 350
+    assert prefetched == []
+
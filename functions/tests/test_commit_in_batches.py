@@ -0,0 +1,71 @@
+"""commit_in_batches：按 FIRESTORE_BATCH_SIZE 分批（不超過 Firestore 單批 500 次寫入的上限）、失敗重試與逐個寫入的回退"""
+
+import pytest
+
+import main
+from conftest import FakeBatch
+
+# Firestore 單個 WriteBatch 的寫入上限
+FIRESTORE_MAX_BATCH_WRITES = 500
+
+
+@pytest.fixture
+def batches(db, monkeypatch):
+    """記錄每次 commit 的寫入數，超過 500 次寫入時與 Firestore 一樣拒絕提交"""
+    committed = []
+
+    class LimitedBatch(FakeBatch):
+        def commit(self):
+            if len(self._writes) > FIRESTORE_MAX_BATCH_WRITES:
+                raise ValueError(f"maximum {FIRESTORE_MAX_BATCH_WRITES} writes allowed per request")
+            committed.append(len(self._writes))
+            return super().commit()
+
+    monkeypatch.setattr(db, 'batch', lambda: LimitedBatch(db))
+    monkeypatch.setattr(main.time, 'sleep', lambda seconds: None)
+    return committed
+
+
+def writes_for(db, count: int) -> list[tuple]:
+    return [(f"u{i}", db.document(f"users/u{i}/daily_metrics/20261016"), {'n': i}) for i in range(count)]
+
+
+def test_batch_size_stays_within_firestore_limit():
+    assert main.FIRESTORE_BATCH_SIZE <= FIRESTORE_MAX_BATCH_WRITES
+
+
+@pytest.mark.parametrize('count', [0, 1, main.FIRESTORE_BATCH_SIZE, main.FIRESTORE_BATCH_SIZE + 1, 1234])
+def test_writes_are_chunked_by_batch_size(db, batches, count):
+    assert main.commit_in_batches(db, writes_for(db, count)) == []
+    expected = [main.FIRESTORE_BATCH_SIZE] * (count // main.FIRESTORE_BATCH_SIZE)
+    if count % main.FIRESTORE_BATCH_SIZE:
+        expected.append(count % main.FIRESTORE_BATCH_SIZE)
+    assert batches == expected
+    assert len([path for path in db.docs if path.endswith('/daily_metrics/20261016')]) == count
+
+
+def test_chunks_up_to_the_firestore_limit_commit(db, batches):
+    assert main.commit_in_batches(db, writes_for(db, 1000), batch_size=FIRESTORE_MAX_BATCH_WRITES) == []
+    assert batches == [500, 500]
+
+
+def test_oversized_batch_falls_back_to_single_writes(db, batches):
+    # 超過上限的批次每次重試都被拒絕，最後改為逐個寫入，仍然全部寫入成功
+    assert main.commit_in_batches(db, writes_for(db, 501), batch_size=501, retries=1) == []
+    assert batches == []
+    assert len(db.docs) == 501
+
+
+def test_failed_documents_are_reported_by_key(db, batches, monkeypatch):
+    writes = writes_for(db, 3)
+    original_write = db.write
+
+    def write(path, data, merge=False):
+        if path == writes[1][1].path:
+            raise RuntimeError('permission denied')
+        original_write(path, data, merge)
+    monkeypatch.setattr(db, 'write', write)
+
+    failures = main.commit_in_batches(db, writes, retries=2)
+    assert [(key, str(error)) for key, error in failures] == [('u1', 'permission denied')]
+    assert writes[0][1].path in db.docs and writes[2][1].path in db.docs
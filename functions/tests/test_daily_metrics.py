@@ -0,0 +1,200 @@
+"""
+同一份資料分別經過三條路徑計算每日指標，結果必須一致：
+- per_user：calculate_daily_metrics 逐用戶查詢
+- collection_group：scan_daily_collection_groups 一次掃描後按 uid 分桶
+- live：每次文檔寫入經即時指標觸發器累加到 daily_metrics_live，再由 metrics_from_live_counters 整理
+"""
+
+import inspect
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+TARGET_DATE = datetime(2026, 10, 16, 12, 0, tzinfo=main.TAIWAN_TZ)
+DATE_STRING = '20261016'
+
+
+def at(day_offset: int, hour: int) -> datetime:
+    """目標日期（台灣時間）前後 day_offset 天的 hour 點，轉為 UTC"""
+    start_of_day = TARGET_DATE.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (start_of_day + timedelta(days=day_offset, hours=hour)).astimezone(timezone.utc)
+
+
+# (文檔路徑, 數據)，按寫入順序排列；同一路徑出現多次表示更新（例如事件改期）
+FIXTURE_WRITES = [
+    ('users/u1', {'app_config': 1}),
+    ('users/u2', {'app_config': 0}),
+    # u1（實驗組）：完成的事件，含 commit plan 的聊天、複習與已點開的通知
+    ('users/u1/experiment_events/e1', {'title': 'reading-w1-d1', 'scheduledStartTime': at(0, 9), 'isDone': True}),
+    ('users/u1/experiment_events/e1/chats/c1', {'start_time': at(0, 9), 'result': 0, 'commit_plan': True}),
+    ('users/u1/experiment_events/e1/chats/c2', {'start_time': at(0, 10), 'result': 1}),
+    ('users/u1/experiment_events/e1/review/r1', {'startTime': at(0, 11), 'durationMin': 5}),
+    ('users/u1/experiment_events/e1/notifications/n1', {'created_at': at(0, 8), 'opened_time': at(0, 9)}),
+    # 未完成（逾期）的事件，聊天結果為 leave，通知未點開
+    ('users/u1/experiment_events/e2', {'title': 'vocab-w1-d1', 'scheduledStartTime': at(0, 15), 'isDone': False}),
+    ('users/u1/experiment_events/e2/chats/c3', {'start_time': at(0, 15), 'result': 2}),
+    ('users/u1/experiment_events/e2/notifications/n2', {'created_at': at(0, 14)}),
+    # 前一天的事件與聊天，之後改期到目標日期：子集合的計數與 commit plan 隨事件移動
+    ('users/u1/experiment_events/e3', {'title': 'reading-w1-d2', 'scheduledStartTime': at(-1, 9), 'isDone': False}),
+    ('users/u1/experiment_events/e3/chats/c4', {'start_time': at(-1, 9), 'result': 1, 'commit_plan': True}),
+    ('users/u1/experiment_events/e3', {'title': 'reading-w1-d2', 'scheduledStartTime': at(0, 20), 'isDone': True}),
+    # 目標日期之後的事件不計入
+    ('users/u1/experiment_events/e4', {'title': 'reading-w1-d3', 'scheduledStartTime': at(1, 9), 'isDone': False}),
+    ('users/u1/experiment_events/e4/chats/c5', {'start_time': at(1, 9), 'result': 0}),
+    # 應用會話：按 date 欄位歸屬日期，平均時長只計算有效會話
+    ('users/u1/experiment/data/app_sessions/s1', {'date': DATE_STRING, 'duration_seconds': 120, 'opened_by_notification': True}),
+    ('users/u1/experiment/data/app_sessions/s2', {'date': DATE_STRING, 'duration_seconds': 0}),
+    ('users/u1/experiment/data/app_sessions/s3', {'date': '20261017', 'duration_seconds': 60}),
+    # u2（對照組）
+    ('users/u2/control_events/e5', {'title': 'vocab-w1-d1', 'scheduledStartTime': at(0, 10), 'isDone': True}),
+    ('users/u2/control_events/e5/review/r2', {'startTime': at(0, 10), 'durationMin': 3}),
+    ('users/u2/control_events/e5/chats/c6', {'start_time': at(0, 10), 'result': 0}),
+    ('users/u2/control/data/app_sessions/s4', {'date': DATE_STRING, 'duration_seconds': 45}),
+]
+
+# 子集合名稱 -> (觸發器, 觸發器參數中文檔 ID 的名稱)
+SUBCOLLECTION_TRIGGERS = {
+    'chats': (main.live_metrics_on_chat, 'chatId'),
+    'review': (main.live_metrics_on_review, 'sessionId'),
+    'notifications': (main.live_metrics_on_notification, 'notifId'),
+}
+
+
+def trigger_for(path: str):
+    """返回寫入 path 時會觸發的即時指標觸發器與其路徑參數；沒有觸發器時返回 None"""
+    parts = path.split('/')
+    if len(parts) == 4 and parts[2] in ('experiment_events', 'control_events'):
+        function = main.live_metrics_on_experiment_event if parts[2] == 'experiment_events' else main.live_metrics_on_control_event
+        return function, {'uid': parts[1], 'eventId': parts[3]}
+    if len(parts) == 6 and parts[4] in SUBCOLLECTION_TRIGGERS:
+        function, id_param = SUBCOLLECTION_TRIGGERS[parts[4]]
+        return function, {'uid': parts[1], 'eventsCollection': parts[2], 'eventId': parts[3], id_param: parts[5]}
+    if len(parts) == 6 and parts[4] == 'app_sessions':
+        return main.live_metrics_on_app_session, {'uid': parts[1], 'group': parts[2], 'sessionId': parts[5]}
+    return None
+
+
+def write_with_triggers(db, path: str, data: dict, event_id: str) -> None:
+    """寫入文檔，並以寫入前後的快照呼叫對應的觸發器（與部署後 Firestore 觸發器收到的事件相同）"""
+    reference = db.document(path)
+    before = reference.get()
+    reference.set(data)
+    trigger = trigger_for(path)
+    if trigger is not None:
+        function, params = trigger
+        event = SimpleNamespace(id=event_id, params=params, data=SimpleNamespace(before=before, after=reference.get()))
+        inspect.unwrap(function)(event)
+
+
+def without_created_at(metrics: dict) -> dict:
+    return {name: value for name, value in metrics.items() if name != 'created_at'}
+
+
+@pytest.fixture
+def seeded_db(db):
+    for i, (path, data) in enumerate(FIXTURE_WRITES):
+        write_with_triggers(db, path, data, event_id=f"write-{i}")
+    return db
+
+
+def test_all_paths_produce_identical_metrics(seeded_db):
+    db = seeded_db
+    user_docs = list(db.collection('users').stream())
+
+    per_user = {user_doc.id: main.calculate_daily_metrics(user_doc.id, TARGET_DATE, db) for user_doc in user_docs}
+    collection_group = main.calculate_all_daily_metrics(TARGET_DATE, user_docs, db)
+    live = {
+        user_doc.id: main.metrics_from_live_counters(
+            db.document(f"users/{user_doc.id}/{main.LIVE_METRICS_COLLECTION}/{DATE_STRING}").get().to_dict() or {},
+            DATE_STRING,
+        )
+        for user_doc in user_docs
+    }
+
+    for uid in ('u1', 'u2'):
+        assert without_created_at(collection_group[uid]) == without_created_at(per_user[uid])
+        assert without_created_at(live[uid]) == without_created_at(per_user[uid])
+
+
+def test_fixture_exercises_every_metric_group(seeded_db):
+    """避免三條路徑都算出 0 而「一致」：確認夾具涵蓋各類指標"""
+    metrics = main.calculate_daily_metrics('u1', TARGET_DATE, seeded_db)
+    assert metrics['event_total_count'] == 3
+    assert metrics['event_overdue_count'] == 1
+    assert metrics['event_complete_count'] == 2
+    assert metrics['event_commit_plan_count'] == 2
+    assert (metrics['chat_start_count'], metrics['chat_snooze_count'], metrics['chat_leave_count']) == (1, 2, 1)
+    assert (metrics['review_count'], metrics['review_total_duration']) == (1, 5)
+    assert (metrics['notif_total_count'], metrics['notif_open_count'], metrics['notif_dismiss_count']) == (2, 1, 1)
+    assert (metrics['app_open_count'], metrics['app_average_open_time'], metrics['app_open_by_notif_count']) == (2, 120, 1)
+
+
+def test_redelivered_trigger_event_is_counted_once(seeded_db):
+    db = seeded_db
+    path = 'users/u1/experiment_events/e1/chats/c1'
+    live_path = f"users/u1/{main.LIVE_METRICS_COLLECTION}/{DATE_STRING}"
+    before = db.document(live_path).get().to_dict()
+
+    # 同一個觸發器事件重複投遞：刪除聊天後以相同 event.id 再呼叫一次
+    reference = db.document(path)
+    before_delete = reference.get()
+    db.docs.pop(path)
+    event = SimpleNamespace(id='delete-c1', params=trigger_for(path)[1],
+                            data=SimpleNamespace(before=before_delete, after=reference.get()))
+    inspect.unwrap(main.live_metrics_on_chat)(event)
+    inspect.unwrap(main.live_metrics_on_chat)(event)
+
+    after = db.document(live_path).get().to_dict()
+    assert after['chat_total_count'] == before['chat_total_count'] - 1
+    assert after['chat_start_count'] == before['chat_start_count'] - 1
+    assert after['event_commit_plan_count'] == before['event_commit_plan_count'] - 1
+
+
+def test_incremental_finalizes_from_live_docs_without_rescanning(seeded_db, monkeypatch):
+    db = seeded_db
+    db.document('users/u3').set({'app_config': 1})  # 當天沒有任何寫入，沒有即時文檔
+    user_docs = list(db.collection('users').stream())
+    expected = {uid: without_created_at(main.calculate_daily_metrics(uid, TARGET_DATE, db)) for uid in ('u1', 'u2')}
+
+    def no_scan(*args, **kwargs):
+        raise AssertionError("incremental 模式不應重新掃描 collection group")
+    recomputed = []
+    full_calculation = main.calculate_daily_metrics
+    monkeypatch.setattr(main, 'scan_daily_collection_groups', no_scan)
+    monkeypatch.setattr(main, 'calculate_daily_metrics', lambda uid, **kwargs: recomputed.append(uid) or full_calculation(uid, **kwargs))
+
+    metrics, drift_count = main.finalize_live_metrics(db, user_docs, TARGET_DATE, sample_size=0)
+
+    assert drift_count == 0
+    assert recomputed == []
+    # 沒有即時文檔的用戶留給呼叫方完整計算
+    assert set(metrics) == {'u1', 'u2'}
+    assert {uid: without_created_at(m) for uid, m in metrics.items()} == expected
+
+
+def test_incremental_sample_replaces_drifted_live_counts(seeded_db, monkeypatch):
+    db = seeded_db
+    live_path = f"users/u1/{main.LIVE_METRICS_COLLECTION}/{DATE_STRING}"
+    db.document(live_path).set({'chat_total_count': 99}, merge=True)
+    user_docs = list(db.collection('users').stream())
+    recomputed = []
+    full_calculation = main.calculate_daily_metrics
+    monkeypatch.setattr(main, 'calculate_daily_metrics', lambda uid, **kwargs: recomputed.append(uid) or full_calculation(uid, **kwargs))
+
+    metrics, drift_count = main.finalize_live_metrics(db, user_docs, TARGET_DATE, sample_size=1)
+    assert len(recomputed) == 1
+
+    metrics, drift_count = main.finalize_live_metrics(db, user_docs, TARGET_DATE, sample_size=2)
+    assert drift_count == 1
+    assert metrics['u1']['chat_total_count'] == full_calculation('u1', TARGET_DATE, db)['chat_total_count'] == 4
+
+
+def test_live_verify_sample_is_bounded_and_stable():
+    uids = [f"u{i}" for i in range(50)]
+    sample = main.live_verify_sample(uids, DATE_STRING, 5)
+    assert len(sample) == 5
+    assert sample == main.live_verify_sample(list(reversed(uids)), DATE_STRING, 5)
+    assert main.live_verify_sample(uids, '20261017', 5) != sample
@@ -0,0 +1,67 @@
+"""get_experiment_stats：aggregate 模式的 count() 計數與分組明細的分頁，必須與 full 模式逐一讀取用戶文檔的分組一致"""
+
+import inspect
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+# full 模式以 Python 的 app_config == 0 判斷對照組：0、0.0 與 False 都是對照組，其餘值（含 null 與 True）為實驗組
+APP_CONFIGS = [0, 0.0, False, 1, 2, 1.5, True, 'a', None]
+GROUPS = ('control', 'experiment', 'no_config')
+
+
+def call(data: dict) -> dict:
+    return inspect.unwrap(main.get_experiment_stats)(SimpleNamespace(auth=None, data=data))
+
+
+@pytest.fixture
+def users_db(db):
+    for i in range(40):
+        user_data = {'createdAt': i, 'experiment_assigned_at': i}
+        if i % 10 != 9:
+            user_data['app_config'] = APP_CONFIGS[i % len(APP_CONFIGS)]
+        db.document(f"users/u{i:03d}").set(user_data)
+    return db
+
+
+def list_all(group: str, page_size: int) -> tuple[list[str], list[int]]:
+    uids, sizes, page_token = [], [], None
+    while True:
+        result = call({'group': group, 'page_size': page_size, 'page_token': page_token})
+        uids += [detail['uid'] for detail in result['details']]
+        sizes.append(len(result['details']))
+        page_token = result['next_page_token']
+        if page_token is None:
+            return uids, sizes
+
+
+def test_aggregate_counts_match_full_mode(users_db):
+    full = call({})['stats']
+    aggregate = call({'mode': 'aggregate'})['stats']
+    for key in ('total_users', 'control_count', 'experiment_count', 'no_config_count'):
+        assert aggregate[key] == full[key], key
+    # 夾具涵蓋 0.0 與 False 的對照組，以及 null 與 True 的實驗組
+    assert (full['control_count'], full['experiment_count'], full['no_config_count']) == (12, 24, 4)
+
+
+@pytest.mark.parametrize('page_size', [1, 3, 7, 100])
+def test_group_pages_match_full_mode(users_db, page_size):
+    full = call({})['stats']['group_details']
+    for group in GROUPS:
+        uids, sizes = list_all(group, page_size)
+        assert sorted(uids) == sorted(detail['uid'] for detail in full[group]), group
+        assert len(uids) == len(set(uids))
+        assert all(size == page_size for size in sizes[:-1]), (group, sizes)
+
+
+def test_paging_does_not_read_cursor_documents(users_db, monkeypatch):
+    reads = []
+    document_class = type(users_db.document('users/u000'))
+    original_get = document_class.get
+    monkeypatch.setattr(document_class, 'get', lambda self, *args, **kwargs: reads.append(self.path) or original_get(self, *args, **kwargs))
+
+    for group in GROUPS:
+        list_all(group, 3)
+    assert reads == []
@@ -0,0 +1,108 @@
+"""firestore_stats：包裝 GAPIC 方法後按呼叫位置累計 RPC 次數、讀取文檔數與寫入數"""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import firestore_stats
+
+
+class FakeFirestoreApi:
+    """模擬 Firestore 客戶端底層的 GAPIC 方法：串流 RPC 返回回應的迭代器"""
+
+    def run_query(self, request=None, **kwargs):
+        return iter([SimpleNamespace(document=f"doc{i}") for i in range(request['count'])] + [SimpleNamespace(document=None)])
+
+    def run_aggregation_query(self, request=None, **kwargs):
+        return iter([SimpleNamespace(result={'count': 42})])
+
+    def batch_get_documents(self, request=None, **kwargs):
+        return iter([SimpleNamespace(found='users/u1', missing=None), SimpleNamespace(found=None, missing='users/u2')])
+
+    def commit(self, request=None, **kwargs):
+        return SimpleNamespace(write_results=request['writes'] if isinstance(request, dict) else request.writes)
+
+    def batch_write(self, request=None, **kwargs):
+        return None
+
+    def list_documents(self, request=None, **kwargs):
+        return ['users/u1', 'users/u2']
+
+    def list_collection_ids(self, request=None, **kwargs):
+        return ['chats']
+
+
+@pytest.fixture
+def stats():
+    return firestore_stats.FirestoreStats()
+
+
+@pytest.fixture
+def api(stats):
+    db = SimpleNamespace(_firestore_api=FakeFirestoreApi())
+    firestore_stats.instrument(db, stats)
+    return db._firestore_api
+
+
+def site_counts(stats, site: str) -> dict:
+    counters = firestore_stats.usage_delta({}, stats.snapshot())['sites'][site]
+    return {name: value for name, value in counters.items() if name != 'ms' and value}
+
+
+def test_rpcs_reads_and_writes_are_counted_per_call_site(api, stats):
+    with firestore_stats.call_site('events'):
+        assert len(list(api.run_query(request={'count': 3}))) == 4
+        list(api.run_query(request={'count': 2}))
+    with firestore_stats.call_site('users'):
+        list(api.batch_get_documents(request={}))
+        list(api.run_aggregation_query(request={}))
+    with firestore_stats.call_site('daily_metrics_writes'):
+        api.commit(request={'writes': ['w'] * 4})
+        api.commit(request=SimpleNamespace(writes=['w'] * 2))
+    api.list_documents(request={})
+
+    assert site_counts(stats, 'events') == {'rpcs': 2, 'queries': 2, 'reads': 5}
+    # 找到與不存在的文檔都算讀取；聚合查詢算 1 次讀取
+    assert site_counts(stats, 'users') == {'rpcs': 2, 'lookups': 1, 'queries': 1, 'reads': 3}
+    assert site_counts(stats, 'daily_metrics_writes') == {'rpcs': 2, 'commits': 2, 'writes': 6}
+    # 沒有標記的呼叫記為 other
+    assert site_counts(stats, 'other') == {'rpcs': 1, 'queries': 1}
+
+
+def test_instrument_twice_does_not_double_count(stats):
+    db = SimpleNamespace(_firestore_api=FakeFirestoreApi())
+    firestore_stats.instrument(db, stats)
+    firestore_stats.instrument(db, stats)
+    with firestore_stats.call_site('events'):
+        list(db._firestore_api.run_query(request={'count': 1}))
+    assert site_counts(stats, 'events') == {'rpcs': 1, 'queries': 1, 'reads': 1}
+
+
+def test_call_site_is_nested_and_thread_local(api, stats):
+    with firestore_stats.call_site('outer'):
+        with firestore_stats.call_site('inner'):
+            api.list_collection_ids(request={})
+        api.list_collection_ids(request={})
+        # 線程池中的工作函數沒有自行標記時不繼承呼叫端的標記
+        worker = threading.Thread(target=lambda: api.list_collection_ids(request={}))
+        worker.start()
+        worker.join()
+    assert {site: counters['rpcs'] for site, counters in stats.snapshot().items()} == {'inner': 1, 'outer': 1, 'other': 1}
+
+
+def test_usage_delta_and_merge(api, stats):
+    with firestore_stats.call_site('events'):
+        list(api.run_query(request={'count': 1}))
+    before = stats.snapshot()
+    with firestore_stats.call_site('users'):
+        list(api.batch_get_documents(request={}))
+
+    delta = firestore_stats.usage_delta(before, stats.snapshot())
+    # 兩次 snapshot 之間沒有 RPC 的位置不列出
+    assert list(delta['sites']) == ['users']
+    assert (delta['total']['rpcs'], delta['total']['reads']) == (1, 2)
+
+    merged = firestore_stats.merge_usage(delta, delta, None)
+    assert merged['sites']['users']['reads'] == 4
+    assert merged['total']['rpcs'] == 2
@@ -0,0 +1,115 @@
+"""LLM 遙測：TelemetryBuffer 的批次寫出、失敗重試與丟棄，rollup 的分組彙總，以及 main 從記錄到夜間彙總的流程"""
+
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import llm_telemetry
+import main
+
+
+def wait_until(condition, timeout_sec: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_buffer_flushes_in_background_once_batch_is_full():
+    written = []
+    buffer = llm_telemetry.TelemetryBuffer(written.append, batch_size=3, flush_interval_sec=3600, max_buffered=100)
+    buffer.record({'n': 1})
+    buffer.record({'n': 2})
+    time.sleep(0.05)
+    # 未滿一批且未到定時寫出的時間：record 只放進緩衝區
+    assert written == [] and buffer.stats()['buffered'] == 2
+
+    buffer.record({'n': 3})
+    assert wait_until(lambda: written)
+    assert written == [[{'n': 1}, {'n': 2}, {'n': 3}]]
+    assert buffer.stats() == {'buffered': 0, 'flushed': 3, 'dropped': 0, 'failed_flushes': 0}
+
+
+def test_failed_flush_keeps_events_in_order_for_the_next_flush():
+    attempts = []
+
+    def writer(events):
+        attempts.append([event['n'] for event in events])
+        if len(attempts) == 1:
+            raise RuntimeError('unavailable')
+    buffer = llm_telemetry.TelemetryBuffer(writer, batch_size=100, flush_interval_sec=3600, max_buffered=100)
+    buffer.record({'n': 1})
+    assert buffer.flush() == 0
+    buffer.record({'n': 2})
+    assert buffer.flush() == 2
+    assert attempts == [[1], [1, 2]]
+    assert buffer.stats()['failed_flushes'] == 1
+
+
+def test_oldest_events_are_dropped_beyond_max_buffered():
+    written = []
+    buffer = llm_telemetry.TelemetryBuffer(written.append, batch_size=100, flush_interval_sec=3600, max_buffered=3)
+    for n in range(5):
+        buffer.record({'n': n})
+    buffer.flush()
+    assert [event['n'] for event in written[0]] == [2, 3, 4]
+    assert buffer.stats()['dropped'] == 2
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert (llm_telemetry.percentile(values, 50), llm_telemetry.percentile(values, 95)) == (50, 95)
+    assert llm_telemetry.percentile([7], 95) == 7
+    assert llm_telemetry.percentile([], 50) is None
+    assert llm_telemetry.distribution([1, 2, 6]) == {'p50': 2, 'p95': 6, 'max': 6, 'mean': 3.0}
+
+
+def test_rollup_groups_by_endpoint_and_group():
+    events = [
+        {'endpoint': 'coach', 'group': 'experiment', 'session': 's1', 'latency_ms': 100, 'total_tokens': 10, 'status': 'ok', 'retries': 0},
+        {'endpoint': 'coach', 'group': 'experiment', 'session': 's1', 'latency_ms': 300, 'total_tokens': 20, 'status': 'ok', 'retries': 2},
+        {'endpoint': 'coach', 'group': 'control', 'session': 's2', 'latency_ms': 200, 'total_tokens': 5, 'status': 'error', 'retries': 0},
+        {'endpoint': 'summarize', 'group': None, 'latency_ms': 50, 'total_tokens': 7, 'status': 'ok'},
+    ]
+    summary = llm_telemetry.rollup(events, slowest=2)
+
+    assert summary['calls'] == 4
+    assert set(summary['endpoints']) == {'coach', 'summarize'}
+    coach = summary['endpoints']['coach']
+    assert set(coach) == {'experiment', 'control', llm_telemetry.ALL_GROUPS}
+    assert (coach['experiment']['calls'], coach['experiment']['retries'], coach['experiment']['calls_with_retries']) == (2, 2, 1)
+    assert coach['experiment']['tokens_per_session'] == {'p50': 30, 'p95': 30, 'max': 30, 'mean': 30.0}
+    assert coach['all']['errors'] == 1 and coach['all']['total_tokens'] == 35
+    assert coach['all']['latency_ms']['max'] == 300
+    # 沒有分組的事件記為 unknown
+    assert set(summary['endpoints']['summarize']) == {'unknown', llm_telemetry.ALL_GROUPS}
+    assert [event['latency_ms'] for event in summary['slowest']] == [300, 200]
+
+
+def test_recorded_calls_are_written_with_group_and_rolled_up(db, monkeypatch):
+    db.document('users/u1').set({'app_config': 0})
+    buffer = llm_telemetry.TelemetryBuffer(main.write_llm_telemetry, batch_size=100, flush_interval_sec=3600, max_buffered=100)
+    monkeypatch.setattr(main, 'llm_telemetry_buffer', buffer)
+    usage = SimpleNamespace(prompt_tokens=80, completion_tokens=20, total_tokens=100,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=64))
+    data = {'taskTitle': 'reading-w1-d1', 'startTime': '2026-10-16T09:00:00', 'currentTurn': 2}
+
+    started_at = time.perf_counter()
+    main.record_llm_call('coach', 'gpt-4.1-mini', started_at, openai_ms=12.3, usage=usage, uid='u1', data=data)
+    main.record_llm_call('coach', 'gpt-4.1-mini', started_at, uid='u1', data=data, error=RuntimeError('timeout'))
+    assert buffer.flush() == 2
+
+    events = [doc.to_dict() for doc in db.collection(main.LLM_TELEMETRY_COLLECTION).stream()]
+    assert {event['group'] for event in events} == {'control'}
+    assert {event['session'] for event in events} == {main.llm_session_id('u1', data)}
+    assert sorted(event['status'] for event in events) == ['error', 'ok']
+
+    date_str = datetime.now(main.TAIWAN_TZ).strftime('%Y%m%d')
+    summary = main.run_llm_telemetry_rollup(date_str)
+    control = summary['endpoints']['coach']['control']
+    assert (control['calls'], control['errors'], control['cached_tokens'], control['total_tokens']) == (2, 1, 64, 100)
+    assert db.document(f"{main.LLM_TELEMETRY_DAILY_COLLECTION}/{date_str}").get().to_dict()['calls'] == 2
@@ -0,0 +1,96 @@
+"""串流教練回覆：JsonStringFieldStream 的增量解碼與 validate_response_fields 的欄位檢查"""
+
+import json
+
+import pytest
+
+import main
+import system_prompt
+
+ANSWER = 'Line1\n\t"quoted" back\\slash a/b 你好 😀 end'
+RESPONSE = json.dumps({
+    'user_action': 'pending',
+    'answer': ANSWER,
+    'end_of_dialogue': False,
+    'talk_type': 'change_talk',
+    'presistant_type': 'none',
+})
+# ensure_ascii=True 時中文與表情以 \uXXXX（表情為代理對）輸出
+RESPONSE_ASCII = json.dumps(json.loads(RESPONSE), ensure_ascii=True)
+
+
+def feed_chunks(chunks: list[str]) -> tuple[str, main.JsonStringFieldStream]:
+    stream = main.JsonStringFieldStream('answer')
+    return "".join(stream.feed(chunk) for chunk in chunks), stream
+
+
+def test_single_chunk_decodes_all_escapes():
+    for text in (RESPONSE, RESPONSE_ASCII):
+        decoded, stream = feed_chunks([text])
+        assert decoded == ANSWER
+        assert stream.done
+
+
+@pytest.mark.parametrize('text', [RESPONSE, RESPONSE_ASCII], ids=['utf8', 'ascii'])
+def test_every_two_chunk_split_decodes_the_same(text):
+    # 逐一嘗試每個切分點，涵蓋切在 \\、\\n、\\uXXXX 與代理對中間的情況
+    for split in range(len(text) + 1):
+        decoded, _ = feed_chunks([text[:split], text[split:]])
+        assert decoded == ANSWER, f"split at {split}: {text[max(0, split - 8):split]!r}|{text[split:split + 8]!r}"
+
+
+def test_one_character_per_chunk():
+    decoded, stream = feed_chunks(list(RESPONSE_ASCII))
+    assert decoded == ANSWER
+    assert stream.done
+
+
+def test_unicode_escape_split_across_chunks_waits_for_all_hex_digits():
+    stream = main.JsonStringFieldStream('answer')
+    assert stream.feed('{"answer": "a\\u4f') == 'a'
+    assert stream.feed('60b') == '你b'
+    # 代理對分在兩段：高位代理先保留，低位到達後才輸出完整字元
+    assert stream.feed('\\ud83d') == ''
+    assert stream.feed('\\ude00"}') == '😀'
+    assert stream.done
+
+
+def test_text_after_closing_quote_is_ignored():
+    stream = main.JsonStringFieldStream('answer')
+    assert stream.feed('{"answer": "hi", "talk_type": "change_talk"') == 'hi'
+    assert stream.feed(', "answer": "again"}') == ''
+
+
+def test_missing_field_yields_nothing():
+    decoded, stream = feed_chunks(['{"user_action": "pending", ', '"end_of_dialogue": true}'])
+    assert decoded == ''
+    assert not stream.done
+
+
+def valid_answer() -> dict:
+    return json.loads(RESPONSE)
+
+
+def test_validate_response_fields_accepts_schema_conforming_answer():
+    answer = valid_answer()
+    assert main.validate_response_fields(answer, system_prompt.get_response_schema()) is answer
+
+
+@pytest.mark.parametrize('field', ['user_action', 'answer', 'end_of_dialogue', 'talk_type', 'presistant_type'])
+def test_validate_response_fields_rejects_missing_field(field):
+    answer = valid_answer()
+    del answer[field]
+    with pytest.raises(ValueError, match=field):
+        main.validate_response_fields(answer, system_prompt.get_response_schema())
+
+
+@pytest.mark.parametrize('field, value', [
+    ('end_of_dialogue', 'false'),
+    ('answer', None),
+    ('user_action', 'later'),
+    ('talk_type', 'small_talk'),
+])
+def test_validate_response_fields_rejects_wrong_type_or_enum(field, value):
+    answer = {**valid_answer(), field: value}
+    with pytest.raises(ValueError, match=field):
+        main.validate_response_fields(answer, system_prompt.get_response_schema())
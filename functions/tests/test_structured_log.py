@@ -0,0 +1,112 @@
+"""structured_log：一行一筆的 JSON 記錄、等級過濾、context 欄位、按 sample_key 限速，以及 run() 的摘要記錄"""
+
+import contextvars
+import json
+import threading
+
+import pytest
+
+import structured_log
+
+
+def records(capsys) -> list[dict]:
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+@pytest.fixture(autouse=True)
+def fresh_sampler(monkeypatch):
+    monkeypatch.setattr(structured_log, '_sampler', structured_log.Sampler(2, 60))
+    monkeypatch.setattr(structured_log, 'LOG_SAMPLE_BURST', 2)
+    monkeypatch.setattr(structured_log, 'LOG_LEVEL', 'INFO')
+
+
+def test_each_record_is_one_json_line_with_severity_and_fields(capsys):
+    structured_log.warning("寫入失敗", uid='u1', documents=3, error=ValueError('bad'))
+    assert records(capsys) == [{'severity': 'WARNING', 'message': '寫入失敗', 'uid': 'u1', 'documents': 3, 'error': 'bad'}]
+
+
+def test_records_below_log_level_are_skipped(capsys, monkeypatch):
+    structured_log.debug("略過")
+    monkeypatch.setattr(structured_log, 'LOG_LEVEL', 'ERROR')
+    structured_log.warning("略過")
+    structured_log.error("輸出")
+    assert [record['message'] for record in records(capsys)] == ['輸出']
+
+
+def test_context_fields_nest_and_stay_in_their_thread(capsys):
+    with structured_log.context(uid='u1', shard='1/2'):
+        with structured_log.context(uid='u2'):
+            structured_log.info("inner")
+        structured_log.info("outer")
+        # 線程不繼承標記，以 contextvars.copy_context().run 執行才繼承
+        plain = threading.Thread(target=structured_log.info, args=("plain thread",))
+        copied = threading.Thread(target=contextvars.copy_context().run, args=(structured_log.info, "copied context"))
+        for thread in (plain, copied):
+            thread.start()
+            thread.join()
+    structured_log.info("after")
+
+    fields = {record['message']: {key: record.get(key) for key in ('uid', 'shard')} for record in records(capsys)}
+    assert fields == {
+        'inner': {'uid': 'u2', 'shard': '1/2'},
+        'outer': {'uid': 'u1', 'shard': '1/2'},
+        'plain thread': {'uid': None, 'shard': None},
+        'copied context': {'uid': 'u1', 'shard': '1/2'},
+        'after': {'uid': None, 'shard': None},
+    }
+
+
+def test_sampled_messages_are_rate_limited_per_key(capsys):
+    for i in range(5):
+        structured_log.error("用戶錯誤", sample_key='user_error', i=i)
+    structured_log.error("寫入錯誤", sample_key='write_error')
+    structured_log.error("沒有 sample_key 不限速")
+    assert [record.get('i') for record in records(capsys)] == [0, 1, None, None]
+    assert structured_log._sampler.suppressed == {'user_error': 3}
+
+
+def test_sampler_window_resets(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(structured_log.time, 'monotonic', lambda: now[0])
+    sampler = structured_log.Sampler(burst=1, window_sec=60)
+    assert [sampler.allow('k') for _ in range(3)] == [True, False, False]
+    now[0] = 60
+    assert sampler.allow('k') is True
+    assert sampler.suppressed == {'k': 2}
+
+
+def test_run_emits_one_summary_with_counts_and_suppressed(capsys):
+    with structured_log.run('daily_metrics_aggregation', date='20261016', shard='1/1') as run_log:
+        for _ in range(4):
+            structured_log.error("用戶錯誤", sample_key='user_error')
+        run_log.count('pages')
+        run_log.count('users_listed', 200)
+        run_log.set(processed_count=200)
+
+    output = records(capsys)
+    # 限速狀態屬於這次執行：全域的 sampler 不受影響
+    assert len([record for record in output if record['message'] == '用戶錯誤']) == 2
+    assert all(record['run'] == 'daily_metrics_aggregation' and record['date'] == '20261016' for record in output)
+    summary = output[-1]
+    assert (summary['severity'], summary['message']) == ('INFO', 'daily_metrics_aggregation 結束')
+    assert summary['counts'] == {'pages': 1, 'users_listed': 200}
+    assert summary['suppressed'] == {'user_error': 2}
+    assert (summary['status'], summary['processed_count']) == ('completed', 200)
+    assert structured_log._sampler.suppressed == {}
+    assert structured_log.current_run() is None
+
+
+def test_failed_run_summary_is_an_error_and_reraises(capsys):
+    with pytest.raises(RuntimeError):
+        with structured_log.run('coach_context_refresh') as run_log:
+            run_log.set(status='running')
+            raise RuntimeError('quota exceeded')
+    summary = records(capsys)[-1]
+    assert (summary['severity'], summary['message']) == ('ERROR', 'coach_context_refresh 失敗')
+    assert (summary['status'], summary['error']) == ('failed', 'quota exceeded')
+
+
+def test_skipped_status_set_inside_run_is_kept(capsys):
+    with structured_log.run('daily_metrics_aggregation') as run_log:
+        run_log.set(status='skipped')
+    assert records(capsys)[-1]['status'] == 'skipped'
@@ -0,0 +1,130 @@
+"""
+批量摘要：submit_summary_batch / claim_summary_batch / apply_summary_batch 對本地 Batch API stub（benchmarks/fake_openai.py）
+以真實的 openai 客戶端呼叫，驗證提交、套用、失敗回退與重複認領
+"""
+
+import inspect
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from openai import OpenAI
+
+import main
+
+sys.path.insert(0, os.path.join(os.path.dirname(main.__file__), '..', 'benchmarks'))
+from fake_openai import FakeOpenAIServer  # noqa: E402
+
+CHAT_PATHS = ['users/u1/experiment_events/e1/chats/c1', 'users/u1/experiment_events/e1/chats/c2']
+
+
+@pytest.fixture
+def openai_server():
+    server = FakeOpenAIServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(openai_server):
+    return OpenAI(api_key='test', base_url=openai_server.base_url, max_retries=0)
+
+
+@pytest.fixture
+def chat_docs(db):
+    for i, path in enumerate(CHAT_PATHS):
+        db.document(path).set({'summary_status': main.CHAT_SUMMARY_PENDING})
+        db.document(f"{path}/messages/m1").set({'role': 'ChatRole.user', 'content': f'今天不想讀書 {i}', 'timestamp': 1})
+        db.document(f"{path}/messages/m2").set({'role': 'ChatRole.assistant', 'content': '先讀五分鐘？', 'timestamp': 2})
+    # 沒有訊息的聊天不提交
+    db.document('users/u1/experiment_events/e1/chats/c3').set({'summary_status': main.CHAT_SUMMARY_PENDING})
+    return [db.document(path).get() for path in [*CHAT_PATHS, 'users/u1/experiment_events/e1/chats/c3']]
+
+
+def test_submit_uploads_one_request_per_chat_and_marks_chats(db, client, openai_server, chat_docs):
+    job = main.submit_summary_batch(db, client, chat_docs)
+
+    assert job['request_count'] == 2
+    uploaded = next(file for file in openai_server.files.values() if file['purpose'] == 'batch')
+    requests = [json.loads(line) for line in uploaded['content'].decode('utf-8').splitlines()]
+    assert [request['custom_id'] for request in requests] == CHAT_PATHS
+    assert requests[0]['body'] == main.summary_request_body(main.chat_messages_for_summary(db.document(CHAT_PATHS[0])))
+
+    stored = db.document(f"{main.SUMMARY_BATCH_COLLECTION}/{job['batch_id']}").get().to_dict()
+    assert stored['chat_paths'] == CHAT_PATHS
+    for path in CHAT_PATHS:
+        chat = db.document(path).get().to_dict()
+        assert (chat['summary_status'], chat['summary_batch_id']) == (main.CHAT_SUMMARY_IN_BATCH, job['batch_id'])
+    assert db.document('users/u1/experiment_events/e1/chats/c3').get().to_dict()['summary_status'] == main.CHAT_SUMMARY_PENDING
+
+
+def test_submit_without_messages_creates_no_batch(db, client, openai_server, chat_docs):
+    assert main.submit_summary_batch(db, client, chat_docs[2:]) is None
+    assert openai_server.batches == {}
+
+
+def test_apply_waits_for_final_status_then_writes_summaries(db, client, openai_server, chat_docs):
+    openai_server.batch_pending_polls = 1
+    batch_id = main.submit_summary_batch(db, client, chat_docs)['batch_id']
+
+    assert main.apply_summary_batch(db, client, batch_id) == {'batch_id': batch_id, 'status': 'in_progress'}
+    assert db.document(CHAT_PATHS[0]).get().to_dict()['summary_status'] == main.CHAT_SUMMARY_IN_BATCH
+
+    outcome = main.apply_summary_batch(db, client, batch_id)
+    assert (outcome['status'], outcome['succeeded_count'], outcome['failed_count']) == ('completed', 2, 0)
+    for path in CHAT_PATHS:
+        chat = db.document(path).get().to_dict()
+        assert (chat['summary_status'], chat['summary_source']) == (main.CHAT_SUMMARY_DONE, 'batch')
+        assert chat['summary'] and isinstance(chat['snooze_reasons'], list)
+    assert db.document(f"{main.SUMMARY_BATCH_COLLECTION}/{batch_id}").get().to_dict()['applied_at'] is not None
+
+
+def test_failed_request_returns_chat_to_pending(db, client, openai_server, chat_docs):
+    openai_server.batch_fail_ids = {CHAT_PATHS[1]}
+    batch_id = main.submit_summary_batch(db, client, chat_docs)['batch_id']
+
+    outcome = main.apply_summary_batch(db, client, batch_id)
+    assert (outcome['succeeded_count'], outcome['failed_count']) == (1, 1)
+    assert db.document(CHAT_PATHS[0]).get().to_dict()['summary_status'] == main.CHAT_SUMMARY_DONE
+    failed = db.document(CHAT_PATHS[1]).get().to_dict()
+    assert failed['summary_status'] == main.CHAT_SUMMARY_PENDING
+    assert 'summary_batch_id' not in failed
+
+
+def test_claim_is_exclusive_until_lease_expires(db):
+    job_ref = db.collection(main.SUMMARY_BATCH_COLLECTION).document('batch_1')
+    job_ref.set({'batch_id': 'batch_1', 'status': 'completed'})
+
+    assert main.claim_summary_batch(db, job_ref) is True
+    assert job_ref.get().to_dict()['status'] == main.SUMMARY_BATCH_APPLYING_STATUS
+    # 租約內第二次認領失敗
+    assert main.claim_summary_batch(db, job_ref) is False
+
+    # 套用中斷、租約逾期後可重新認領
+    expired = datetime.now(timezone.utc) - main.SUMMARY_BATCH_APPLY_LEASE - timedelta(minutes=1)
+    job_ref.set({'apply_claimed_at': expired}, merge=True)
+    assert main.claim_summary_batch(db, job_ref) is True
+
+    # 已套用的批次不再認領
+    job_ref.set({'applied_at': datetime.now(timezone.utc), 'apply_claimed_at': expired}, merge=True)
+    assert main.claim_summary_batch(db, job_ref) is False
+
+
+def test_second_apply_is_skipped_without_downloading_again(db, client, openai_server, chat_docs):
+    batch_id = main.submit_summary_batch(db, client, chat_docs)['batch_id']
+    main.apply_summary_batch(db, client, batch_id)
+    db.document(CHAT_PATHS[0]).set({'summary': '人工修改'}, merge=True)
+
+    assert main.apply_summary_batch(db, client, batch_id)['skipped'] is True
+    assert openai_server.stats['files.content'] == 1
+    assert db.document(CHAT_PATHS[0]).get().to_dict()['summary'] == '人工修改'
+
+
+def test_chat_summary_batch_requires_admin(db):
+    request = SimpleNamespace(auth=SimpleNamespace(uid='u1', token={}), data={})
+    with pytest.raises(main.https_fn.HttpsError) as error:
+        inspect.unwrap(main.chat_summary_batch)(request)
+    assert error.value.code == main.https_fn.FunctionsErrorCode.PERMISSION_DENIED
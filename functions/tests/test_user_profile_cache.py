@@ -0,0 +1,81 @@
+"""UserProfileCache：分組查詢重用快取的用戶文檔，過期、淘汰或重新 seed 後讀到最新的分組"""
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手動推進的 time.monotonic"""
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def user_reads(db, monkeypatch):
+    """記錄對 users/{uid} 文檔的單獨讀取"""
+    reads = []
+    document_class = type(db.document('users/u1'))
+    original_get = document_class.get
+
+    def get(self, *args, **kwargs):
+        if self.path.count('/') == 1 and self.path.startswith('users/'):
+            reads.append(self.id)
+        return original_get(self, *args, **kwargs)
+    monkeypatch.setattr(document_class, 'get', get)
+    return reads
+
+
+def test_fetch_reads_each_user_once(db, user_reads):
+    db.document('users/u1').set({'app_config': 0})
+    for _ in range(3):
+        assert main.get_user_group_path('u1', db) == 'control'
+    # 不存在的用戶同樣快取（空 dict，默認為實驗組），不會每次重新讀取
+    for _ in range(2):
+        assert main.get_user_group_path('ghost', db) == 'experiment'
+    assert user_reads == ['u1', 'ghost']
+    assert main.user_profile_cache.stats() == {'size': 2, 'hits': 3, 'misses': 2}
+
+
+def test_seeded_page_needs_no_reads(db, user_reads):
+    for uid, app_config in (('u1', 0), ('u2', 1)):
+        db.document(f"users/{uid}").set({'app_config': app_config})
+    main.user_profile_cache.seed(list(db.collection('users').stream()))
+    assert [main.get_user_group_path(uid, db) for uid in ('u1', 'u2')] == ['control', 'experiment']
+    assert user_reads == []
+
+
+def test_expired_entry_is_read_again(db, user_reads, clock):
+    cache = main.UserProfileCache(ttl_sec=60)
+    db.document('users/u1').set({'app_config': 0})
+    assert cache.fetch('u1', db) == {'app_config': 0}
+
+    db.document('users/u1').set({'app_config': 1})
+    clock[0] += 60
+    assert cache.fetch('u1', db) == {'app_config': 0}
+    clock[0] += 1
+    assert cache.fetch('u1', db) == {'app_config': 1}
+    assert user_reads == ['u1', 'u1']
+
+
+def test_seed_replaces_stale_entries(db):
+    cache = main.UserProfileCache()
+    cache.put('u1', {'app_config': 0})
+    db.document('users/u1').set({'app_config': 1})
+    cache.seed([db.document('users/u1').get()])
+    assert cache.get('u1') == {'app_config': 1}
+
+
+def test_least_recently_used_entry_is_evicted(db, user_reads):
+    cache = main.UserProfileCache(maxsize=2)
+    for uid in ('u1', 'u2', 'u3'):
+        db.document(f"users/{uid}").set({'app_config': 1})
+    cache.fetch('u1', db)
+    cache.fetch('u2', db)
+    cache.fetch('u1', db)  # u1 變為最近使用
+    cache.fetch('u3', db)  # 淘汰 u2
+    assert cache.get('u2') is None
+    assert cache.get('u1') is not None and cache.get('u3') is not None
+    assert user_reads == ['u1', 'u2', 'u3']
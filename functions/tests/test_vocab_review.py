@@ -0,0 +1,122 @@
+"""單字間隔複習：到期順序、間隔隨複習次數增長（spaced_review:+1,+3 (within week)），以及 vocab_review_queue 的即時計算"""
+
+import inspect
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+import vocab_review
+
+MONDAY = date(2026, 10, 12)
+
+
+def study(week: int, day: int, on: date, positions: set[int] | None = None) -> dict:
+    return {'week': week, 'day': day, 'date': on, 'positions': positions}
+
+
+def queue_words(queue: dict) -> list[str]:
+    return [item['word'] for item in queue['items']]
+
+
+def test_fixture_rules_match_curriculum():
+    # 以下測試依賴課程素材的規則：第 1 週單字日為 day 1–5，複習間隔為 +1、+3 天且限於同週
+    assert vocab_review.REVIEW_RULES[(1, 1)] == ((1, 3), True)
+    assert vocab_review.LAST_VOCAB_DAYS[1] == 5
+
+
+def test_parse_review_policy():
+    assert vocab_review.parse_review_policy('spaced_review:+1,+3 (within week)') == ((1, 3), True)
+    assert vocab_review.parse_review_policy('spaced_review: +7, +2') == ((2, 7), False)
+    assert vocab_review.parse_review_policy('weekly_test') is None
+
+
+def test_interval_grows_after_each_review():
+    words = vocab_review.day_words(1, 1)
+    position = min(words)
+    studies = [study(1, 1, MONDAY, {position})]
+
+    # 學習隔天第一次到期
+    assert vocab_review.build_review_queue(studies, MONDAY)['next_due'] == '20261013'
+    first = vocab_review.build_review_queue(studies, MONDAY + timedelta(days=1))
+    assert [(item['word'], item['step'], item['due']) for item in first['items']] == [(words[position], 1, '20261013')]
+
+    # 完成第一次複習後，下一次在學習日 +3 天到期（間隔由 1 天增為 2 天）
+    studies.append(study(1, 1, MONDAY + timedelta(days=1), {position}))
+    assert vocab_review.build_review_queue(studies, MONDAY + timedelta(days=2)) == {'items': [], 'count': 0, 'next_due': '20261015'}
+    second = vocab_review.build_review_queue(studies, MONDAY + timedelta(days=3))
+    assert [(item['step'], item['due']) for item in second['items']] == [(2, '20261015')]
+
+    # 兩次複習都完成後不再排程
+    studies.append(study(1, 1, MONDAY + timedelta(days=3), {position}))
+    assert vocab_review.build_review_queue(studies, MONDAY + timedelta(days=10)) == {'items': [], 'count': 0, 'next_due': None}
+
+
+def test_late_review_completes_the_step_and_overdue_words_stay_due():
+    words = vocab_review.day_words(1, 1)
+    position = min(words)
+    # 第一次複習晚了一天（day +2）仍算完成第 1 次；第 2 次在 +3 天到期
+    studies = [study(1, 1, MONDAY, {position}), study(1, 1, MONDAY + timedelta(days=2), {position})]
+    assert vocab_review.build_review_queue(studies, MONDAY + timedelta(days=2))['next_due'] == '20261015'
+
+    # 從未複習：第 1 次逾期仍保持到期，並記錄逾期天數
+    overdue = vocab_review.build_review_queue(studies[:1], MONDAY + timedelta(days=4))
+    assert [(item['step'], item['overdue_days']) for item in overdue['items']] == [(1, 3)]
+
+
+def test_reviews_beyond_the_week_are_dropped():
+    # day 3 的 +3 天複習落在 day 6，超出第 1 週最後一個單字日（day 5），只保留 +1 天的複習
+    words = vocab_review.day_words(1, 3)
+    position = min(words)
+    studies = [study(1, 3, MONDAY + timedelta(days=2), {position}), study(1, 3, MONDAY + timedelta(days=3), {position})]
+    assert vocab_review.build_review_queue(studies, MONDAY + timedelta(days=30))['next_due'] is None
+    # day 5 的第一次複習就超出同週
+    assert vocab_review.build_review_queue([study(1, 5, MONDAY + timedelta(days=4))], MONDAY + timedelta(days=30))['count'] == 0
+
+
+def test_queue_orders_by_due_date_then_curriculum_order():
+    day1, day2 = vocab_review.day_words(1, 1), vocab_review.day_words(1, 2)
+    studies = [
+        # day 2 的單字先被學習，但到期較晚
+        study(1, 2, MONDAY + timedelta(days=1), set(sorted(day2)[:2])),
+        # day 1 的單字（位置倒序看過），第 1 次複習較早到期
+        study(1, 1, MONDAY, set(sorted(day1, reverse=True)[:3])),
+    ]
+    queue = vocab_review.build_review_queue(studies, MONDAY + timedelta(days=2))
+
+    expected_day1 = [day1[position] for position in sorted(day1)[-3:]]
+    expected_day2 = [day2[position] for position in sorted(day2)[:2]]
+    assert queue_words(queue) == expected_day1 + expected_day2
+    assert [item['due'] for item in queue['items']] == ['20261013'] * 3 + ['20261014'] * 2
+    assert queue['count'] == 5
+
+
+def test_queue_limit_keeps_total_count_and_earliest_items():
+    words = vocab_review.day_words(1, 1)
+    queue = vocab_review.build_review_queue([study(1, 1, MONDAY)], MONDAY + timedelta(days=1), limit=3)
+    assert queue_words(queue) == [words[position] for position in sorted(words)[:3]]
+    assert queue['count'] == len(words)
+
+
+def test_vocab_review_queue_requires_login():
+    with pytest.raises(main.https_fn.HttpsError) as error:
+        inspect.unwrap(main.vocab_review_queue)(SimpleNamespace(auth=None, data={}))
+    assert error.value.code == main.https_fn.FunctionsErrorCode.UNAUTHENTICATED
+
+
+def test_vocab_review_queue_computes_and_stores_missing_queue(db):
+    today = datetime.now(main.TAIWAN_TZ)
+    yesterday_9am = (today - timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0).astimezone(timezone.utc)
+    db.document('users/u1/experiment_events/e1').set({'title': 'vocab-w1-d1', 'scheduledStartTime': yesterday_9am})
+    # cardDwellTimes 的 key 為卡片位置，停留時間為 0 的卡片不算看過
+    db.document('users/u1/experiment_events/e1/vocab/s1').set({'startTime': yesterday_9am, 'cardDwellTimes': {'0': 1200, '1': 0}})
+
+    request = SimpleNamespace(auth=SimpleNamespace(uid='u1', token={}), data={})
+    computed = inspect.unwrap(main.vocab_review_queue)(request)
+    assert computed['source'] == 'computed'
+    assert [(item['position'], item['step']) for item in computed['items']] == [(0, 1)]
+
+    stored = inspect.unwrap(main.vocab_review_queue)(request)
+    assert stored['source'] == 'precomputed'
+    assert stored['items'] == computed['items']
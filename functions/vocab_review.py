@@ -0,0 +1,173 @@
+"""
+單字間隔複習排程：依課程素材的 spaced_review 規則，從使用者的單字學習紀錄計算到期的複習單字
+純計算模組，不讀寫 Firestore；學習紀錄由 main.py 從 vocab / review 會話文檔整理後傳入
+
+學習紀錄（study）為 dict:
+- week、day：會話所屬的課程週次與天數（取自事件標題）
+- date：會話日期（台灣時區的 datetime.date）
+- positions：看過的卡片在 items_shuffled 中的位置集合；None 表示整組單字都看過
+"""
+
+import heapq
+import json
+import os
+import re
+from datetime import date, timedelta
+from functools import lru_cache
+
+import curriculum
+
+CURRICULUM_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curriculum_index.json')
+
+# 例："spaced_review:+1,+3 (within week)"；within week 表示到期日超出該週的單字日就不再複習（交給週測驗）
+REVIEW_POLICY_PATTERN = re.compile(r'^spaced_review:\s*(\+?\d+(?:\s*,\s*\+?\d+)*)\s*(\(within week\))?\s*$')
+
+# 單日複習佇列的單字上限
+MAX_QUEUE_ITEMS = 16
+
+
+def parse_review_policy(policy: str) -> tuple[tuple[int, ...], bool] | None:
+    """解析複習規則，返回 (間隔天數, 是否限於同週)；不是 spaced_review 規則（如測試日）返回 None"""
+    match = REVIEW_POLICY_PATTERN.match(policy or '')
+    if not match:
+        return None
+    offsets = tuple(sorted(int(offset.strip().lstrip('+')) for offset in match.group(1).split(',')))
+    return offsets, match.group(2) is not None
+
+
+def load_review_rules(index_path: str = CURRICULUM_INDEX_PATH) -> tuple[dict, dict]:
+    """
+    讀取課程索引，返回:
+    - {(week, day): (間隔天數, 是否限於同週)}，只包含有 spaced_review 規則的單字日
+    - {week: 該週最後一個單字日}
+    """
+    with open(index_path, encoding='utf-8') as f:
+        index = json.load(f)
+    rules, last_days = {}, {}
+    for entry in index['days']:
+        if not entry.get('vocab_new_count') and not entry.get('vocab_review_count'):
+            continue
+        week, day = entry['week'], entry['day']
+        last_days[week] = max(last_days.get(week, day), day)
+        rule = parse_review_policy(entry.get('vocab_review_policy', ''))
+        if rule is not None:
+            rules[(week, day)] = rule
+    return rules, last_days
+
+
+# 導入時建立一次
+REVIEW_RULES, LAST_VOCAB_DAYS = load_review_rules()
+
+
+@lru_cache(maxsize=None)
+def day_words(week: int, day: int) -> dict[int, str]:
+    """(week, day) 的 {items_shuffled 位置: 單字}，與客戶端卡片的 index 一致"""
+    page = curriculum.CURRICULUM.query(
+        'vocab', {'week': week, 'day': day}, fields=['word', 'position'], page_size=curriculum.MAX_PAGE_SIZE
+    )
+    return {item['position']: item['word'] for item in page['items'] if item.get('position') is not None}
+
+
+def word_histories(studies: list[dict]) -> dict[tuple[int, str], dict]:
+    """
+    把學習紀錄整理成每個單字的歷程，key 為 (week, word)
+    第一次看到的日期為 learned，之後不同日期的再次接觸記入 reviews（已排序、去重）
+    """
+    histories: dict[tuple[int, str], dict] = {}
+    for study in sorted(studies, key=lambda s: s['date']):
+        words = day_words(study['week'], study['day'])
+        positions = words.keys() if study.get('positions') is None else study['positions']
+        for position in positions:
+            word = words.get(position)
+            if word is None:
+                continue
+            history = histories.get((study['week'], word))
+            if history is None:
+                histories[(study['week'], word)] = {
+                    'word': word,
+                    'week': study['week'],
+                    'day': study['day'],
+                    'position': position,
+                    'learned': study['date'],
+                    'reviews': [],
+                }
+            elif study['date'] > history['learned'] and study['date'] not in history['reviews']:
+                history['reviews'].append(study['date'])
+    return histories
+
+
+def next_review(history: dict) -> tuple[date, int] | None:
+    """
+    返回單字的下一次複習 (到期日, 第幾次複習)，複習已全部完成或超出同週範圍時返回 None
+    第 i 次複習在 learned + offsets[i] 天到期，由該日或之後的第一次接觸完成；逾期未複習的仍保持到期
+    """
+    rule = REVIEW_RULES.get((history['week'], history['day']))
+    if rule is None:
+        return None
+    offsets, within_week = rule
+    reviews = iter(history['reviews'])
+    for step, offset in enumerate(offsets):
+        due = history['learned'] + timedelta(days=offset)
+        if any(reviewed >= due for reviewed in reviews):
+            continue
+        if within_week and history['day'] + offset > LAST_VOCAB_DAYS.get(history['week'], 0):
+            return None
+        return due, step + 1
+    return None
+
+
+class ReviewQueue:
+    """
+    按到期日排序的最小堆，同一天到期時依課程順序（week、day、卡片位置）
+    pop_due(as_of) 依序取出已到期的單字，peek_due() 查看下一個到期日
+    """
+
+    def __init__(self):
+        self._heap: list[tuple] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, due: date, step: int, history: dict) -> None:
+        heapq.heappush(self._heap, (due, history['week'], history['day'], history['position'], history['word'], step))
+
+    def peek_due(self) -> date | None:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, as_of: date, limit: int = MAX_QUEUE_ITEMS) -> list[dict]:
+        items = []
+        while self._heap and self._heap[0][0] <= as_of and len(items) < limit:
+            due, week, day, position, word, step = heapq.heappop(self._heap)
+            items.append({
+                'word': word,
+                'week': week,
+                'day': day,
+                'position': position,
+                'step': step,
+                'due': due.strftime('%Y%m%d'),
+                'overdue_days': (as_of - due).days,
+            })
+        return items
+
+
+def build_review_queue(studies: list[dict], as_of: date, limit: int = MAX_QUEUE_ITEMS) -> dict:
+    """
+    計算 as_of 當天的複習佇列
+    返回 {'items': [...], 'count': 到期總數, 'next_due': 之後最近的到期日（YYYYMMDD）或 None}
+    """
+    queue = ReviewQueue()
+    for history in word_histories(studies).values():
+        scheduled = next_review(history)
+        if scheduled is not None:
+            queue.push(scheduled[0], scheduled[1], history)
+
+    items = queue.pop_due(as_of, limit)
+    due_count = len(items)
+    while queue.peek_due() is not None and queue.peek_due() <= as_of:
+        due_count += len(queue.pop_due(as_of))
+    next_due = queue.peek_due()
+    return {
+        'items': items,
+        'count': due_count,
+        'next_due': next_due.strftime('%Y%m%d') if next_due else None,
+    }
@@ -261,8 +261,7 @@ class ChatProvider extends ChangeNotifier {
       // 更新統計數據
       await _updateChatStatistics();
       
-      // 🎯 新增：生成並儲存聊天總結
-      await _generateAndSaveSummary();
+      // 聊天總結由雲函數 summarize_chat_on_end 在 result 寫入後於服務端生成並儲存，客戶端不再重複生成
       
       _hasEndedChat = true; // 标记聊天已结束
     } catch (e) {
@@ -302,40 +301,6 @@ class ChatProvider extends ChangeNotifier {
     }
   }
 
-  /// 生成並儲存聊天總結
-  Future<void> _generateAndSaveSummary() async {
-    // 檢查是否已被 dispose
-    if (_disposed) return;
-    
-    // 只有在有对话消息时才生成总结
-    if (_messages.isEmpty || _messages.length < 2) {
-      debugPrint('聊天消息太少，跳过总结生成');
-      return;
-    }
-
-    try {
-      debugPrint('開始生成聊天總結...');
-      
-      // 调用云函数获取总结
-      final summaryResult = await _coach.summarizeChat(_messages);
-      
-      // 儲存總結到 Firebase
-      await ExperimentEventHelper.saveChatSummary(
-        uid: uid,
-        eventId: eventId,
-        chatId: chatId,
-        summary: summaryResult.summary,
-        snoozeReasons: summaryResult.snoozeReasons,
-        coachMethods: summaryResult.coachMethods,
-      );
-      
-      debugPrint('聊天總結生成並存儲成功');
-    } catch (e) {
-      debugPrint('生成聊天總結失敗: $e');
-      // 总结失败不影响用户体验，只记录错误
-    }
-  }
-  
   /// 檢查用戶是否已表達開始任務的意願（用於判斷commit_plan）
   bool get hasCommitmentToPlan {
     // 簡單檢查最後幾條用戶消息是否包含肯定詞語